@@ -0,0 +1,480 @@
+"""
+Contrôle d'admission et ordonnancement des traitements de PDF (par worker)
+
+- au plus ADMISSION_MAX_DOCUMENTS documents traités en même temps
+- au plus ADMISSION_MAX_QUEUED documents admis en attente d'un créneau, par classe de priorité
+- au-delà, la requête est refusée (429 + Retry-After estimé d'après la durée moyenne d'un document)
+- corps de requête limité à MAX_REQUEST_BYTES, vérifié pendant la réception (413)
+
+L'admission est décidée par le middleware, avant la lecture du corps, sur le nombre de documents
+annoncé (X-Document-Count, 1 par défaut) ; la route ajuste ensuite la réservation au nombre réel.
+Les traitements admis s'exécutent sur un limiteur de threads dédié : un document qui attend son
+créneau n'occupe pas le pool partagé d'anyio qui sert toutes les autres routes.
+
+Une requête plus grosse que toute la capacité n'est admise que si plus rien n'est en attente :
+elle occupe alors toute la file jusqu'à ce qu'il lui reste moins de documents que la capacité.
+
+Classes de priorité : 'interactive' (petites requêtes) et 'bulk' (gros lots, archives).
+Chaque document attend son créneau dans la file de sa classe ; un créneau libéré va à la classe
+la moins servie au regard de son poids (partage équitable pondéré). Un lot est donc devancé
+entre deux documents par les requêtes interactives, jamais au milieu d'un document.
+"""
+import functools
+import json
+import logging
+import math
+import os
+import re
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Deque, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Documents traités simultanément par worker : l'extraction est liée au CPU et le GIL n'en
+# exécute qu'une à la fois par processus, le parallélisme vient des workers (WEB_CONCURRENCY)
+ADMISSION_MAX_DOCUMENTS = int(os.getenv("ADMISSION_MAX_DOCUMENTS", "1"))
+# Documents admis en attente d'un créneau (au-delà : 429)
+ADMISSION_MAX_QUEUED = int(os.getenv("ADMISSION_MAX_QUEUED", str(4 * ADMISSION_MAX_DOCUMENTS)))
+# Taille maximale d'un corps de requête, en octets
+MAX_REQUEST_BYTES = int(os.getenv("MAX_REQUEST_BYTES", str(256 * 1024 * 1024)))
+# Durée supposée d'un document tant qu'aucune n'a été mesurée
+ADMISSION_DEFAULT_DOCUMENT_SECONDS = 2.0
+
+INTERACTIVE = 'interactive'
+BULK = 'bulk'
+PRIORITY_CLASSES = (INTERACTIVE, BULK)
+# Classe demandée par le client ; sans en-tête, la classe dépend du nombre de documents
+PRIORITY_HEADER = "X-Priority"
+# Nombre de documents annoncé par le client, réservé avant la lecture du corps
+DOCUMENT_COUNT_HEADER = "X-Document-Count"
+# Au-delà de ce nombre de documents, une requête est traitée en 'bulk' quoi qu'elle demande
+INTERACTIVE_MAX_DOCUMENTS = int(os.getenv("INTERACTIVE_MAX_DOCUMENTS", "10"))
+# Part des créneaux accordée à chaque classe quand les deux attendent
+SCHEDULER_WEIGHTS = {
+    INTERACTIVE: float(os.getenv("SCHEDULER_INTERACTIVE_WEIGHT", "4")),
+    BULK: float(os.getenv("SCHEDULER_BULK_WEIGHT", "1")),
+}
+# Latences conservées par classe pour les percentiles
+LATENCY_WINDOW = 500
+
+# Requêtes soumises au contrôle d'admission (refusées avant lecture du corps si la file est pleine)
+ADMISSION_PATHS = re.compile(r"^/(analyze_pdfs/|uploads/[^/]+/finalize|batches/[^/]+/retry)$")
+
+class Overloaded(Exception):
+    """File d'attente pleine"""
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"Server busy, retry in {retry_after}s")
+        self.retry_after = retry_after
+
+def classify(headers, documents: int) -> str:
+    """
+    Classe d'une requête : X-Priority si fourni, sinon d'après son nombre de documents
+    headers : en-têtes Starlette, ou dictionnaire aux clés en minuscules
+    """
+    requested = headers.get(PRIORITY_HEADER.lower(), "").lower()
+    if requested == BULK or documents > INTERACTIVE_MAX_DOCUMENTS:
+        return BULK
+    return INTERACTIVE
+
+def _percentile(values: List[float], fraction: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return round(ordered[min(len(ordered) - 1, int(fraction * len(ordered)))], 3)
+
+class FairScheduler:
+    """
+    Créneaux de traitement partagés entre classes (file d'attente pondérée)
+    Chaque classe a un temps virtuel qui avance de 1/poids par créneau accordé ;
+    le prochain créneau va à la classe en attente dont le temps virtuel est le plus faible.
+    """
+
+    def __init__(self, slots: int, weights: Dict[str, float] = SCHEDULER_WEIGHTS):
+        self.free = slots
+        self.weights = {name: max(weight, 0.01) for name, weight in weights.items()}
+        self._virtual = dict.fromkeys(self.weights, 0.0)
+        # Temps virtuel du dernier créneau accordé
+        self._clock = 0.0
+        self._waiting: Dict[str, Deque] = {name: deque() for name in self.weights}
+        self._granted = set()
+        self._condition = threading.Condition()
+
+    def _charge(self, priority: str):
+        self._clock = self._virtual[priority]
+        self._virtual[priority] += 1 / self.weights[priority]
+
+    def _dispatch(self):
+        """Accorde les créneaux libres aux classes en attente (sous self._condition)"""
+        granted = False
+        while self.free > 0:
+            waiting = [name for name, queue in self._waiting.items() if queue]
+            if not waiting:
+                break
+            priority = min(waiting, key=lambda name: self._virtual[name])
+            self._granted.add(self._waiting[priority].popleft())
+            self._charge(priority)
+            self.free -= 1
+            granted = True
+        if granted:
+            self._condition.notify_all()
+
+    def acquire(self, priority: str):
+        with self._condition:
+            if self.free > 0 and not any(self._waiting.values()):
+                self.free -= 1
+                self._charge(priority)
+                return
+            if not self._waiting[priority]:
+                # Une classe qui se remet à attendre ne récupère pas le temps passé inactive
+                self._virtual[priority] = max(self._virtual[priority], self._clock)
+            waiter = object()
+            self._waiting[priority].append(waiter)
+            self._dispatch()
+            while waiter not in self._granted:
+                self._condition.wait()
+            self._granted.discard(waiter)
+
+    def release(self):
+        with self._condition:
+            self.free += 1
+            self._dispatch()
+
+    def waiting(self) -> Dict[str, int]:
+        with self._condition:
+            return {name: len(queue) for name, queue in self._waiting.items()}
+
+class AdmissionTicket:
+    """Réservation d'une requête admise ; libérée au fil des documents traités"""
+
+    def __init__(self, controller: 'AdmissionController', documents: int, reserved: int,
+                 priority: str = INTERACTIVE):
+        self.controller = controller
+        self.priority = priority
+        self.remaining = documents
+        self.cost = reserved
+        self.reserved = reserved
+        self.admitted_at = time.monotonic()
+        self._closed = False
+
+    @contextmanager
+    def document(self):
+        """Créneau de traitement d'un document (attend son tour dans la file de sa classe)"""
+        try:
+            with self.controller.slot(self.priority):
+                yield
+        finally:
+            self._document_done()
+
+    def _document_done(self):
+        self.remaining = max(0, self.remaining - 1)
+        self._shrink(min(self.remaining, self.cost))
+
+    def resize(self, documents: int):
+        """
+        Ajuste la réservation au nombre réel de documents, connu une fois le corps lu
+        Au-delà de INTERACTIVE_MAX_DOCUMENTS, la requête passe en 'bulk' ; lève Overloaded
+        si la file de sa classe ne peut pas l'accueillir
+        """
+        priority = BULK if documents > INTERACTIVE_MAX_DOCUMENTS else self.priority
+        self.controller._move(self, priority, min(max(documents, 1), self.controller.capacity))
+        self.remaining = documents
+
+    def _shrink(self, reserved: int):
+        with self.controller._lock:
+            self.controller.classes[self.priority]['pending'] -= self.reserved - reserved
+        self.reserved = reserved
+
+    def close(self):
+        """Libère ce qui reste réservé et enregistre la latence de la requête (fin, y compris en erreur)"""
+        if self._closed:
+            return
+        self._closed = True
+        if self.reserved:
+            self._shrink(0)
+        with self.controller._lock:
+            self.controller.classes[self.priority]['latencies'].append(
+                time.monotonic() - self.admitted_at
+            )
+
+class NullTicket:
+    """Aucune limite (scripts, Streamlit local)"""
+
+    @contextmanager
+    def document(self):
+        yield
+
+    priority = INTERACTIVE
+
+    def resize(self, documents: int):
+        pass
+
+    def close(self):
+        pass
+
+NULL_TICKET = NullTicket()
+
+class AdmissionController:
+    def __init__(self, max_documents: int = ADMISSION_MAX_DOCUMENTS,
+                 max_queued: int = ADMISSION_MAX_QUEUED):
+        self.max_documents = max(1, max_documents)
+        self.max_queued = max(0, max_queued)
+        # Capacité de chaque classe : un gros lot ne ferme pas la porte aux requêtes interactives
+        self.capacity = self.max_documents + self.max_queued
+        self.scheduler = FairScheduler(self.max_documents)
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.oversized_requests = 0
+        # pending : documents admis et pas encore terminés (réservations en cours)
+        self.classes = {
+            name: {'pending': 0, 'in_flight': 0, 'admitted_requests': 0, 'rejected_requests': 0,
+                   'started_documents': 0, 'completed_documents': 0, 'wait_seconds': 0.0,
+                   'latencies': deque(maxlen=LATENCY_WINDOW)}
+            for name in PRIORITY_CLASSES
+        }
+        self._document_seconds: Optional[float] = None
+        # Limiteur de threads des traitements admis, créé dans la boucle d'événements
+        self._limiter = None
+
+    def _observe(self, duration: float):
+        """Moyenne glissante de la durée d'un document (sous self._lock)"""
+        if self._document_seconds is None:
+            self._document_seconds = duration
+        else:
+            self._document_seconds = 0.9 * self._document_seconds + 0.1 * duration
+
+    @contextmanager
+    def slot(self, priority: str):
+        """Créneau de traitement : attend son tour dans la file de la classe, compté dans in_flight"""
+        metrics = self.classes[priority]
+        waited = time.monotonic()
+        self.scheduler.acquire(priority)
+        started = time.monotonic()
+        with self._lock:
+            self.in_flight += 1
+            metrics['in_flight'] += 1
+            metrics['started_documents'] += 1
+            metrics['wait_seconds'] += started - waited
+        try:
+            yield
+        finally:
+            duration = time.monotonic() - started
+            with self._lock:
+                self.in_flight -= 1
+                metrics['in_flight'] -= 1
+                metrics['completed_documents'] += 1
+                self._observe(duration)
+            self.scheduler.release()
+
+    def background_document(self, priority: str = BULK):
+        """
+        Créneau d'un traitement lancé hors requête admise (extraction pendant un téléversement) :
+        il partage les créneaux des requêtes, sans réservation dans la file
+        """
+        return self.slot(priority)
+
+    def retry_after(self, priority: str = INTERACTIVE) -> int:
+        """Délai estimé avant qu'une place se libère dans la file de la classe"""
+        per_document = self._document_seconds or ADMISSION_DEFAULT_DOCUMENT_SECONDS
+        backlog = max(1, self.classes[priority]['pending'] - self.max_queued)
+        return max(1, math.ceil(per_document * backlog / self.max_documents))
+
+    def reject(self, priority: str = INTERACTIVE) -> Overloaded:
+        with self._lock:
+            self.classes[priority]['rejected_requests'] += 1
+            retry_after = self.retry_after(priority)
+        logger.warning(f"Admission: {priority} request rejected, "
+                       f"{self.classes[priority]['pending']} document(s) pending, "
+                       f"retry after {retry_after}s")
+        return Overloaded(retry_after)
+
+    def admit(self, documents: int, priority: str = INTERACTIVE) -> AdmissionTicket:
+        """Réserve la place de `documents` documents ; lève Overloaded si la file est pleine"""
+        cost = min(max(documents, 1), self.capacity)
+        metrics = self.classes[priority]
+        with self._lock:
+            if metrics['pending'] + cost <= self.capacity:
+                metrics['pending'] += cost
+                metrics['admitted_requests'] += 1
+                return AdmissionTicket(self, documents, cost, priority)
+        raise self.reject(priority)
+
+    def _move(self, ticket: AdmissionTicket, priority: str, cost: int):
+        """Remplace la réservation d'un ticket par `cost` documents dans la classe `priority`"""
+        with self._lock:
+            target = self.classes[priority]
+            held = ticket.reserved if priority == ticket.priority else 0
+            admitted = target['pending'] - held + cost <= self.capacity
+            if admitted:
+                source = self.classes[ticket.priority]
+                source['pending'] -= ticket.reserved
+                target['pending'] += cost
+                if priority != ticket.priority:
+                    source['admitted_requests'] -= 1
+                    target['admitted_requests'] += 1
+                ticket.priority, ticket.cost, ticket.reserved = priority, cost, cost
+        if not admitted:
+            raise self.reject(priority)
+
+    async def run(self, func, *args, **kwargs):
+        """
+        Exécute un traitement admis dans un thread du limiteur dédié
+        Chaque requête admise réserve au moins une place dans sa classe : avec autant de threads
+        que la capacité des deux classes, aucune requête admise n'attend un thread, et celles qui
+        attendent un créneau n'occupent pas le pool partagé d'anyio (/uploads, /search, /ledger...)
+        """
+        import anyio.to_thread
+
+        if self._limiter is None:
+            self._limiter = anyio.CapacityLimiter(len(PRIORITY_CLASSES) * self.capacity)
+        return await anyio.to_thread.run_sync(functools.partial(func, *args, **kwargs),
+                                              limiter=self._limiter)
+
+    def stats(self) -> Dict:
+        waiting = self.scheduler.waiting()
+        with self._lock:
+            classes = {}
+            for name, metrics in self.classes.items():
+                decided = metrics['admitted_requests'] + metrics['rejected_requests']
+                latencies = list(metrics['latencies'])
+                classes[name] = {
+                    'weight': self.scheduler.weights[name],
+                    'in_flight': metrics['in_flight'],
+                    'waiting_documents': waiting[name],
+                    'queued': max(0, metrics['pending'] - metrics['in_flight']),
+                    'admitted_requests': metrics['admitted_requests'],
+                    'rejected_requests': metrics['rejected_requests'],
+                    'rejection_rate': (
+                        round(metrics['rejected_requests'] / decided, 4) if decided else None
+                    ),
+                    'completed_documents': metrics['completed_documents'],
+                    'average_wait_seconds': (
+                        round(metrics['wait_seconds'] / metrics['started_documents'], 3)
+                        if metrics['started_documents'] else None
+                    ),
+                    'latency_p50_seconds': _percentile(latencies, 0.5),
+                    'latency_p95_seconds': _percentile(latencies, 0.95),
+                    'latency_p99_seconds': _percentile(latencies, 0.99),
+                }
+            return {
+                'max_documents': self.max_documents,
+                'max_queued': self.max_queued,
+                'in_flight': self.in_flight,
+                'oversized_requests': self.oversized_requests,
+                'average_document_seconds': (
+                    round(self._document_seconds, 3) if self._document_seconds is not None else None
+                ),
+                'classes': classes,
+            }
+
+_admission: Optional[AdmissionController] = None
+_admission_lock = threading.Lock()
+
+def get_admission() -> AdmissionController:
+    """Contrôleur partagé du worker"""
+    global _admission
+    if _admission is None:
+        with _admission_lock:
+            if _admission is None:
+                _admission = AdmissionController()
+    return _admission
+
+def declared_documents(headers) -> int:
+    """Nombre de documents annoncé (X-Document-Count), 1 si absent ou invalide"""
+    declared = headers.get(DOCUMENT_COUNT_HEADER.lower(), "")
+    return max(1, int(declared)) if declared.isdigit() else 1
+
+class RequestTooLarge(Exception):
+    pass
+
+async def _send_json(send, status: int, content: Dict, headers=()):
+    body = json.dumps(content).encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json'),
+                    (b'content-length', str(len(body)).encode()), *headers],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+class AdmissionMiddleware:
+    """
+    Middleware ASGI :
+    - admet les traitements avant la lecture du corps (ticket dans scope['state']), sinon 429
+    - interrompt (413) tout corps dépassant max_body_bytes, annoncé ou constaté en cours de réception
+    """
+
+    def __init__(self, app, max_body_bytes: int = MAX_REQUEST_BYTES, controller=None):
+        self.app = app
+        self.max_body_bytes = max_body_bytes
+        self.controller = controller
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        controller = self.controller or get_admission()
+
+        headers = {key.decode('latin-1').lower(): value.decode('latin-1')
+                   for key, value in scope.get('headers') or []}
+        too_large = {'detail': f"Request body is limited to {self.max_body_bytes} bytes"}
+        declared = headers.get('content-length')
+        if declared and declared.isdigit() and int(declared) > self.max_body_bytes:
+            with controller._lock:
+                controller.oversized_requests += 1
+            await _send_json(send, 413, too_large)
+            return
+
+        ticket = None
+        if scope['method'] == 'POST' and ADMISSION_PATHS.match(scope['path']):
+            # Réservation sur le nombre annoncé ; la route l'ajuste une fois les fichiers reçus
+            documents = declared_documents(headers)
+            try:
+                ticket = controller.admit(documents, classify(headers, documents))
+            except Overloaded as overloaded:
+                await _send_json(send, 429, {'detail': str(overloaded)},
+                                 [(b'retry-after', str(overloaded.retry_after).encode())])
+                return
+            scope.setdefault('state', {})['admission_ticket'] = ticket
+
+        received = 0
+        exceeded = False
+        started = False
+
+        async def limited_receive():
+            nonlocal received, exceeded
+            message = await receive()
+            if message['type'] == 'http.request':
+                received += len(message.get('body', b''))
+                if received > self.max_body_bytes:
+                    exceeded = True
+                    raise RequestTooLarge()
+            return message
+
+        async def guarded_send(message):
+            nonlocal started
+            # La réponse d'erreur de l'application (corps tronqué) est remplacée par un 413
+            if exceeded and not started:
+                return
+            if message['type'] == 'http.response.start':
+                started = True
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, guarded_send)
+        except RequestTooLarge:
+            pass
+        except Exception:
+            if not exceeded:
+                raise
+        finally:
+            if ticket is not None:
+                ticket.close()
+        if exceeded and not started:
+            with controller._lock:
+                controller.oversized_requests += 1
+            logger.warning(f"Request body over {self.max_body_bytes} bytes on {scope['path']}")
+            await _send_json(send, 413, too_large)
@@ -0,0 +1,208 @@
+"""
+Agrégats mensuels maintenus au fil des lots (SQLite)
+
+- contributions : dernière contribution de chaque facture (clé = type + numéro de facture)
+- monthly : totaux par mois x Syst x Réseau_Vente x Type_Vente
+
+Valider une facture retire son ancienne contribution (correction, doublon, reprise) avant
+d'ajouter la nouvelle : une facture n'est jamais comptée deux fois. Les montants sont calculés
+comme dans le classeur (invoice_to_row) et stockés en centimes pour éviter toute dérive d'arrondi.
+Un rapport lit uniquement la table monthly : son coût ne dépend pas du volume d'historique.
+"""
+import logging
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Optional
+
+from create_invoice_excel import invoice_to_row
+from records import Invoice, as_invoice, parse_invoice_date
+
+logger = logging.getLogger(__name__)
+
+# Base des agrégats (vide : agrégats désactivés)
+AGGREGATES_PATH = os.getenv("AGGREGATES_PATH", "temp_files/aggregates.sqlite")
+
+DIMENSIONS = ('month', 'syst', 'reseau_vente', 'type_vente')
+MONEY_MEASURES = ('total_ht', 'tva', 'total_ttc', 'remise')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS contributions (
+    invoice_key TEXT PRIMARY KEY,
+    month TEXT NOT NULL,
+    syst TEXT NOT NULL,
+    reseau_vente TEXT NOT NULL,
+    type_vente TEXT NOT NULL,
+    total_ht INTEGER NOT NULL,
+    tva INTEGER NOT NULL,
+    total_ttc INTEGER NOT NULL,
+    remise INTEGER NOT NULL,
+    quantite REAL NOT NULL,
+    job_id TEXT,
+    filename TEXT,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS monthly (
+    month TEXT NOT NULL,
+    syst TEXT NOT NULL,
+    reseau_vente TEXT NOT NULL,
+    type_vente TEXT NOT NULL,
+    invoice_count INTEGER NOT NULL,
+    total_ht INTEGER NOT NULL,
+    tva INTEGER NOT NULL,
+    total_ttc INTEGER NOT NULL,
+    remise INTEGER NOT NULL,
+    quantite REAL NOT NULL,
+    PRIMARY KEY (month, syst, reseau_vente, type_vente)
+);
+"""
+
+def _cents(value) -> int:
+    try:
+        return round(float(value or 0) * 100)
+    except (TypeError, ValueError):
+        return 0
+
+def aggregate_key(invoice: Invoice, job_id: str, filename: str) -> str:
+    """Identité d'une facture : son numéro (N° Syst.), sinon le fichier qui l'a produite"""
+    if invoice.numero_facture:
+        return f"{invoice.type}|{invoice.numero_facture}"
+    return f"file|{job_id}|{filename}"
+
+def contribution(invoice: Invoice) -> Dict:
+    """Dimensions et mesures d'une facture, calculées comme dans le classeur"""
+    row = invoice_to_row(invoice)
+    date_facture = parse_invoice_date(invoice.date_facture)
+    return {
+        'month': date_facture.strftime('%Y-%m') if date_facture else '',
+        'syst': row['Syst'],
+        'reseau_vente': invoice.reseau_vente or '',
+        'type_vente': invoice.type_vente or '',
+        'total_ht': _cents(row['Credit HT']),
+        'tva': _cents(row['TVA Collectee']),
+        'total_ttc': _cents(row['Credit TTC']),
+        'remise': _cents(row['remise']),
+        'quantite': float(row['quantité'] or 0),
+    }
+
+class MonthlyAggregates:
+    def __init__(self, path=AGGREGATES_PATH):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(str(path), check_same_thread=False, timeout=30)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(SCHEMA)
+        self._db.commit()
+        self._lock = threading.Lock()
+
+    def _apply(self, values: Dict, sign: int):
+        """Ajoute (sign=1) ou retire (sign=-1) une contribution de son agrégat"""
+        dims = tuple(values[d] for d in DIMENSIONS)
+        self._db.execute(
+            """INSERT INTO monthly VALUES (?, ?, ?, ?, 0, 0, 0, 0, 0, 0)
+               ON CONFLICT DO NOTHING""", dims
+        )
+        self._db.execute(
+            """UPDATE monthly SET invoice_count = invoice_count + ?, total_ht = total_ht + ?,
+                   tva = tva + ?, total_ttc = total_ttc + ?, remise = remise + ?,
+                   quantite = quantite + ?
+               WHERE month = ? AND syst = ? AND reseau_vente = ? AND type_vente = ?""",
+            (sign, sign * values['total_ht'], sign * values['tva'], sign * values['total_ttc'],
+             sign * values['remise'], sign * values['quantite'], *dims)
+        )
+        if sign < 0:
+            self._db.execute(
+                """DELETE FROM monthly WHERE invoice_count <= 0
+                   AND month = ? AND syst = ? AND reseau_vente = ? AND type_vente = ?""", dims
+            )
+
+    def _replace(self, key: str, values: Optional[Dict], job_id: str = None, filename: str = None):
+        previous = self._db.execute(
+            "SELECT * FROM contributions WHERE invoice_key = ?", (key,)
+        ).fetchone()
+        if previous is not None:
+            self._apply(dict(previous), -1)
+            self._db.execute("DELETE FROM contributions WHERE invoice_key = ?", (key,))
+        if values is None:
+            return
+        self._apply(values, 1)
+        self._db.execute(
+            """INSERT INTO contributions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+            (key, *(values[d] for d in DIMENSIONS), *(values[m] for m in MONEY_MEASURES),
+             values['quantite'], job_id, filename, time.time())
+        )
+
+    def commit_batch(self, job_id: str, invoices_data: Dict) -> int:
+        """Valide les factures d'un lot en une transaction (remplace leurs contributions précédentes)"""
+        committed = 0
+        with self._lock, self._db:
+            for filename, entry in invoices_data.items():
+                invoice = as_invoice(entry)
+                try:
+                    values = contribution(invoice)
+                except Exception as e:
+                    logger.error(f"Aggregates: cannot compute {filename}: {str(e)}")
+                    continue
+                self._replace(aggregate_key(invoice, job_id, filename), values, job_id, filename)
+                committed += 1
+        return committed
+
+    def remove(self, key: str):
+        """Retire une facture des agrégats (facture annulée)"""
+        with self._lock, self._db:
+            self._replace(key, None)
+
+    def rebuild(self):
+        """Recalcule la table monthly à partir des contributions (contrôle de cohérence)"""
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM monthly")
+            self._db.execute(
+                """INSERT INTO monthly
+                   SELECT month, syst, reseau_vente, type_vente, COUNT(*), SUM(total_ht), SUM(tva),
+                          SUM(total_ttc), SUM(remise), SUM(quantite)
+                   FROM contributions GROUP BY month, syst, reseau_vente, type_vente"""
+            )
+
+    def summary(self, month_from: Optional[str] = None, month_to: Optional[str] = None,
+                syst: Optional[str] = None, reseau_vente: Optional[str] = None,
+                type_vente: Optional[str] = None) -> Dict:
+        """Agrégats filtrés (mois au format YYYY-MM), montants en euros, et leur total"""
+        conditions, params = [], []
+        for column, operator, value in (('month', '>=', month_from), ('month', '<=', month_to),
+                                        ('syst', '=', syst), ('reseau_vente', '=', reseau_vente),
+                                        ('type_vente', '=', type_vente)):
+            if value:
+                conditions.append(f"{column} {operator} ?")
+                params.append(value)
+        sql = "SELECT * FROM monthly"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY month, syst, reseau_vente, type_vente"
+
+        with self._lock:
+            rows = [dict(row) for row in self._db.execute(sql, params).fetchall()]
+
+        totals = {'invoice_count': 0, 'quantite': 0.0, **{m: 0 for m in MONEY_MEASURES}}
+        for row in rows:
+            for measure in totals:
+                totals[measure] += row[measure]
+        for row in rows + [totals]:
+            for measure in MONEY_MEASURES:
+                row[measure] = row[measure] / 100
+        return {'rows': rows, 'totals': totals}
+
+_aggregates: Optional[MonthlyAggregates] = None
+_aggregates_lock = threading.Lock()
+
+def get_aggregates() -> Optional[MonthlyAggregates]:
+    """Agrégats partagés du processus (None si AGGREGATES_PATH est vide)"""
+    global _aggregates
+    if not AGGREGATES_PATH:
+        return None
+    if _aggregates is None:
+        with _aggregates_lock:
+            if _aggregates is None:
+                _aggregates = MonthlyAggregates()
+    return _aggregates
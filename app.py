@@ -1,20 +1,41 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException
-from fastapi.responses import FileResponse
+from fastapi import FastAPI, UploadFile, File, HTTPException, Request
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
+from starlette.background import BackgroundTask
+from starlette.concurrency import run_in_threadpool
+import asyncio
+import io
 import shutil
+import sqlite3
 from pathlib import Path
-import tempfile
-import uvicorn
 import logging
 import os
+import threading
+import time
+import uuid
 from datetime import datetime
-import pytz
-from typing import List
-from pdf_extractor import extract_text_from_pdf
+from dataclasses import dataclass, field
+from concurrent.futures import Future
+from typing import Dict, List
 from billing_extractor import InvoiceExtractor
-from create_invoice_excel import create_invoice_dataframe, format_excel
+from create_invoice_excel import create_invoice_dataframe, build_workbook
 import json
 import traceback
-import pandas as pd
+from admission import NULL_TICKET, AdmissionMiddleware, Overloaded, classify, get_admission
+from aggregates import get_aggregates
+from artifact_store import (ARTIFACT_STORE_URL, batch_key, get_artifact_store, get_json,
+                            publish_batch, restore_batch)
+from dedup import BatchDeduplicator, DuplicateIndex
+from monthly_ledger import get_monthly_ledger
+from parse_cache import get_parse_cache
+from profiling import (NULL_PROFILER, list_profiles, memory_status, profile_path,
+                       request_profiler)
+from records import dump_invoices, load_invoices
+from search_index import get_search_index
+from tiered_extraction import extract_invoice_tiered
+from uploads import SESSION_MARKER, UPLOAD_CHUNK_SIZE, ExtractionQueue, UploadSession
+from workspace import Workspace, cleanup_expired, janitor, latest_workspace
+
+# Les modules lourds (pandas, pytz, pdfplumber, pyarrow) sont importés à la première utilisation
 
 # Configuration du logging
 logging.basicConfig(level=logging.INFO)
@@ -22,122 +43,485 @@ logger = logging.getLogger(__name__)
 
 app = FastAPI()
 
+# Taille des corps de requête bornée, traitements refusés (429) quand la file est pleine
+app.add_middleware(AdmissionMiddleware)
+
 # Create temp_files directory if it doesn't exist
 TEMP_DIR = Path("temp_files")
 TEMP_DIR.mkdir(exist_ok=True)
 
-def generate_excel_filename():
-    """Génère un nom de fichier au format factures_auto_YYMMDDHHMMSS"""
+# Un sous-répertoire isolé par requête, nettoyé par TTL
+WORKSPACES_DIR = TEMP_DIR / "workspaces"
+WORKSPACES_DIR.mkdir(exist_ok=True)
+
+# Export Parquet optionnel (désactivé si la variable n'est pas définie)
+PARQUET_EXPORT_DIR = os.getenv("PARQUET_EXPORT_DIR")
+
+# Conservation du texte brut des factures dans factures.json (désactivée par défaut)
+KEEP_RAW_TEXT = os.getenv("KEEP_RAW_TEXT", "false").lower() in ("1", "true", "yes")
+
+# Détection des doublons avec les lots précédents (index persistant dans TEMP_DIR)
+DEDUP_ACROSS_BATCHES = os.getenv("DEDUP_ACROSS_BATCHES", "true").lower() in ("1", "true", "yes")
+
+# Index des doublons, recherche, agrégats et grand livre sont des bases SQLite propres au réplica.
+# Avec un stockage partagé (plusieurs réplicas), chacun n'en verrait qu'une partie : elles sont
+# désactivées, sauf REPLICA_LOCAL_STORES=true (un seul réplica derrière ce stockage)
+REPLICA_LOCAL_STORES = os.getenv("REPLICA_LOCAL_STORES", "false").lower() in ("1", "true", "yes")
+
+# Préchauffage de la chaîne d'extraction en arrière-plan au démarrage
+WARMUP_ON_STARTUP = os.getenv("WARMUP_ON_STARTUP", "true").lower() in ("1", "true", "yes")
+
+# Texte minimal de facture MEG utilisé pour le préchauffage
+WARMUP_SAMPLE_TEXT = (
+    "N° : FAC0000000\nDate: 01/01/2024\nN° client : CLT000\n"
+    "ART000 - Préchauffage 1,00 1,00 € 0,00% 1,00 € 20,00%\n"
+    "Total HT 1,00 €\nTVA 0,20 €\nTotal TTC 1,20 €\n"
+)
+
+_warm_event = threading.Event()
+_warm_lock = threading.Lock()
+
+def warmup():
+    """Importe et préchauffe la chaîne d'extraction (pdfplumber, regex, pandas, xlsxwriter)"""
+    with _warm_lock:
+        if _warm_event.is_set():
+            return
+        started = time.perf_counter()
+
+        import pdfplumber  # noqa: F401
+        import pytz
+
+        import font_cache  # noqa: F401
+
+        pytz.timezone('Europe/Paris')
+
+        # Un passage complet sur une facture factice charge les regex et l'export Excel
+        invoice = InvoiceExtractor().extract_invoice(WARMUP_SAMPLE_TEXT)
+        df = create_invoice_dataframe({"warmup.pdf": invoice})
+        build_workbook(df).close()
+
+        if PARQUET_EXPORT_DIR:
+            import pyarrow.dataset  # noqa: F401
+
+        _warm_event.set()
+        logger.info(f"Extraction stack warmed up in {time.perf_counter() - started:.2f}s")
+
+def _warmup_in_background():
+    try:
+        warmup()
+    except Exception as e:
+        logger.error(f"Warm-up failed: {str(e)}")
+        logger.error(traceback.format_exc())
+
+def generate_excel_filename(job_id: str = None):
+    """
+    Génère un nom de fichier au format factures_auto_YYMMDDHHMMSS_<suffixe>
+    Le suffixe (issu de l'identifiant de lot) évite les collisions entre requêtes simultanées
+    """
+    import pytz
+
     paris_tz = pytz.timezone('Europe/Paris')
     current_time = datetime.now(paris_tz)
     timestamp = current_time.strftime('%y%m%d%H%M%S')
-    return f'factures_auto_{timestamp}.xlsx'
+    suffix = job_id.rsplit('-', 1)[-1][:8] if job_id else uuid.uuid4().hex[:8]
+    return f'factures_auto_{timestamp}_{suffix}.xlsx'
+
+_duplicate_index = None
+_duplicate_index_lock = threading.Lock()
+
+def local_stores_enabled() -> bool:
+    """Bases SQLite propres au réplica utilisables : pas de stockage partagé, ou un seul réplica"""
+    return REPLICA_LOCAL_STORES or not ARTIFACT_STORE_URL
+
+def _require_local_store(getter, disabled: str):
+    """Base locale servie par une route ; 404 si la fonction est désactivée"""
+    if not local_stores_enabled():
+        raise HTTPException(status_code=404, detail=(
+            f"{disabled}: per-replica store unavailable with a shared artifact store "
+            f"(set REPLICA_LOCAL_STORES=true for a single replica)"
+        ))
+    store = getter()
+    if store is None:
+        raise HTTPException(status_code=404, detail=disabled)
+    return store
+
+def get_duplicate_index():
+    """Index inter-lots des factures récentes, chargé à la première utilisation"""
+    global _duplicate_index
+    with _duplicate_index_lock:
+        if _duplicate_index is None:
+            _duplicate_index = DuplicateIndex(TEMP_DIR / "dedup_index.sqlite")
+        return _duplicate_index
+
+# Statut de chaque fichier d'un lot, dans son espace de travail
+MANIFEST_FILE = "manifest.json"
+
+@dataclass(slots=True)
+class BatchResult:
+    """
+    Résultat d'un lot : classeur en mémoire (à fermer par l'appelant), doublons écartés
+    et manifeste (statut de chaque fichier)
+    """
+    excel_filename: str
+    workbook: object
+    duplicates: list = field(default_factory=list)
+    manifest: list = field(default_factory=list)
+
+    @property
+    def failed(self) -> list:
+        return [entry for entry in self.manifest if entry['status'] in ('error', 'missing')]
+
+def _keep_duplicate(deduplicator, duplicate, invoices_data):
+    """Politique flag : conserve la facture en double, marquée, sans nouvelle analyse"""
+    flagged = deduplicator.flagged(duplicate)
+    if flagged is not None:
+        invoices_data[duplicate.filename] = flagged
+
+def _commit_secondary_stores(workspace: Workspace, invoices: Dict, texts: Dict,
+                             manifest: List[Dict], profiler=NULL_PROFILER):
+    """
+    Reporte les factures livrées d'un lot dans les index secondaires (recherche, agrégats,
+    grand livre, Parquet). Ils sont secondaires : le lot est livré même si l'un d'eux échoue.
+    """
+    if not invoices:
+        return
+    # Bases propres au réplica : écartées avec un stockage partagé (voir REPLICA_LOCAL_STORES)
+    local = local_stores_enabled()
+
+    # Indexer les nouvelles factures pour GET /search
+    search_index = get_search_index() if local else None
+    indexed_texts = {filename: text for filename, text in texts.items() if filename in invoices}
+    if search_index is not None and indexed_texts:
+        try:
+            with profiler.stage("search_index"):
+                indexed = search_index.index_batch(
+                    workspace.job_id, invoices, indexed_texts,
+                    {entry['file']: entry['name'] for entry in manifest}
+                )
+            logger.info(f"Search index: {indexed} invoice(s) indexed")
+        except Exception as e:
+            logger.error(f"Search indexing failed: {str(e)}")
+
+    # Mettre à jour les agrégats mensuels (une facture déjà comptée est remplacée)
+    aggregates = get_aggregates() if local else None
+    if aggregates is not None:
+        try:
+            with profiler.stage("aggregates"):
+                committed = aggregates.commit_batch(workspace.job_id, invoices)
+            logger.info(f"Monthly aggregates: {committed} invoice(s) committed")
+        except Exception as e:
+            logger.error(f"Aggregates update failed: {str(e)}")
+
+    # Grand livre mensuel : lignes ajoutées, ou remplacées si le N° Syst. existe déjà
+    monthly_ledger = get_monthly_ledger() if local else None
+    if monthly_ledger is not None:
+        try:
+            with profiler.stage("ledger"):
+                counts = monthly_ledger.commit_batch(workspace.job_id, invoices)
+            logger.info(f"Monthly ledger: {counts}")
+        except Exception as e:
+            logger.error(f"Monthly ledger update failed: {str(e)}")
+
+    # Exporter en Parquet pour les traitements analytiques
+    if PARQUET_EXPORT_DIR:
+        try:
+            from parquet_export import export_parquet
 
-def process_pdfs(pdf_paths):
-    """Traite les PDFs et génère un fichier Excel"""
+            with profiler.stage("parquet_export"):
+                result = export_parquet(invoices, PARQUET_EXPORT_DIR)
+            logger.info(f"Parquet export: {result}")
+        except Exception as e:
+            logger.error(f"Parquet export failed: {str(e)}")
+
+def process_pdfs(pdf_paths, keep_text=KEEP_RAW_TEXT, workspace: Workspace = None,
+                 profiler=NULL_PROFILER, prefetched: Dict[str, Future] = None,
+                 original_names: Dict[str, str] = None, previous: Dict = None,
+                 previous_manifest: List[Dict] = None, ticket=NULL_TICKET) -> BatchResult:
+    """
+    Traite les PDFs et génère le classeur Excel en mémoire
+    Un fichier en échec n'interrompt pas le lot : il est noté dans le manifeste et dans la
+    feuille 'Erreurs' du classeur, les autres factures sont livrées.
+    prefetched : extractions déjà lancées (téléversement par morceaux), par chemin de fichier
+    original_names : nom d'origine de chaque fichier reçu
+    previous, previous_manifest : factures et manifeste conservés d'un traitement précédent (reprise)
+    ticket : réservation d'admission ; chaque extraction attend un créneau de traitement
+    """
+    if workspace is None:
+        workspace = Workspace.create(WORKSPACES_DIR)
+    original_names = original_names or {}
     logger.info(f"Starting PDF processing for paths: {pdf_paths}")
 
     # Initialiser l'extracteur
-    extractor = InvoiceExtractor()
+    # Un texte déjà analysé avec les mêmes patterns n'est pas réanalysé
+    extractor = InvoiceExtractor(cache=get_parse_cache())
+
+    # Doublons dans le lot, et avec les lots précédents si l'index est activé (index propre au
+    # réplica : désactivé avec un stockage partagé). Les fichiers du lot lui-même (reprise)
+    # ne sont pas des doublons
+    across_batches = DEDUP_ACROSS_BATCHES and local_stores_enabled()
+    deduplicator = BatchDeduplicator(get_duplicate_index() if across_batches else None,
+                                     job_id=workspace.job_id, names=original_names)
 
     # Dictionnaire pour stocker les données des factures
-    invoices_data = {}
+    invoices_data = dict(previous or {})
+    manifest = list(previous_manifest or [])
+    # Texte extrait de chaque facture, pour l'index de recherche
+    texts = {}
 
     # Traiter chaque PDF
     for pdf_path in pdf_paths:
+        # Get just the filename without the path
+        filename = os.path.basename(pdf_path)
+        entry = {'file': filename, 'name': original_names.get(filename, filename), 'status': 'ok'}
+        manifest.append(entry)
+        # Repousse l'expiration à chaque document : le nettoyage ne supprime pas un lot en cours
+        workspace.touch()
+        stage = 'read'
         try:
             logger.info(f"Processing file: {pdf_path}")
 
-            # Get just the filename without the path
-            filename = os.path.basename(pdf_path)
-
             # Vérifier que le fichier existe
             if not os.path.exists(str(pdf_path)):
                 logger.error(f"File not found: {pdf_path}")
+                entry.update(status='missing', stage=stage, error="File not found")
                 continue
 
-            # Extraire le texte du PDF
-            logger.info("Extracting text...")
-            extracted_data = extract_text_from_pdf(str(pdf_path))
-            text = extracted_data.get('text', '')
-            logger.info(f"Extracted text length: {len(text)}")
+            # Copie exacte d'un fichier déjà traité : aucune extraction
+            stage = 'dedup'
+            with profiler.stage("dedup", filename):
+                duplicate = deduplicator.check_content(filename, pdf_path)
+            if duplicate:
+                _keep_duplicate(deduplicator, duplicate, invoices_data)
+                entry.update(status='duplicate', original=duplicate.original)
+                continue
 
-            # Extraire les données de la facture
+            # Extraire la facture : texte rapide, étages coûteux si les montants ne se recoupent pas
             logger.info("Extracting invoice data...")
-            data = extractor.extract_invoice_data(text)
+            stage = 'extract'
+            future = prefetched.get(str(pdf_path)) if prefetched else None
+            if future is not None:
+                result = future.result()
+            else:
+                with ticket.document():
+                    result = extract_invoice_tiered(str(pdf_path), extractor, profiler)
+            if result is None:
+                raise ValueError("Text extraction failed")
+            invoice, text = result.invoice, result.text
+            entry['tier'] = result.tier
+            logger.info(f"Extracted text length: {len(text)}, tier: {result.tier}")
 
-            # Calculate total quantity from articles
-            total_quantity = 0
-            articles = data.get("invoice_data", {}).get("articles", [])
-            for article in articles:
-                total_quantity += article.get("quantite", 0)
+            # Update nombre_articles with the actual sum of quantities
+            invoice.nombre_articles = invoice.total_quantity()
+            logger.info(f"Total quantity calculated: {invoice.nombre_articles}")
+
+            # Même facture déjà traitée (réexport, autre nom de fichier...)
+            stage = 'dedup'
+            duplicate = deduplicator.check_invoice(filename, invoice)
+            if duplicate:
+                _keep_duplicate(deduplicator, duplicate, invoices_data)
+                entry.update(status='duplicate', original=duplicate.original)
+                continue
 
-            logger.info(f"Total quantity calculated: {total_quantity}")
+            # Le texte brut n'est conservé que sur demande
+            if keep_text:
+                invoice.text = text
 
-            # Update nombre_articles with the actual sum of quantities
-            if "invoice_data" in data:
-                data["invoice_data"]["nombre_articles"] = total_quantity
-
-            # Stocker les données dans le format attendu par create_invoice_dataframe
-            invoices_data[filename] = {
-                "text": text,
-                "data": {
-                    "type": data.get("invoice_data", {}).get("type", ""),
-                    "TOTAL": data.get("invoice_data", {}).get("TOTAL", {}),
-                    "articles": data.get("invoice_data", {}).get("articles", []),
-                    "nombre_articles": total_quantity,  # Use calculated total
-                    "Type_Vente": data.get("invoice_data", {}).get("Type_Vente", ""),
-                    "Réseau_Vente": data.get("invoice_data", {}).get("Réseau_Vente", ""),
-                    "commentaire": data.get("invoice_data", {}).get("commentaire", ""),
-                    "statut_paiement": data.get("invoice_data", {}).get("statut_paiement", ""),
-                    "numero_client": data.get("invoice_data", {}).get("numero_client", ""),
-                    "client_name": data.get("invoice_data", {}).get("client_name", ""),
-                    "date_facture": data.get("invoice_data", {}).get("date_facture", ""),
-                    "date_commande": data.get("invoice_data", {}).get("date_commande", ""),
-                    "numero_facture": data.get("invoice_data", {}).get("numero_facture", "")
-                }
-            }
+            invoices_data[filename] = invoice
+            texts[filename] = text
         except Exception as e:
+            # Le fichier est écarté, le lot continue
             logger.error(f"Error processing {pdf_path}: {str(e)}")
             logger.error(traceback.format_exc())
-            raise Exception(f"Error processing {pdf_path}: {str(e)}")
+            entry.update(status='error', stage=stage, error=str(e))
+
+    if extractor.cache is not None:
+        # Résultats du lot écrits en une transaction
+        extractor.cache.flush()
+        logger.info(f"Parse cache: {extractor.cache.stats()}")
 
     try:
+        if deduplicator.duplicates:
+            duplicates = [d.to_dict() for d in deduplicator.duplicates]
+            duplicates_path = workspace.file("duplicates.json")
+            if previous is not None and duplicates_path.exists():
+                with open(duplicates_path, 'r', encoding='utf-8') as f:
+                    duplicates = json.load(f) + duplicates
+            with open(duplicates_path, 'w', encoding='utf-8') as f:
+                json.dump(duplicates, f, ensure_ascii=False)
+
         # Sauvegarder les données JSON
         logger.info("Saving JSON data...")
-        json_path = TEMP_DIR / "factures.json"
-        with open(json_path, 'w', encoding='utf-8') as f:
-            json.dump(invoices_data, f, ensure_ascii=False, indent=2)
+        json_path = workspace.file("factures.json")
+        with profiler.stage("save_json"), open(json_path, 'w', encoding='utf-8') as f:
+            dump_invoices(invoices_data, f)
 
         logger.info(f"JSON data saved to {json_path}")
 
         # Générer le fichier Excel
         logger.info("Generating Excel file...")
-        excel_path = TEMP_DIR / generate_excel_filename()
-
-        # Créer le DataFrame
-        df = create_invoice_dataframe(invoices_data)
+        excel_filename = generate_excel_filename(workspace.job_id)
+
+        # Créer le DataFrame ; les factures non convertibles rejoignent la feuille 'Erreurs'
+        row_errors = []
+        with profiler.stage("dataframe"):
+            df = create_invoice_dataframe(invoices_data, errors=row_errors)
+        for error in row_errors:
+            for entry in manifest:
+                if entry['file'] == error['file']:
+                    entry.update(status='error', stage=error['stage'], error=error['error'])
+                    error['name'] = entry['name']
 
         # Log the quantité column to verify it's correct
         if 'quantité' in df.columns:
             logger.info(f"Quantité values in DataFrame: {df['quantité'].tolist()}")
 
-        # Sauvegarder avec le formatage
-        with pd.ExcelWriter(excel_path, engine='xlsxwriter') as writer:
-            df.to_excel(writer, sheet_name='Factures', index=False)
-            format_excel(writer, df)
-
-        return excel_path
+        failed = [entry for entry in manifest if entry['status'] in ('error', 'missing')]
+        with open(workspace.file(MANIFEST_FILE), 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False)
+        if failed:
+            logger.warning(f"{len(failed)} of {len(manifest)} file(s) failed in batch {workspace.job_id}")
+
+        # Construire le classeur formaté en mémoire (déversé sur disque s'il est très gros)
+        with profiler.stage("workbook"):
+            workbook = build_workbook(df, errors=failed)
+
+        # Seules les factures livrées dans le classeur rejoignent les index ; celles d'un
+        # traitement précédent (reprise) y sont déjà
+        row_error_files = {error['file'] for error in row_errors}
+        delivered = [filename for filename in invoices_data if filename not in row_error_files]
+        new_invoices = {filename: invoices_data[filename] for filename in delivered
+                        if filename not in (previous or {})}
+        _commit_secondary_stores(workspace, new_invoices, texts, manifest, profiler)
+        try:
+            deduplicator.commit(delivered)
+        except Exception as e:
+            logger.error(f"Duplicate index update failed: {str(e)}")
+
+        # Lot publié pour les autres réplicas (manifeste, reprise, classeur)
+        store = get_artifact_store()
+        if store is not None:
+            try:
+                with profiler.stage("publish"):
+                    publish_batch(store, workspace, manifest, workbook, excel_filename)
+            except Exception as e:
+                logger.error(f"Batch publication failed: {str(e)}")
+        return BatchResult(excel_filename, workbook, deduplicator.duplicates, manifest)
     except Exception as e:
         logger.error(f"Error in final processing: {str(e)}")
         logger.error(traceback.format_exc())
         raise
 
+def retry_failed(workspace: Workspace, profiler=NULL_PROFILER, ticket=NULL_TICKET) -> BatchResult:
+    """
+    Retraite uniquement les fichiers en échec d'un lot ; les factures déjà extraites sont reprises
+    telles quelles de factures.json
+    """
+    with open(workspace.file(MANIFEST_FILE), 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+    previous = {}
+    json_path = workspace.file("factures.json")
+    if json_path.exists():
+        with open(json_path, 'r', encoding='utf-8') as f:
+            previous = load_invoices(f)
+
+    retried = [entry for entry in manifest
+               if entry['status'] == 'error' and workspace.file(entry['file']).exists()]
+    retried_files = {entry['file'] for entry in retried}
+    kept_manifest = [entry for entry in manifest if entry['file'] not in retried_files]
+    # Fichiers convertis en facture mais pas en ligne Excel : réanalysés eux aussi
+    for filename in retried_files:
+        previous.pop(filename, None)
+
+    return process_pdfs(
+        [workspace.file(entry['file']) for entry in retried], workspace=workspace, profiler=profiler,
+        original_names={entry['file']: entry['name'] for entry in retried},
+        previous=previous, previous_manifest=kept_manifest, ticket=ticket
+    )
+
+XLSX_MEDIA_TYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+def workbook_response(workbook, excel_filename: str) -> StreamingResponse:
+    """Diffuse le classeur directement depuis son tampon, fermé une fois l'envoi terminé"""
+    workbook.seek(0, os.SEEK_END)
+    size = workbook.tell()
+    workbook.seek(0)
+
+    headers = {
+        'Content-Disposition': f'attachment; filename="{excel_filename}"',
+        'Content-Length': str(size)
+    }
+    return StreamingResponse(
+        iter(lambda: workbook.read(64 * 1024), b''),
+        media_type=XLSX_MEDIA_TYPE,
+        headers=headers,
+        background=BackgroundTask(workbook.close)
+    )
+
+def _remove_processed_pdfs(pdf_paths, result: BatchResult = None):
+    """Supprime les PDF reçus, sauf ceux en échec, conservés pour une reprise"""
+    failed = {entry['file'] for entry in result.failed} if result is not None else set()
+    for pdf_path in pdf_paths:
+        if pdf_path.name in failed:
+            continue
+        try:
+            pdf_path.unlink(missing_ok=True)
+        except Exception as e:
+            logger.error(f"Error cleaning up files: {str(e)}")
+
+def batch_response(result: BatchResult, job_id: str, profiler=NULL_PROFILER) -> StreamingResponse:
+    """Classeur du lot, avec identifiant, compteurs et lien vers le manifeste en en-têtes"""
+    response = workbook_response(result.workbook, result.excel_filename)
+    response.headers['X-Job-Id'] = job_id
+    response.headers['X-Duplicate-Count'] = str(len(result.duplicates))
+    response.headers['X-File-Count'] = str(len(result.manifest))
+    response.headers['X-Failed-Count'] = str(len(result.failed))
+    response.headers['X-Manifest-Url'] = f"/batches/{job_id}/manifest"
+    if profiler.enabled:
+        response.headers['X-Profile-Id'] = profiler.label
+    return response
+
+def save_profile(profiler, error: Exception = None):
+    """Enregistre le profil de la requête, qu'elle ait réussi ou échoué"""
+    if not profiler.enabled:
+        return
+    try:
+        profiler.save(error=error)
+    except Exception as e:
+        logger.error(f"Cannot save profile {profiler.label}: {str(e)}")
+        profiler.close()
+
+def admit(request: Request, documents: int):
+    """
+    Réservation des documents d'une requête dans la file de sa classe (interactive ou bulk),
+    sinon 429 avec Retry-After
+    Le middleware a déjà réservé le nombre annoncé avant la lecture du corps : la réservation
+    est ajustée au nombre réel de documents
+    """
+    ticket = getattr(request.state, 'admission_ticket', None)
+    try:
+        if ticket is None:
+            return get_admission().admit(documents, classify(request.headers, documents))
+        ticket.resize(documents)
+        return ticket
+    except Overloaded as e:
+        raise HTTPException(status_code=429, detail=str(e),
+                            headers={"Retry-After": str(e.retry_after)})
+
 @app.post("/analyze_pdfs/")
-async def analyze_pdfs(files: List[UploadFile] = File(...)):
+async def analyze_pdfs(request: Request, files: List[UploadFile] = File(...)):
+    ticket = admit(request, len(files))
+    profiler = NULL_PROFILER
+    error = None
     try:
+        # Espace de travail isolé pour cette requête
+        workspace = Workspace.create(WORKSPACES_DIR)
+
+        # Profilage sur demande (en-têtes X-Profile / X-Profile-Memory ou variables d'environnement)
+        profiler = request_profiler(workspace.job_id, request.headers)
+
         # Create a list to store processed PDF paths
         pdf_paths = []
+        original_names = {}
 
         # Process each uploaded file
         for file in files:
@@ -147,68 +531,352 @@ async def analyze_pdfs(files: List[UploadFile] = File(...)):
 
             # Create unique name for the file
             pdf_name = f"input_{os.urandom(8).hex()}.pdf"
-            pdf_path = TEMP_DIR / pdf_name
+            pdf_path = workspace.file(pdf_name)
             pdf_paths.append(pdf_path)
+            original_names[pdf_name] = file.filename
 
             # Save the uploaded PDF
             with pdf_path.open("wb") as buffer:
                 shutil.copyfileobj(file.file, buffer)
 
+        result = None
         try:
-            # Process all PDFs (maintenant appel direct à la fonction locale)
-            excel_path = process_pdfs(pdf_paths)
-
-            if not excel_path.exists():
-                raise HTTPException(status_code=500, detail="Excel file was not created")
-
-            # Generate filename with correct format
-            excel_filename = generate_excel_filename()
-
-            # Return Excel file
-            headers = {
-                'Content-Disposition': f'attachment; filename="{excel_filename}"'
-            }
-
-            return FileResponse(
-                path=excel_path,
-                filename=excel_filename,
-                media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                background=None,  # Prevent automatic deletion
-                headers=headers
+            # Traitement hors de la boucle d'événements, sur les threads réservés aux traitements
+            # Le nom est généré une seule fois, dans process_pdfs
+            result = await get_admission().run(
+                process_pdfs, pdf_paths, workspace=workspace, profiler=profiler,
+                original_names=original_names, ticket=ticket
             )
 
+            # Return Excel file (fichiers en échec : feuille 'Erreurs' et manifeste)
+            return batch_response(result, workspace.job_id, profiler)
+
         except Exception as e:
             logger.error(f"Error processing PDFs: {str(e)}")
             raise HTTPException(status_code=500, detail=f"Error processing PDFs: {str(e)}")
 
         finally:
-            # Clean up temporary files
-            for pdf_path in pdf_paths:
-                try:
-                    if pdf_path.exists():
-                        pdf_path.unlink()
-                except Exception as e:
-                    logger.error(f"Error cleaning up files: {str(e)}")
+            # Clean up temporary files (les PDF en échec restent pour POST /batches/{job_id}/retry)
+            _remove_processed_pdfs(pdf_paths, result)
 
     except Exception as e:
+        error = e
         logger.error(f"Unexpected error: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        # Profil enregistré aussi pour une requête en échec
+        save_profile(profiler, error)
+        ticket.close()
+
+def _prefetch_upload(pdf_path: str):
+    """Extraction d'un fichier complet pendant l'envoi des suivants, dans un créneau 'bulk'"""
+    with get_admission().background_document():
+        return extract_invoice_tiered(pdf_path, InvoiceExtractor(cache=get_parse_cache()))
+
+# Extractions lancées pendant le téléversement par morceaux
+upload_queue = ExtractionQueue(_prefetch_upload)
+
+def _get_upload(upload_id: str) -> UploadSession:
+    session = UploadSession.open(WORKSPACES_DIR, upload_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Upload session not found or expired")
+    return session
+
+@app.post("/uploads")
+async def create_upload():
+    """Ouvre une session de téléversement reprenable"""
+    session = await run_in_threadpool(UploadSession.create, WORKSPACES_DIR)
+    return {"upload_id": session.upload_id, "max_chunk_size": UPLOAD_CHUNK_SIZE}
+
+@app.post("/uploads/{upload_id}/files")
+async def declare_upload_file(upload_id: str, request: Request):
+    """Déclare un fichier : {"filename": ..., "size": ..., "chunk_size": (optionnel)}"""
+    session = _get_upload(upload_id)
+    try:
+        payload = await request.json()
+        meta = await run_in_threadpool(
+            session.add_file, payload["filename"], int(payload["size"]), payload.get("chunk_size")
+        )
+    except (KeyError, TypeError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid file declaration: {str(e)}")
+    return {key: meta[key] for key in ("file_id", "filename", "size", "chunk_size", "total_chunks")}
+
+@app.put("/uploads/{upload_id}/files/{file_id}/chunks/{index}")
+async def upload_chunk(upload_id: str, file_id: str, index: int, request: Request):
+    """Reçoit un morceau (corps brut) ; renvoyer un morceau déjà reçu est sans effet"""
+    session = _get_upload(upload_id)
+    declared = request.headers.get("content-length")
+    if declared and declared.isdigit() and int(declared) > UPLOAD_CHUNK_SIZE:
+        raise HTTPException(status_code=413, detail=f"Chunks are limited to {UPLOAD_CHUNK_SIZE} bytes")
+
+    data = bytearray()
+    async for part in request.stream():
+        data.extend(part)
+        if len(data) > UPLOAD_CHUNK_SIZE:
+            raise HTTPException(status_code=413, detail=f"Chunks are limited to {UPLOAD_CHUNK_SIZE} bytes")
 
-# Nettoyage périodique des fichiers temporaires (optionnel)
+    try:
+        ack = await run_in_threadpool(session.write_chunk, file_id, index, bytes(data))
+    except KeyError:
+        raise HTTPException(status_code=404, detail="File not declared in this upload")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    # Fichier complet : extraction lancée sans attendre la finalisation
+    if ack["completed"]:
+        upload_queue.submit(session.pdf_path(file_id))
+    return ack
+
+@app.get("/uploads/{upload_id}")
+async def upload_status(upload_id: str):
+    """État de la session : morceaux manquants de chaque fichier, pour reprendre après une coupure"""
+    session = _get_upload(upload_id)
+    return await run_in_threadpool(session.status)
+
+@app.post("/uploads/{upload_id}/finalize")
+async def finalize_upload(upload_id: str, request: Request):
+    """Termine la session : attend les extractions en cours et renvoie le classeur Excel"""
+    session = _get_upload(upload_id)
+    status = await run_in_threadpool(session.status)
+    if not status["complete"]:
+        incomplete = [entry for entry in status["files"] if not entry["complete"]]
+        return JSONResponse(status_code=409, content={
+            "detail": "Upload incomplete",
+            "files": incomplete,
+        })
+
+    metas = session.files()
+    ticket = admit(request, len(metas))
+    profiler = request_profiler(session.upload_id, request.headers)
+    pdf_paths = [session.pdf_path(meta['file_id']) for meta in metas]
+    original_names = {session.pdf_path(meta['file_id']).name: meta['filename'] for meta in metas}
+    # Extractions lancées par ce worker ; les autres fichiers sont extraits ici
+    prefetched = upload_queue.take(pdf_paths)
+    result = None
+    error = None
+    try:
+        result = await get_admission().run(
+            process_pdfs, pdf_paths, workspace=session.workspace, profiler=profiler,
+            prefetched=prefetched, original_names=original_names, ticket=ticket
+        )
+    except Exception as e:
+        error = e
+        logger.error(f"Error processing upload {upload_id}: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error processing PDFs: {str(e)}")
+    finally:
+        _remove_processed_pdfs(pdf_paths, result)
+        session.workspace.file(SESSION_MARKER).unlink(missing_ok=True)
+        save_profile(profiler, error)
+        ticket.close()
+
+    return batch_response(result, session.upload_id, profiler)
+
+async def open_batch(job_id: str):
+    """
+    Espace de travail d'un lot ; avec un stockage partagé, le manifeste publié fait foi
+    (lot traité ou repris par un autre réplica)
+    """
+    store = get_artifact_store()
+    if store is None:
+        return Workspace.open(WORKSPACES_DIR, job_id)
+    try:
+        return await run_in_threadpool(restore_batch, store, WORKSPACES_DIR, job_id)
+    except Exception as e:
+        logger.warning(f"Batch {job_id}: artifact store unavailable, local copy used ({str(e)})")
+        return Workspace.open(WORKSPACES_DIR, job_id)
+
+@app.get("/batches/{job_id}/manifest")
+async def batch_manifest(job_id: str):
+    """Statut de chaque fichier d'un lot (ok, duplicate, error, missing)"""
+    workspace = await open_batch(job_id)
+    if workspace is None or not workspace.file(MANIFEST_FILE).exists():
+        raise HTTPException(status_code=404, detail="Batch not found or expired")
+    with open(workspace.file(MANIFEST_FILE), 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+    return {"job_id": job_id, "files": manifest,
+            "failed": sum(1 for entry in manifest if entry['status'] in ('error', 'missing'))}
+
+@app.get("/batches/{job_id}/workbook")
+async def batch_workbook(job_id: str):
+    """Classeur d'un lot publié dans le stockage partagé, quel que soit le réplica qui l'a produit"""
+    store = get_artifact_store()
+    if store is None or not job_id or '/' in job_id or job_id.startswith('.'):
+        raise HTTPException(status_code=404, detail="Batch not found")
+    data = await run_in_threadpool(store.get, batch_key(job_id, "workbook.xlsx"))
+    if data is None:
+        raise HTTPException(status_code=404, detail="Batch not found")
+    meta = await run_in_threadpool(get_json, store, batch_key(job_id, "workbook.json")) or {}
+    return workbook_response(io.BytesIO(data), meta.get('filename', f"{job_id}.xlsx"))
+
+@app.post("/batches/{job_id}/retry")
+async def retry_batch(job_id: str, request: Request):
+    """Retraite les fichiers en échec d'un lot et renvoie le classeur complet mis à jour"""
+    workspace = await open_batch(job_id)
+    if workspace is None or not workspace.file(MANIFEST_FILE).exists():
+        raise HTTPException(status_code=404, detail="Batch not found or expired")
+    workspace.touch()
+
+    with open(workspace.file(MANIFEST_FILE), 'r', encoding='utf-8') as f:
+        failed = sum(1 for entry in json.load(f) if entry['status'] == 'error')
+    ticket = admit(request, failed)
+    profiler = request_profiler(f"{job_id}-retry-{uuid.uuid4().hex[:6]}", request.headers)
+    result = None
+    error = None
+    try:
+        result = await get_admission().run(retry_failed, workspace, profiler, ticket)
+    except Exception as e:
+        error = e
+        logger.error(f"Error retrying batch {job_id}: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error processing PDFs: {str(e)}")
+    finally:
+        if result is not None:
+            retried = [workspace.file(entry['file']) for entry in result.manifest]
+            _remove_processed_pdfs(retried, result)
+        save_profile(profiler, error)
+        ticket.close()
+
+    return batch_response(result, job_id, profiler)
+
+# Nettoyage périodique des espaces de travail expirés
 @app.on_event("startup")
 async def startup_event():
     try:
-        for file in TEMP_DIR.glob("*"):
-            file.unlink()
+        removed = cleanup_expired(WORKSPACES_DIR)
+        logger.info(f"Removed {removed} expired workspace(s) at startup")
     except Exception as e:
         logger.error(f"Erreur lors du nettoyage initial: {str(e)}")
 
+    app.state.janitor = asyncio.create_task(janitor(WORKSPACES_DIR))
+
+    if not local_stores_enabled():
+        logger.warning("Shared artifact store: cross-batch dedup, search, aggregates and ledger "
+                       "are disabled (per-replica SQLite; REPLICA_LOCAL_STORES=true for a single replica)")
+
+    # Déjà préchauffé si le processus a été forké par serve.py
+    if WARMUP_ON_STARTUP and not _warm_event.is_set():
+        threading.Thread(target=_warmup_in_background, name="warmup", daemon=True).start()
+
+@app.get("/ready")
+async def ready():
+    """Sonde de disponibilité : 200 une fois la chaîne d'extraction préchauffée"""
+    if _warm_event.is_set():
+        return {"status": "ready"}
+    return JSONResponse(status_code=503, content={"status": "warming"})
+
+@app.get("/batches/{job_id}/duplicates")
+async def batch_duplicates(job_id: str):
+    """Doublons écartés ou marqués lors d'un lot"""
+    workspace = Workspace.open(WORKSPACES_DIR, job_id)
+    if workspace is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired batch")
+    duplicates_path = workspace.file("duplicates.json")
+    if not duplicates_path.exists():
+        return {"job_id": job_id, "duplicates": []}
+    with open(duplicates_path, 'r', encoding='utf-8') as f:
+        return {"job_id": job_id, "duplicates": json.load(f)}
+
+@app.get("/search")
+async def search(q: str = None, numero_facture: str = None, client: str = None,
+                 numero_client: str = None, reseau_vente: str = None, date_from: str = None,
+                 date_to: str = None, total_ttc: float = None, min_ttc: float = None,
+                 max_ttc: float = None, limit: int = 50, offset: int = 0):
+    """
+    Recherche dans les factures traitées : plein texte (q) et filtres
+    (dates au format YYYY-MM-DD, client par préfixe, total_ttc exact au centime)
+    """
+    search_index = _require_local_store(get_search_index, "Search index disabled")
+    started = time.perf_counter()
+    try:
+        results = await run_in_threadpool(
+            search_index.search, q=q, numero_facture=numero_facture, client=client,
+            numero_client=numero_client, reseau_vente=reseau_vente, date_from=date_from,
+            date_to=date_to, total_ttc=total_ttc, min_ttc=min_ttc, max_ttc=max_ttc,
+            limit=limit, offset=offset
+        )
+    except sqlite3.OperationalError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid search: {str(e)}")
+    return {
+        "results": results,
+        "count": len(results),
+        "elapsed_ms": round((time.perf_counter() - started) * 1000, 2),
+    }
+
+@app.get("/reports/monthly")
+async def monthly_report(month_from: str = None, month_to: str = None, syst: str = None,
+                         reseau_vente: str = None, type_vente: str = None):
+    """Totaux HT, TVA, TTC, remises, quantités et nombre de factures par mois x réseau x type"""
+    aggregates = _require_local_store(get_aggregates, "Monthly aggregates disabled")
+    return await run_in_threadpool(
+        aggregates.summary, month_from=month_from, month_to=month_to, syst=syst,
+        reseau_vente=reseau_vente, type_vente=type_vente
+    )
+
+def _get_monthly_ledger():
+    return _require_local_store(get_monthly_ledger, "Monthly ledger disabled")
+
+@app.get("/ledger")
+async def ledger_months():
+    """Mois du grand livre et nombre de lignes de chacun"""
+    monthly_ledger = _get_monthly_ledger()
+    return {"months": await run_in_threadpool(monthly_ledger.months)}
+
+@app.get("/ledger/{month}")
+async def ledger_workbook(month: str):
+    """Classeur du mois (YYYY-MM), régénéré seulement s'il a changé"""
+    monthly_ledger = _get_monthly_ledger()
+    try:
+        datetime.strptime(month, '%Y-%m')
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Month must be YYYY-MM")
+    path = await run_in_threadpool(monthly_ledger.materialize, month)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Month not found in ledger")
+    return FileResponse(path, media_type=XLSX_MEDIA_TYPE, filename=path.name)
+
+@app.get("/debug/profiles")
+async def debug_profiles():
+    """Liste des profils de requêtes conservés (les plus récents d'abord)"""
+    return {"profiles": list_profiles()}
+
+@app.get("/debug/profiles/{profile_id}")
+async def debug_profile(profile_id: str, format: str = "json"):
+    """Télécharge un profil : résumé par étape (json) ou statistiques pstats (prof)"""
+    path = profile_path(profile_id, format)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    media_type = "application/json" if format == "json" else "application/octet-stream"
+    return FileResponse(path, media_type=media_type, filename=path.name)
+
+@app.get("/debug/memory")
+async def debug_memory(limit: int = 10):
+    """État de tracemalloc et mesures mémoire des dernières requêtes (X-Profile-Memory: 1)"""
+    measured = [
+        {'id': profile['id'], 'created': profile['created'], **profile['memory']}
+        for profile in list_profiles() if profile.get('memory')
+    ]
+    return {"process": memory_status(), "profiles": measured[:max(0, limit)]}
+
+@app.get("/debug/admission")
+async def debug_admission():
+    """Documents en cours et en attente, requêtes admises et refusées, latences par classe"""
+    return get_admission().stats()
+
+@app.get("/debug/font_cache")
+async def debug_font_cache():
+    """Compteurs du cache de polices du worker ayant servi la requête"""
+    from font_cache import font_cache_stats
+    return font_cache_stats()
+
 @app.get("/debug/json")
-async def debug_json():
-    """Endpoint to check the JSON data"""
+async def debug_json(job_id: str = None):
+    """Endpoint to check the JSON data (latest batch unless job_id is given)"""
     try:
-        json_path = TEMP_DIR / "factures.json"
-        if not json_path.exists():
+        if job_id:
+            workspace = Workspace.open(WORKSPACES_DIR, job_id)
+        else:
+            workspace = latest_workspace(WORKSPACES_DIR, "factures.json")
+        json_path = workspace.file("factures.json") if workspace else None
+        if json_path is None or not json_path.exists():
             return {"error": "No JSON data found"}
 
         with open(json_path, 'r', encoding='utf-8') as f:
@@ -225,9 +893,11 @@ async def debug_json():
                 "nombre_articles": invoice.get('data', {}).get('nombre_articles', 0)
             }
 
-        return {"summary": summary}
+        return {"job_id": workspace.job_id, "summary": summary}
     except Exception as e:
         return {"error": str(e)}
 
 if __name__ == "__main__":
+    import uvicorn
+
     uvicorn.run(app, host="0.0.0.0", port=8000)
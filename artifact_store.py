@@ -0,0 +1,272 @@
+"""
+Stockage d'artefacts partagé entre réplicas
+
+ARTIFACT_STORE_URL choisit le backend (vide : désactivé, tout reste dans temp_files local) :
+    /srv/artefacts ou file:///srv/artefacts   répertoire local (volume partagé)
+    gs://bucket/prefixe                       Google Cloud Storage
+Avec STORAGE_EMULATOR_HOST (ex. http://localhost:4443 pour fake-gcs-server), le backend GCS
+parle à l'émulateur sans identifiants et crée le bucket s'il n'existe pas.
+
+Clés :
+    texts/<sha256 du PDF>.json                 texte extrait et étage retenu (adressé par contenu)
+    parses/<empreinte>/<sha256 du texte>.json  résultat d'analyse (adressé par contenu)
+    batches/<job_id>/...                       manifeste, factures.json, classeur, PDF en échec
+Un artefact adressé par contenu n'est jamais réécrit : deux réplicas peuvent le publier en même temps.
+"""
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+from pathlib import Path
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Backend partagé (vide : désactivé)
+ARTIFACT_STORE_URL = os.getenv("ARTIFACT_STORE_URL", "")
+# Projet GCS (facultatif ; utilisé avec l'émulateur)
+GCS_PROJECT = os.getenv("GCS_PROJECT", "")
+
+BATCH_FILES = ("manifest.json", "factures.json", "duplicates.json")
+# Empreinte du manifeste lors du dernier échange avec le stockage (publication ou rapatriement)
+SYNC_MARKER = ".manifest_sync"
+
+def _check_key(key: str) -> str:
+    parts = key.split('/')
+    if not key or any(part in ('', '.', '..') for part in parts):
+        raise ValueError(f"Invalid artifact key: {key!r}")
+    return key
+
+class LocalStore:
+    """Artefacts dans un répertoire (local ou volume partagé), écrits atomiquement"""
+
+    def __init__(self, root):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def __repr__(self):
+        return f"LocalStore({str(self.root)!r})"
+
+    def _path(self, key: str) -> Path:
+        return self.root / _check_key(key)
+
+    def get(self, key: str) -> Optional[bytes]:
+        try:
+            return self._path(key).read_bytes()
+        except FileNotFoundError:
+            return None
+
+    def put(self, key: str, data: bytes, overwrite: bool = True):
+        path = self._path(key)
+        if not overwrite and path.exists():
+            return
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, path)
+
+    def exists(self, key: str) -> bool:
+        return self._path(key).exists()
+
+    def put_file(self, key: str, source, overwrite: bool = True):
+        path = self._path(key)
+        if not overwrite and path.exists():
+            return
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        shutil.copyfile(source, tmp_path)
+        os.replace(tmp_path, path)
+
+    def get_file(self, key: str, destination) -> bool:
+        path = self._path(key)
+        if not path.exists():
+            return False
+        shutil.copyfile(path, destination)
+        return True
+
+    def list(self, prefix: str) -> List[str]:
+        base = self.root / prefix
+        if not base.is_dir():
+            return []
+        return sorted(str(path.relative_to(self.root)) for path in base.rglob('*')
+                      if path.is_file() and not path.name.startswith('.'))
+
+class GCSStore:
+    """Artefacts dans un bucket Google Cloud Storage (ou son émulateur)"""
+
+    def __init__(self, bucket: str, prefix: str = ""):
+        from google.cloud import storage
+
+        self.prefix = prefix.strip('/')
+        if os.getenv("STORAGE_EMULATOR_HOST"):
+            from google.auth.credentials import AnonymousCredentials
+
+            client = storage.Client(project=GCS_PROJECT or "local",
+                                    credentials=AnonymousCredentials())
+            self.bucket = client.lookup_bucket(bucket) or client.create_bucket(bucket)
+        else:
+            client = storage.Client(project=GCS_PROJECT or None)
+            self.bucket = client.bucket(bucket)
+        self.bucket_name = bucket
+
+    def __repr__(self):
+        return f"GCSStore('gs://{self.bucket_name}/{self.prefix}')"
+
+    def _blob(self, key: str):
+        name = f"{self.prefix}/{_check_key(key)}" if self.prefix else _check_key(key)
+        return self.bucket.blob(name)
+
+    def get(self, key: str) -> Optional[bytes]:
+        from google.api_core.exceptions import NotFound
+
+        try:
+            return self._blob(key).download_as_bytes()
+        except NotFound:
+            return None
+
+    def put(self, key: str, data: bytes, overwrite: bool = True):
+        from google.api_core.exceptions import PreconditionFailed
+
+        try:
+            # if_generation_match=0 : création seulement, sans lecture préalable
+            self._blob(key).upload_from_string(data, if_generation_match=None if overwrite else 0)
+        except PreconditionFailed:
+            pass
+
+    def exists(self, key: str) -> bool:
+        return self._blob(key).exists()
+
+    def put_file(self, key: str, source, overwrite: bool = True):
+        from google.api_core.exceptions import PreconditionFailed
+
+        try:
+            self._blob(key).upload_from_filename(str(source),
+                                                 if_generation_match=None if overwrite else 0)
+        except PreconditionFailed:
+            pass
+
+    def get_file(self, key: str, destination) -> bool:
+        from google.api_core.exceptions import NotFound
+
+        try:
+            self._blob(key).download_to_filename(str(destination))
+            return True
+        except NotFound:
+            Path(destination).unlink(missing_ok=True)
+            return False
+
+    def list(self, prefix: str) -> List[str]:
+        full_prefix = f"{self.prefix}/{prefix}" if self.prefix else prefix
+        start = len(self.prefix) + 1 if self.prefix else 0
+        return sorted(blob.name[start:] for blob in self.bucket.list_blobs(prefix=full_prefix))
+
+def open_store(url: str):
+    """Backend correspondant à une URL (file://, gs:// ou chemin)"""
+    if url.startswith("gs://"):
+        bucket, _, prefix = url[len("gs://"):].partition('/')
+        return GCSStore(bucket, prefix)
+    if url.startswith("file://"):
+        url = url[len("file://"):]
+    return LocalStore(url)
+
+_artifact_store = None
+_artifact_store_lock = threading.Lock()
+
+def get_artifact_store():
+    """Stockage partagé du processus (None si ARTIFACT_STORE_URL est vide)"""
+    global _artifact_store
+    if not ARTIFACT_STORE_URL:
+        return None
+    if _artifact_store is None:
+        with _artifact_store_lock:
+            if _artifact_store is None:
+                _artifact_store = open_store(ARTIFACT_STORE_URL)
+                logger.info(f"Artifact store: {_artifact_store!r}")
+    return _artifact_store
+
+def get_json(store, key: str) -> Optional[Dict]:
+    data = store.get(key)
+    return json.loads(data) if data is not None else None
+
+def put_json(store, key: str, value, overwrite: bool = True):
+    store.put(key, json.dumps(value, ensure_ascii=False).encode('utf-8'), overwrite=overwrite)
+
+def text_key(pdf_digest: str) -> str:
+    return f"texts/{pdf_digest}.json"
+
+def parse_key(fingerprint: str, digest: str) -> str:
+    return f"parses/{fingerprint}/{digest}.json"
+
+def batch_key(job_id: str, name: str) -> str:
+    return f"batches/{job_id}/{name}"
+
+def publish_batch(store, workspace, manifest: List[Dict], workbook=None, excel_filename: str = None):
+    """
+    Publie un lot : fichiers JSON, PDF en échec (pour une reprise sur un autre réplica) et classeur
+    workbook : tampon du classeur, repositionné au début après copie
+    """
+    for name in BATCH_FILES:
+        path = workspace.file(name)
+        if path.exists():
+            store.put_file(batch_key(workspace.job_id, name), path)
+    for entry in manifest:
+        path = workspace.file(entry['file'])
+        if entry['status'] == 'error' and path.exists():
+            store.put_file(batch_key(workspace.job_id, f"pdfs/{entry['file']}"), path, overwrite=False)
+    if workbook is not None and excel_filename:
+        workbook.seek(0)
+        store.put(batch_key(workspace.job_id, "workbook.xlsx"), workbook.read())
+        workbook.seek(0)
+        put_json(store, batch_key(workspace.job_id, "workbook.json"), {'filename': excel_filename})
+    manifest_path = workspace.file("manifest.json")
+    if manifest_path.exists():
+        workspace.file(SYNC_MARKER).write_text(_digest(manifest_path.read_bytes()))
+
+def _digest(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+def restore_batch(store, root: Path, job_id: str):
+    """
+    Espace de travail local d'un lot, aligné sur la version publiée dans le stockage
+    Le lot est rapatrié s'il est absent localement, ou si le manifeste publié a changé depuis le
+    dernier échange (lot repris par un autre réplica). Une copie locale plus récente que la
+    dernière publication de ce réplica est conservée.
+    Renvoie le Workspace, ou None si le lot n'est connu ni du stockage ni localement
+    """
+    from workspace import Workspace
+
+    if not job_id or '/' in job_id or job_id.startswith('.'):
+        return None
+    data = store.get(batch_key(job_id, "manifest.json"))
+    if data is None:
+        return Workspace.open(root, job_id)
+    workspace = Workspace.open(root, job_id)
+    if workspace is None:
+        try:
+            workspace = Workspace.create(root, job_id)
+        except FileExistsError:
+            workspace = Workspace.open(root, job_id)
+
+    digest = _digest(data)
+    marker = workspace.file(SYNC_MARKER)
+    if marker.exists() and marker.read_text() == digest:
+        return workspace
+    manifest_path = workspace.file("manifest.json")
+    if not manifest_path.exists() or manifest_path.read_bytes() != data:
+        for name in BATCH_FILES:
+            if name != "manifest.json" and not store.get_file(batch_key(job_id, name),
+                                                              workspace.file(name)):
+                workspace.file(name).unlink(missing_ok=True)
+        for entry in json.loads(data):
+            path = workspace.file(entry['file'])
+            if entry['status'] == 'error' and not path.exists():
+                store.get_file(batch_key(job_id, f"pdfs/{entry['file']}"), path)
+        # Manifeste écrit en dernier : il n'annonce que des fichiers déjà rapatriés
+        tmp_path = manifest_path.with_name(f".{manifest_path.name}.tmp")
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, manifest_path)
+        logger.info(f"Batch {job_id} restored from {store!r}")
+    marker.write_text(digest)
+    return workspace
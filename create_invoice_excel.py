@@ -1,10 +1,18 @@
-import pandas as pd
 from datetime import datetime
 import json
-import re
-import pytz  # Pour gérer les fuseaux horaires
+import logging
+import os
+import tempfile
 from pathlib import Path
-from openpyxl import Workbook
+from typing import Dict, List, Optional
+from records import Invoice, as_invoice
+
+logger = logging.getLogger(__name__)
+
+# pandas et pytz sont importés à la demande pour ne pas ralentir le démarrage de l'API
+
+# Au-delà de cette taille, le classeur généré est déversé sur disque au lieu de rester en mémoire
+EXCEL_SPOOL_MAX_BYTES = int(os.getenv("EXCEL_SPOOL_MAX_BYTES", str(32 * 1024 * 1024)))
 
 def load_invoice_data():
     """Charge les données des factures depuis le fichier JSON"""
@@ -12,10 +20,10 @@ def load_invoice_data():
         with open('factures.json', 'r', encoding='utf-8') as f:
             return json.load(f)
     except FileNotFoundError:
-        print("Erreur: Le fichier factures.json n'a pas été trouvé")
+        logger.error("factures.json not found")
         return {}
     except json.JSONDecodeError:
-        print("Erreur: Le fichier factures.json n'est pas un JSON valide")
+        logger.error("factures.json is not valid JSON")
         return {}
 
 def format_date(date_str: str) -> str:
@@ -28,8 +36,8 @@ def format_date(date_str: str) -> str:
     except ValueError:
         return date_str
 
-def create_invoice_dataframe(invoices_data):
-    """Crée un DataFrame à partir des données des factures"""
+def _build_headers():
+    """Construit la liste des colonnes du fichier Excel"""
     # Définir les headers dans le même ordre exact que create_excel_from_data
     headers = [
         'Type-facture', 'n°ordre', 'saisie', 'Syst', 'N° Syst.', 'comptable', 'Type_facture',
@@ -44,159 +52,122 @@ def create_invoice_dataframe(invoices_data):
     for i in range(1, 21):
         headers.extend([f'supfam{i}', f'fam{i}', f'ref{i}', f'q{i}', f'prix{i}',
                       f'r€{i}', f'ht{i}', f'tva€{i}'])
+    return headers
+
+HEADERS = _build_headers()
+
+def invoice_to_row(invoice: Invoice) -> dict:
+    """Construit la ligne Excel d'une facture"""
+    row = dict.fromkeys(HEADERS, '')  # Initialiser toutes les colonnes avec des valeurs vides
+    totals = invoice.totals
+
+    # Calculer le taux de TVA et le total HT avec remise
+    total_ht = totals.total_ht
+    remise_globale = totals.remise
+    # Appliquer la remise si elle existe
+    if remise_globale:
+        total_ht = total_ht - float(remise_globale)
+    total_ttc = totals.total_ttc
+
+    # Formater le taux de TVA au format XX,XX%
+    if invoice.type == 'meg':
+        taux_tva = f"{invoice.articles[0].tva:.2f}%".replace('.', ',') if invoice.articles else ''
+    else:
+        if total_ht and total_ht != 0:
+            taux_tva = f"{((total_ttc / total_ht) - 1) * 100:.2f}%".replace('.', ',')
+        else:
+            taux_tva = ''
+
+    # Calculate total quantity from articles
+    total_quantity = invoice.total_quantity()
+
+    # Remplir les articles et calculer la somme des remises
+    somme_remises = 0  # Pour stocker la somme des remises en euros
+
+    for i, article in enumerate(invoice.articles, 1):
+        if i > 20:
+            break
+
+        quantite = article.quantite
+        remise_percent = article.remise
+
+        # Calculate values based on the type of invoice
+        if invoice.type == 'meg':
+            prix_ht = article.prix_unitaire
+            montant_ht = article.montant_ht
+            # Calculer la remise en euros (remise_percent est un pourcentage)
+            remise_euros = remise_percent * montant_ht
+            taux_tva_decimal = article.tva / 100
+            tva_euros = montant_ht * taux_tva_decimal
+        else:
+            prix_ttc = article.prix_unitaire
+            taux_tva = ((total_ttc / total_ht) - 1) if total_ht > 0 else 0
+            prix_ht = prix_ttc / (1 + taux_tva) if taux_tva > 0 else prix_ttc
+            montant_ht = prix_ht * quantite
+            # Calculer la remise en euros
+            remise_euros = remise_percent * montant_ht
+            tva_euros = montant_ht * taux_tva
+
+        # Ajouter cette remise à la somme totale
+        somme_remises += remise_euros
+
+        # Fill in the row data
+        row[f'ref{i}'] = article.reference
+        row[f'q{i}'] = quantite
+        row[f'prix{i}'] = round(prix_ht, 2)
+        row[f'r€{i}'] = round(remise_euros, 2)  # Utiliser la remise en euros
+        row[f'ht{i}'] = round(montant_ht, 2)
+        row[f'tva€{i}'] = round(tva_euros, 2)
+
+    # Utiliser la remise globale si elle existe, sinon utiliser la somme des remises
+    remise_finale = remise_globale if remise_globale else somme_remises
+
+    # Remplir les données dans l'ordre exact des colonnes
+    row['Type-facture'] = " "
+    row['n°ordre'] = " "
+    row['Syst'] = 'MEG' if invoice.type == 'meg' else 'Internet'
+    row['N° Syst.'] = invoice.numero_facture
+    row['Type_Vente'] = invoice.type_vente
+    row['Réseau_Vente'] = invoice.reseau_vente
+    row['Client'] = invoice.client_name
+    row['Date commande'] = format_date(invoice.date_commande)
+    row['Date facture'] = format_date(invoice.date_facture)
+    row['Commentaire'] = invoice.commentaire
+    # Echéance d'acompte, déjà extraite par InvoiceExtractor
+    row['date1'] = format_date(invoice.date_acompte)
+    row['acompte1'] = invoice.acompte_echeance
+    row['solde'] = total_ttc
+    row['contrôle paiement'] = invoice.statut_paiement
+    row['reste dû'] = total_ttc - total_ttc
+    row['tva'] = taux_tva
+    row['Credit TTC'] = total_ttc
+    row['Credit HT'] = total_ht  # Utiliser le total HT avec remise
+    row['remise'] = round(remise_finale, 2)  # Utiliser la remise finale calculée
+    row['TVA Collectee'] = totals.tva
+    row['quantité'] = total_quantity
+
+    return row
+
+def create_invoice_dataframe(invoices_data, errors: Optional[List[Dict]] = None):
+    """
+    Crée un DataFrame à partir des données des factures
+    Accepte des Invoice ou des entrées historiques {'data': ..., 'text': ...}
+    errors : liste complétée avec les factures qui n'ont pas pu être converties en ligne
+    """
+    import pandas as pd
 
     rows = []
     for filename, invoice in invoices_data.items():
         try:
-            data = invoice['data']
-            row = {col: '' for col in headers}  # Initialiser toutes les colonnes avec des valeurs vides
-
-            # Extraire la date
-            date = data.get('date', '')
-            if data.get('type') == 'internet' and 'text' in invoice:
-                date_match = re.search(r'Date de commande\s*:\s*(\d{1,2}\s*\w+\s*\d{4})', invoice['text'])
-                if date_match:
-                    date_fr = date_match.group(1).strip()
-                    mois_fr = {
-                        'janvier': '01', 'février': '02', 'mars': '03', 'avril': '04',
-                        'mai': '05', 'juin': '06', 'juillet': '07', 'août': '08',
-                        'septembre': '09', 'octobre': '10', 'novembre': '11', 'décembre': '12'
-                    }
-                    for mois, num in mois_fr.items():
-                        date_fr = date_fr.replace(mois, num)
-                    jour, mois, annee = re.match(r'(\d{1,2})\s*(\d{2})\s*(\d{4})', date_fr).groups()
-                    date = f"{annee}-{mois}-{jour.zfill(2)}"
-
-            # Extraire les informations d'acompte
-            acompte_match = re.search(r'Echéance\(s\)\s*Acompte\s*de\s*(\d+[\s\d]*,\d+)\s*€\s*au\s*(\d{2}/\d{2}/\d{4})', invoice['text'])
-            if acompte_match:
-                montant_acompte = float(acompte_match.group(1).replace(' ', '').replace(',', '.'))
-                date_acompte = acompte_match.group(2)
-                jour, mois, annee = date_acompte.split('/')
-                date_acompte_iso = f"{annee}-{mois}-{jour}"
-            else:
-                montant_acompte = ''
-                date_acompte_iso = ''
-
-            # Calculer le taux de TVA et le total HT avec remise
-            total_ht = data['TOTAL']['total_ht']
-            remise_globale = data['TOTAL'].get('remise', 0)
-            # Appliquer la remise si elle existe
-            if remise_globale:
-                total_ht = total_ht - float(remise_globale)
-            total_ttc = data['TOTAL']['total_ttc']
-
-            # Formater le taux de TVA au format XX,XX%
-            if data.get('type') == 'meg':
-                taux_tva = f"{data['articles'][0]['tva']:.2f}%".replace('.', ',') if data['articles'] else ''
-            else:
-                if total_ht and total_ht != 0:
-                    taux_tva = f"{((total_ttc / total_ht) - 1) * 100:.2f}%".replace('.', ',')
-                else:
-                    taux_tva = ''
-
-            # Calculate total quantity from articles - ensure this is done correctly
-            total_quantity = 0
-            articles = data.get('articles', [])
-            for article in articles:
-                try:
-                    # Make sure we're getting a number
-                    qty = float(article.get('quantite', 0))
-                    total_quantity += qty
-                except (ValueError, TypeError):
-                    # If conversion fails, try to handle it gracefully
-                    print(f"Warning: Could not convert quantity to number: {article.get('quantite')}")
-
-            # Remplir les articles et calculer la somme des remises
-            somme_remises = 0  # Pour stocker la somme des remises en euros
-
-            for i, article in enumerate(articles, 1):
-                if i > 20:
-                    break
-
-                # Get article data with safe defaults
-                reference = article.get('reference', '')
-                description = article.get('description', '')
-                quantite = article.get('quantite', 0)
-                prix_unitaire = article.get('prix_unitaire', 0)
-                remise_percent = article.get('remise', 0)
-
-                # Calculate values based on the type of invoice
-                if data.get('type') == 'meg':
-                    prix_ht = prix_unitaire
-                    montant_ht = article.get('montant_ht', prix_ht * quantite)
-                    # Calculer la remise en euros (remise_percent est un pourcentage)
-                    remise_euros = remise_percent * montant_ht
-                    taux_tva_decimal = article.get('tva', 0) / 100
-                    tva_euros = montant_ht * taux_tva_decimal
-                else:
-                    prix_ttc = prix_unitaire
-                    taux_tva = ((total_ttc / total_ht) - 1) if total_ht > 0 else 0
-                    prix_ht = prix_ttc / (1 + taux_tva) if taux_tva > 0 else prix_ttc
-                    montant_ht = prix_ht * quantite
-                    # Calculer la remise en euros
-                    remise_euros = remise_percent * montant_ht
-                    tva_euros = montant_ht * taux_tva
-
-                # Ajouter cette remise à la somme totale
-                somme_remises += remise_euros
-
-                # Fill in the row data
-                row[f'supfam{i}'] = ''
-                row[f'fam{i}'] = ''
-                row[f'ref{i}'] = reference
-                row[f'q{i}'] = quantite
-                row[f'prix{i}'] = round(prix_ht, 2)
-                row[f'r€{i}'] = round(remise_euros, 2)  # Utiliser la remise en euros
-                row[f'ht{i}'] = round(montant_ht, 2)
-                row[f'tva€{i}'] = round(tva_euros, 2)
-
-            # Utiliser la remise globale si elle existe, sinon utiliser la somme des remises
-            remise_finale = remise_globale if remise_globale else somme_remises
-
-            # Remplir les données dans l'ordre exact des colonnes
-            row['Type-facture'] = " "
-            row['n°ordre'] = " "
-            row['saisie'] = ''
-            row['Syst'] = 'MEG' if data.get('type') == 'meg' else 'Internet'
-            row['N° Syst.'] = data.get('numero_facture', '')
-            row['comptable'] = ''
-            row['Type_facture'] = ''
-            row['Type_Vente'] = data.get('Type_Vente', '')
-            row['Réseau_Vente'] = data.get('Réseau_Vente', '')
-            row['Client'] = data.get('client_name', '')
-            row['Typologie'] = ''
-            row['Banque créditée'] = ''
-            row['Date commande'] = format_date(data.get('date_commande', ''))
-            row['Date facture'] = format_date(data.get('date_facture', ''))
-            row['Date expédition'] = ''
-            row['Commentaire'] = data.get('commentaire', '')
-            row['date1'] = format_date(date_acompte_iso if 'date_acompte_iso' in locals() else '')
-            row['acompte1'] = montant_acompte if 'montant_acompte' in locals() else ''
-            row['date2'] = ''
-            row['acompte2'] = ''
-            row['Date solde'] = ''
-            row['solde'] = data.get('TOTAL', {}).get('total_ttc', 0)
-            row['contrôle paiement'] = data.get('statut_paiement', '')
-            row['reste dû'] = data.get('TOTAL', {}).get('total_ttc', 0) - data.get('TOTAL', {}).get('total_ttc', 0)
-            row['AVO'] = ''
-            row['tva'] = taux_tva
-            row['ttc'] = ''
-            row['Credit TTC'] = data.get('TOTAL', {}).get('total_ttc', 0)
-            row['Credit HT'] = total_ht  # Utiliser le total HT avec remise
-            row['remise'] = round(remise_finale, 2)  # Utiliser la remise finale calculée
-            row['TVA Collectee'] = data.get('TOTAL', {}).get('tva', 0)
-            row['quantité'] = total_quantity
-
-            rows.append(row)
-
+            rows.append(invoice_to_row(as_invoice(invoice)))
         except Exception as e:
-            print(f"Erreur lors du traitement de {filename}: {str(e)}")
+            logger.error(f"Cannot build Excel row for {filename}: {str(e)}")
+            if errors is not None:
+                errors.append({'file': filename, 'stage': 'excel', 'error': str(e)})
             continue
 
-    # Créer le DataFrame en respectant l'ordre exact des colonnes
-    df = pd.DataFrame(rows)
-    return df[headers]  # Forcer l'ordre exact des colonnes
+    # Créer le DataFrame en respectant l'ordre exact des colonnes (même si le lot est vide)
+    return pd.DataFrame(rows, columns=HEADERS)
 
 def format_excel(writer, df):
     """Applique le formatage au fichier Excel"""
@@ -226,10 +197,56 @@ def format_excel(writer, df):
             worksheet.write(0, col_num, value, header_format)
 
     except Exception as e:
-        print(f"Erreur lors du formatage Excel: {str(e)}")
+        logger.error(f"Excel formatting failed: {str(e)}")
+
+ERRORS_HEADERS = ['Fichier', 'Nom d\'origine', 'Étape', 'Erreur']
+
+def write_errors_sheet(writer, errors: List[Dict]):
+    """Feuille 'Erreurs' : un fichier en échec par ligne"""
+    import pandas as pd
+
+    errors_df = pd.DataFrame([
+        [error.get('file', ''), error.get('name', ''), error.get('stage', ''), error.get('error', '')]
+        for error in errors
+    ], columns=ERRORS_HEADERS)
+    errors_df.to_excel(writer, sheet_name='Erreurs', index=False)
+    worksheet = writer.sheets['Erreurs']
+    for idx, width in enumerate((30, 30, 12, 80)):
+        worksheet.set_column(idx, idx, width)
+
+def write_workbook(df, output, errors: Optional[List[Dict]] = None):
+    """
+    Écrit le DataFrame formaté au format xlsx dans un chemin ou un objet fichier
+    errors : fichiers en échec, listés dans une feuille 'Erreurs' (absente si vide)
+    """
+    import pandas as pd
+
+    # in_memory : xlsxwriter n'écrit pas ses fichiers XML intermédiaires sur disque
+    with pd.ExcelWriter(output, engine='xlsxwriter',
+                        engine_kwargs={'options': {'in_memory': True}}) as writer:
+        df.to_excel(writer, sheet_name='Factures', index=False)
+        format_excel(writer, df)
+        if errors:
+            write_errors_sheet(writer, errors)
+
+def build_workbook(df, max_memory: int = EXCEL_SPOOL_MAX_BYTES, errors: Optional[List[Dict]] = None):
+    """
+    Construit le classeur dans un tampon en mémoire, déversé sur disque au-delà de max_memory
+    Renvoie le tampon positionné au début ; l'appelant doit le fermer
+    """
+    buffer = tempfile.SpooledTemporaryFile(max_size=max_memory)
+    try:
+        write_workbook(df, buffer, errors)
+        buffer.seek(0)
+    except Exception:
+        buffer.close()
+        raise
+    return buffer
 
 def create_excel_from_data(invoices_data):
     """Crée un fichier Excel à partir des données des factures"""
+    import pandas as pd
+
     # Initialiser le DataFrame
     rows = []
 
@@ -259,7 +276,7 @@ def create_excel_from_data(invoices_data):
             }
             rows.append(row)
         except Exception as e:
-            print(f"Erreur lors du traitement de {filename}: {str(e)}")
+            logger.error(f"Cannot build Excel row for {filename}: {str(e)}")
             continue
 
     # Créer le DataFrame
@@ -272,6 +289,8 @@ def create_excel_from_data(invoices_data):
     return Path(excel_path)
 
 def main():
+    import pytz  # Pour gérer les fuseaux horaires
+
     try:
         # Charger les données
         invoices_data = load_invoice_data()
@@ -301,9 +320,7 @@ def main():
         filename = f'factures_auto_{timestamp}.xlsx'
 
         # Créer le fichier Excel avec formatage
-        with pd.ExcelWriter(filename, engine='xlsxwriter') as writer:
-            df.to_excel(writer, sheet_name='Factures', index=False)
-            format_excel(writer, df)
+        write_workbook(df, filename)
 
         print(f"Fichier Excel créé : {filename}")
 
@@ -0,0 +1,243 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass, replace
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+from records import Invoice
+
+logger = logging.getLogger(__name__)
+
+# skip : les doublons sont écartés du classeur ; flag : ils y restent, marqués dans le commentaire
+DUPLICATE_POLICY = os.getenv("DUPLICATE_POLICY", "skip").lower()
+# Nombre de factures récentes conservées dans l'index inter-lots
+DEDUP_MAX_ENTRIES = int(os.getenv("DEDUP_MAX_ENTRIES", "20000"))
+# L'index n'est élagué qu'une validation sur DEDUP_PRUNE_EVERY
+DEDUP_PRUNE_EVERY = 100
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS invoices (
+    invoice_key TEXT PRIMARY KEY,
+    job_id TEXT,
+    filename TEXT NOT NULL,
+    name TEXT NOT NULL,
+    seen_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_invoices_seen_at ON invoices (seen_at);
+CREATE TABLE IF NOT EXISTS hashes (
+    digest TEXT PRIMARY KEY,
+    invoice_key TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_hashes_invoice_key ON hashes (invoice_key);
+"""
+
+def content_hash(path, chunk_size: int = 1024 * 1024) -> str:
+    """Empreinte SHA-256 du contenu d'un fichier"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def invoice_key(invoice: Invoice) -> Optional[str]:
+    """Clé logique (type, numero_facture, total_ttc) ; None si la facture n'a pas de numéro"""
+    if not invoice.numero_facture:
+        return None
+    return f"{invoice.type}|{invoice.numero_facture}|{float(invoice.totals.total_ttc or 0):.2f}"
+
+@dataclass(slots=True)
+class Duplicate:
+    """Fichier reconnu comme doublon d'une facture déjà traitée"""
+    filename: str
+    original: str  # nom d'origine (téléversé) de la facture déjà traitée
+    kind: str  # 'content' (octets identiques) ou 'invoice' (même facture)
+    invoice: Optional[Invoice] = None
+    name: Optional[str] = None  # nom d'origine du doublon
+    original_job: Optional[str] = None  # lot de la facture déjà traitée, s'il est différent
+
+    def to_dict(self) -> Dict:
+        return {'filename': self.filename, 'name': self.name or self.filename,
+                'original': self.original, 'original_job': self.original_job, 'kind': self.kind}
+
+class DuplicateIndex:
+    """
+    Index persistant des factures livrées (SQLite, borné aux plus récentes)
+    invoices : clé logique -> lot, fichier et nom d'origine ; hashes : empreinte -> clé logique
+    """
+
+    def __init__(self, path, max_entries: int = DEDUP_MAX_ENTRIES):
+        self.path = Path(path)
+        self.max_entries = max_entries
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(str(self.path), check_same_thread=False, timeout=30)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(SCHEMA)
+        self._db.commit()
+        self._lock = threading.Lock()
+        self._commits = 0
+
+    def lookup_content(self, digest: str) -> Optional[Dict]:
+        with self._lock:
+            row = self._db.execute(
+                """SELECT i.* FROM hashes h JOIN invoices i ON i.invoice_key = h.invoice_key
+                   WHERE h.digest = ?""", (digest,)
+            ).fetchone()
+        return dict(row) if row else None
+
+    def lookup_invoice(self, key: str) -> Optional[Dict]:
+        with self._lock:
+            row = self._db.execute("SELECT * FROM invoices WHERE invoice_key = ?", (key,)).fetchone()
+        return dict(row) if row else None
+
+    def commit(self, entries: Iterable[Dict]):
+        """
+        Enregistre en une transaction des entrées {key, digest, job_id, filename, name}
+        Une clé déjà connue garde son fichier d'origine et gagne l'empreinte
+        """
+        now = time.time()
+        with self._lock, self._db:
+            for entry in entries:
+                self._db.execute(
+                    """INSERT INTO invoices VALUES (?, ?, ?, ?, ?)
+                       ON CONFLICT (invoice_key) DO UPDATE SET seen_at = excluded.seen_at""",
+                    (entry['key'], entry.get('job_id'), entry['filename'], entry['name'], now)
+                )
+                if entry.get('digest'):
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO hashes VALUES (?, ?)", (entry['digest'], entry['key'])
+                    )
+            self._commits += 1
+            if self._commits % DEDUP_PRUNE_EVERY == 0:
+                self._prune()
+
+    def _prune(self):
+        """Supprime les factures au-delà des max_entries plus récentes (sous self._lock)"""
+        cutoff = self._db.execute(
+            "SELECT seen_at FROM invoices ORDER BY seen_at DESC LIMIT 1 OFFSET ?",
+            (self.max_entries,)
+        ).fetchone()
+        if cutoff is None:
+            return
+        self._db.execute("DELETE FROM invoices WHERE seen_at <= ?", (cutoff[0],))
+        self._db.execute(
+            "DELETE FROM hashes WHERE invoice_key NOT IN (SELECT invoice_key FROM invoices)"
+        )
+
+class BatchDeduplicator:
+    """
+    Détection des doublons d'un lot : à l'ingestion (contenu) puis après analyse (facture)
+    Les factures du lot ne rejoignent l'index inter-lots qu'une fois livrées (commit)
+    job_id : lot courant ; ses propres entrées d'index sont ignorées (reprise d'un lot)
+    names : nom d'origine de chaque fichier du lot
+    """
+
+    def __init__(self, index: Optional[DuplicateIndex] = None, policy: str = DUPLICATE_POLICY,
+                 job_id: Optional[str] = None, names: Optional[Dict[str, str]] = None):
+        self.index = index
+        self.policy = policy
+        self.job_id = job_id
+        self.names = names or {}
+        self.duplicates: List[Duplicate] = []
+        self._batch_hashes: Dict[str, str] = {}
+        self._batch_keys: Dict[str, str] = {}
+        self._batch_invoices: Dict[str, Invoice] = {}
+        self._pending_hashes: Dict[str, str] = {}
+        # Entrées à enregistrer dans l'index à la livraison, par fichier
+        self._pending_entries: Dict[str, Dict] = {}
+
+    def _name(self, filename: str) -> str:
+        return self.names.get(filename, filename)
+
+    def _indexed(self, entry: Optional[Dict]) -> Optional[Dict]:
+        """Entrée d'index d'un autre lot (celles du lot courant viennent d'une livraison précédente)"""
+        if entry is None or (self.job_id is not None and entry['job_id'] == self.job_id):
+            return None
+        return entry
+
+    def check_content(self, filename: str, path) -> Optional[Duplicate]:
+        """Doublon octet pour octet : détecté avant toute extraction"""
+        digest = content_hash(path)
+        self._pending_hashes[filename] = digest
+
+        original = self._batch_hashes.get(digest)
+        if original is not None:
+            return self._record(Duplicate(filename, self._name(original), 'content',
+                                          self._batch_invoices.get(original), self._name(filename)))
+
+        # Politique flag : la facture d'origine n'est pas conservée dans l'index, le fichier est
+        # analysé puis marqué par check_invoice
+        if self.index is None or self.policy == 'flag':
+            return None
+        entry = self._indexed(self.index.lookup_content(digest))
+        if entry is not None:
+            return self._record(Duplicate(filename, entry['name'], 'content', None,
+                                          self._name(filename), entry['job_id']))
+        return None
+
+    def check_invoice(self, filename: str, invoice: Invoice) -> Optional[Duplicate]:
+        """Doublon logique : même type, numéro et total TTC qu'une facture déjà vue"""
+        key = invoice_key(invoice)
+        digest = self._pending_hashes.get(filename)
+        if digest is not None:
+            self._batch_hashes[digest] = filename
+        if key is None:
+            self._batch_invoices[filename] = invoice
+            return None
+
+        original = self._batch_keys.get(key)
+        if original is not None:
+            if digest is not None:
+                self._batch_hashes[digest] = original
+            return self._record(Duplicate(filename, self._name(original), 'invoice', invoice,
+                                          self._name(filename)))
+
+        entry = self._indexed(self.index.lookup_invoice(key)) if self.index else None
+        if entry is not None:
+            # Une prochaine copie identique sera écartée dès l'ingestion
+            if digest is not None:
+                self._pending_entries[filename] = {
+                    'key': key, 'digest': digest, 'job_id': entry['job_id'],
+                    'filename': entry['filename'], 'name': entry['name'], 'alias': True,
+                }
+            return self._record(Duplicate(filename, entry['name'], 'invoice', invoice,
+                                          self._name(filename), entry['job_id']))
+
+        self._batch_keys[key] = filename
+        self._batch_invoices[filename] = invoice
+        self._pending_entries[filename] = {
+            'key': key, 'digest': digest, 'job_id': self.job_id,
+            'filename': filename, 'name': self._name(filename),
+        }
+        return None
+
+    def flagged(self, duplicate: Duplicate) -> Optional[Invoice]:
+        """Copie de la facture marquée comme doublon (politique flag), sinon None"""
+        if self.policy != 'flag' or duplicate.invoice is None:
+            return None
+        commentaire = f"DOUBLON de {duplicate.original}"
+        if duplicate.original_job and duplicate.original_job != self.job_id:
+            commentaire = f"{commentaire} (lot {duplicate.original_job})"
+        if duplicate.invoice.commentaire:
+            commentaire = f"{commentaire} - {duplicate.invoice.commentaire}"
+        return replace(duplicate.invoice, commentaire=commentaire, text=None)
+
+    def commit(self, delivered: Iterable[str]):
+        """Enregistre dans l'index les factures livrées (présentes dans le classeur) du lot"""
+        if self.index is None:
+            return
+        delivered = set(delivered)
+        entries = [entry for filename, entry in self._pending_entries.items()
+                   if filename in delivered or entry.get('alias')]
+        if entries:
+            self.index.commit(entries)
+
+    def _record(self, duplicate: Duplicate) -> Duplicate:
+        logger.info(f"Duplicate {duplicate.kind} detected: {duplicate.name or duplicate.filename} "
+                    f"-> {duplicate.original}")
+        self.duplicates.append(duplicate)
+        return duplicate
@@ -0,0 +1,204 @@
+"""
+Cache des polices pdfminer partagé entre documents
+
+pdfminer reconstruit chaque police (programme de police, ToUnicode, largeurs) à chaque document :
+les factures MEG, produites par le même générateur, embarquent pourtant les mêmes polices.
+Les polices construites sont conservées dans un cache LRU borné, propre au processus
+(donc à chaque worker), indexé par l'empreinte du contenu de la ressource de police et non par
+son numéro d'objet, qui n'a de sens que dans un document.
+Les CMap nommées sont déjà mises en cache par pdfminer (CMapDB) pour tout le processus.
+"""
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+
+from pdfminer.pdfinterp import PDFResourceManager
+from pdfminer.pdftypes import PDFObjRef, PDFStream
+from pdfminer.psparser import PSLiteral
+
+# Nombre de polices conservées par worker (0 : cache désactivé)
+FONT_CACHE_SIZE = int(os.getenv("FONT_CACHE_SIZE", "256"))
+# Profondeur maximale parcourue dans la description d'une police
+_MAX_DEPTH = 8
+
+def _feed(digest, obj, depth: int = 0, seen: Optional[set] = None):
+    """Ajoute à l'empreinte le contenu d'un objet PDF, références résolues"""
+    if seen is None:
+        seen = set()
+    if depth > _MAX_DEPTH:
+        digest.update(b'<deep>')
+        return
+    if isinstance(obj, PDFObjRef):
+        if obj.objid in seen:
+            digest.update(b'<cycle>')
+            return
+        seen.add(obj.objid)
+        obj = obj.resolve()
+    if isinstance(obj, PDFStream):
+        digest.update(b'S')
+        _feed(digest, obj.attrs, depth + 1, seen)
+        data = obj.get_rawdata()
+        if data is None:
+            data = obj.get_data()
+        digest.update(hashlib.sha256(data or b'').digest())
+    elif isinstance(obj, dict):
+        digest.update(b'D')
+        for key in sorted(obj, key=str):
+            digest.update(str(key).encode('utf-8', 'replace'))
+            _feed(digest, obj[key], depth + 1, seen)
+    elif isinstance(obj, (list, tuple)):
+        digest.update(b'L')
+        for item in obj:
+            _feed(digest, item, depth + 1, seen)
+    elif isinstance(obj, PSLiteral):
+        digest.update(b'/' + str(obj.name).encode('utf-8', 'replace'))
+    elif isinstance(obj, bytes):
+        digest.update(b'B' + obj)
+    else:
+        digest.update(repr(obj).encode('utf-8', 'replace'))
+
+def font_key(spec) -> str:
+    """Empreinte SHA-256 d'une description de police et des flux qu'elle référence"""
+    digest = hashlib.sha256()
+    _feed(digest, spec)
+    return digest.hexdigest()
+
+class FontCache:
+    """Cache LRU borné des polices construites, avec compteurs de succès"""
+
+    def __init__(self, max_entries: int = FONT_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        # empreinte -> (police, secondes de construction)
+        self._fonts: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.seconds_saved = 0.0
+        self.documents = 0
+
+    def get(self, key: str):
+        """(police, secondes de construction) ou None"""
+        with self._lock:
+            entry = self._fonts.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._fonts.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def add_document(self):
+        with self._lock:
+            self.documents += 1
+
+    def add_saved(self, seconds: float):
+        with self._lock:
+            self.seconds_saved += seconds
+
+    def put(self, key: str, font, build_seconds: float):
+        with self._lock:
+            self._fonts[key] = (font, build_seconds)
+            self._fonts.move_to_end(key)
+            while len(self._fonts) > self.max_entries:
+                self._fonts.popitem(last=False)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'pid': os.getpid(),
+                'entries': len(self._fonts),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else None,
+                'documents': self.documents,
+                'seconds_saved': round(self.seconds_saved, 6),
+                'seconds_saved_per_document': (
+                    round(self.seconds_saved / self.documents, 6) if self.documents else None
+                ),
+            }
+
+class SharedResourceManager(PDFResourceManager):
+    """
+    Gestionnaire de ressources d'un document, adossé au cache de polices du worker
+    Remplace pdf.rsrcmgr de pdfplumber avant l'analyse des pages.
+    """
+
+    def __init__(self, cache: FontCache):
+        super().__init__(caching=True)
+        self.cache = cache
+        self.hits = 0
+        self.misses = 0
+        self.seconds_saved = 0.0
+        cache.add_document()
+
+    def get_font(self, objid, spec):
+        # Police déjà vue dans ce document
+        if objid and objid in self._cached_fonts:
+            return self._cached_fonts[objid]
+
+        # Les polices Type3 dessinent leurs glyphes avec des objets du document : non partagées
+        subtype = spec.get('Subtype') if isinstance(spec, dict) else None
+        if isinstance(subtype, PSLiteral) and subtype.name == 'Type3':
+            return super().get_font(objid, spec)
+
+        started = time.perf_counter()
+        key = font_key(spec)
+        hashed = time.perf_counter()
+
+        entry = self.cache.get(key)
+        if entry is not None:
+            font, build_seconds = entry
+            self.hits += 1
+            # Temps économisé net du calcul de l'empreinte
+            saved = build_seconds - (hashed - started)
+            self.seconds_saved += saved
+            self.cache.add_saved(saved)
+            if objid:
+                self._cached_fonts[objid] = font
+            return font
+
+        self.misses += 1
+        font = super().get_font(objid, spec)
+        self.cache.put(key, font, time.perf_counter() - hashed)
+        return font
+
+    def stats(self) -> Dict:
+        """Compteurs du document courant"""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'seconds_saved': round(self.seconds_saved, 6),
+        }
+
+_font_cache: Optional[FontCache] = None
+_font_cache_lock = threading.Lock()
+
+def get_font_cache() -> Optional[FontCache]:
+    """Cache du worker courant (None si désactivé)"""
+    global _font_cache
+    if FONT_CACHE_SIZE <= 0:
+        return None
+    if _font_cache is None:
+        with _font_cache_lock:
+            if _font_cache is None:
+                _font_cache = FontCache()
+    return _font_cache
+
+def install(pdf) -> Optional[SharedResourceManager]:
+    """Branche le cache partagé sur un document pdfplumber ouvert"""
+    cache = get_font_cache()
+    if cache is None:
+        return None
+    pdf.rsrcmgr = SharedResourceManager(cache)
+    return pdf.rsrcmgr
+
+def font_cache_stats() -> Dict:
+    cache = get_font_cache()
+    if cache is None:
+        return {'enabled': False}
+    return {'enabled': True, **cache.stats()}
@@ -0,0 +1,346 @@
+import re
+import threading
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional, Tuple
+
+from records import Article, Invoice
+
+def convert_to_float(amount_str: str) -> float:
+    """
+    Convertit une chaîne de montant en float
+    """
+    return float(amount_str.replace(',', '.').replace(' ', ''))
+
+@dataclass
+class InvoiceFormat:
+    """
+    Format de facture déclaratif : marqueurs de détection, patterns des champs,
+    valeurs par défaut et analyseurs des articles et des montants
+    """
+    name: str
+    # Sous-chaînes dont la présence identifie le format
+    markers: Tuple[str, ...]
+    # Patterns des champs texte (groupe 1, ou match complet pour whole_match_fields)
+    field_patterns: Dict[str, str]
+    parse_articles: Callable[[str], List[Article]]
+    parse_amounts: Callable[[str], Dict]
+    # Valeurs par défaut des champs (ex. statut de paiement des factures internet)
+    defaults: Dict[str, str] = field(default_factory=dict)
+    # Patterns de repli, essayés si le pattern principal ne trouve rien
+    fallback_patterns: Dict[str, str] = field(default_factory=dict)
+    # Normalisation d'une valeur extraite (clé, valeur) -> valeur
+    normalize: Optional[Callable[[str, str], str]] = None
+    # Recoupement des montants (facture, tolérance) -> anomalies, selon ce que le format imprime
+    check_amounts: Optional[Callable[[Invoice, float], List[str]]] = None
+    # En cas de marqueurs de plusieurs formats, la priorité la plus haute l'emporte
+    priority: int = 0
+    compiled_fields: Dict[str, re.Pattern] = field(init=False, repr=False)
+    compiled_fallbacks: Dict[str, re.Pattern] = field(init=False, repr=False)
+
+    def __post_init__(self):
+        self.compiled_fields = {
+            key: re.compile(pattern, re.IGNORECASE) for key, pattern in self.field_patterns.items()
+        }
+        self.compiled_fallbacks = {
+            key: re.compile(pattern) for key, pattern in self.fallback_patterns.items()
+        }
+
+# Champs dont la valeur est le match complet (codes 20.XX / 20.XX.XX)
+WHOLE_MATCH_FIELDS = {'Réseau_Vente', 'Type_Vente'}
+
+COMMON_FIELD_PATTERNS = {
+    'numero_client': r'N°\s*client\s*:\s*(CLT\d+)',
+    'Réseau_Vente': r'20\.(?:0[1-9]|10)\.\d{2}',  # Pattern pour 20.XX.XX complet
+    'Type_Vente': r'20\.(?:0[1-9]|10)',  # Pattern pour 20.XX uniquement
+    'commentaire': r'Commentaire\s*:\s*([^\n]+)',
+    'statut_paiement': r'Statut paiement\s*:\s*([^\n]+)',
+}
+
+# ----------------------------------------------------------------------------
+# Registre des formats et détection combinée
+# ----------------------------------------------------------------------------
+
+_registry: Dict[str, InvoiceFormat] = {}
+_default_format: Optional[str] = None
+_registry_lock = threading.Lock()
+_detector: Optional[Tuple[re.Pattern, Dict[str, str]]] = None
+
+def register_format(invoice_format: InvoiceFormat, default: bool = False):
+    """Ajoute un format au registre (default : format retenu si aucun marqueur n'est trouvé)"""
+    global _default_format, _detector
+    with _registry_lock:
+        _registry[invoice_format.name] = invoice_format
+        if default or _default_format is None:
+            _default_format = invoice_format.name
+        _detector = None  # l'automate est reconstruit à la prochaine détection
+
+def get_format(name: str) -> InvoiceFormat:
+    return _registry[name]
+
+def registered_formats() -> List[InvoiceFormat]:
+    return list(_registry.values())
+
+def _build_detector() -> Tuple[re.Pattern, Dict[str, str]]:
+    """
+    Un seul automate pour les marqueurs de tous les formats :
+    une alternative nommée par marqueur, reliée à son format
+    """
+    alternatives = []
+    group_formats = {}
+    for invoice_format in _registry.values():
+        for marker in invoice_format.markers:
+            group = f"m{len(alternatives)}"
+            alternatives.append(f"(?P<{group}>{re.escape(marker)})")
+            group_formats[group] = invoice_format.name
+    pattern = re.compile('|'.join(alternatives)) if alternatives else re.compile(r'(?!)')
+    return pattern, group_formats
+
+def detect_format(text: str) -> InvoiceFormat:
+    """
+    Détecte le format en un seul parcours du texte, quel que soit le nombre de formats
+    Le parcours s'arrête dès que le format le plus prioritaire est trouvé
+    """
+    global _detector
+    detector = _detector
+    if detector is None:
+        with _registry_lock:
+            if _detector is None:
+                _detector = _build_detector()
+            detector = _detector
+    pattern, group_formats = detector
+
+    top_priority = max((f.priority for f in _registry.values() if f.markers), default=0)
+    best = None
+    for match in pattern.finditer(text):
+        candidate = _registry[group_formats[match.lastgroup]]
+        if best is None or candidate.priority > best.priority:
+            best = candidate
+            if best.priority >= top_priority:
+                break
+    return best or _registry[_default_format]
+
+# ----------------------------------------------------------------------------
+# Format MEG
+# ----------------------------------------------------------------------------
+
+MEG_ARTICLE_PATTERN = re.compile(
+    r'ART(\d+)\s*-\s*([^\n]+?)\s*'  # Référence et description
+    r'(\d+,\d+)\s*'                 # Quantité
+    r'(\d+[\s\d]*,\d+)\s*€\s*'      # Prix unitaire
+    r'(\d+,\d+)%\s*'                # Remise
+    r'(\d+[\s\d]*,\d+)\s*€\s*'      # Montant HT
+    r'(\d+,\d+)%',                  # TVA
+    re.MULTILINE | re.DOTALL
+)
+MEG_TOTAL_HT_PATTERN = re.compile(r'Total HT\s+([\d\s]+[,.]?\d*)\s*€')
+MEG_TVA_PATTERN = re.compile(r'TVA\s+([\d\s]+[,.]?\d*)\s*€')
+MEG_TOTAL_TTC_PATTERN = re.compile(r'Total TTC\s+([\d\s]+[,.]?\d*)\s*€')
+MEG_ACOMPTE_PATTERN = re.compile(r'Acompte\(s\) reçu\(s\) HT\s+([\d\s]+[,.]?\d*)\s*€')
+
+def parse_meg_articles(text: str) -> List[Article]:
+    articles = []
+    for match in MEG_ARTICLE_PATTERN.finditer(text):
+        try:
+            prix_unitaire = match.group(4).replace(' ', '')
+            montant_ht = match.group(6).replace(' ', '')
+
+            articles.append(Article(
+                reference=f"ART{match.group(1)}",
+                description=match.group(2).strip(),
+                quantite=float(match.group(3).replace(',', '.')),
+                prix_unitaire=float(prix_unitaire.replace(',', '.')),
+                remise=float(match.group(5).replace(',', '.')) / 100,
+                montant_ht=float(montant_ht.replace(',', '.')),
+                tva=float(match.group(7).replace(',', '.'))
+            ))
+        except (IndexError, ValueError) as e:
+            print(f"Erreur lors de l'extraction d'un article MEG: {e}")
+            continue
+    return articles
+
+def parse_meg_amounts(text: str) -> Dict:
+    amounts = {'type_expedition': None}
+
+    # Extraction total HT
+    total_ht_match = MEG_TOTAL_HT_PATTERN.search(text)
+    if total_ht_match:
+        amounts['total_ht'] = convert_to_float(total_ht_match.group(1))
+
+    # Extraction TVA
+    tva_match = MEG_TVA_PATTERN.search(text)
+    if tva_match:
+        amounts['tva'] = convert_to_float(tva_match.group(1))
+
+    # Extraction total TTC
+    total_ttc_match = MEG_TOTAL_TTC_PATTERN.search(text)
+    if total_ttc_match:
+        amounts['total_ttc'] = convert_to_float(total_ttc_match.group(1))
+
+    # Extraction acompte
+    acompte_match = MEG_ACOMPTE_PATTERN.search(text)
+    if acompte_match:
+        amounts['acompte'] = convert_to_float(acompte_match.group(1))
+
+    return amounts
+
+def normalize_meg_field(key: str, value: str) -> str:
+    # Les règlements par chèque sont normalisés
+    if key == 'reglement' and ('cheque' in value.lower() or 'chèque' in value.lower()):
+        return 'cheque'
+    return value
+
+def check_meg_amounts(invoice: Invoice, tolerance: float) -> List[str]:
+    """
+    Montants MEG, tous imprimés sur la facture :
+    total HT + TVA = total TTC, somme des montants HT des articles = total HT
+    """
+    problems = []
+    totals = invoice.totals
+    total_ht = float(totals.total_ht or 0)
+    tva = float(totals.tva or 0)
+    total_ttc = float(totals.total_ttc or 0)
+    if abs(total_ht + tva - total_ttc) > tolerance:
+        problems.append(f"HT {total_ht:.2f} + TVA {tva:.2f} != TTC {total_ttc:.2f}")
+
+    amounts_ht = [float(article.montant_ht or 0) for article in invoice.articles]
+    articles_ht = sum(amounts_ht)
+    # Un centime d'arrondi possible par ligne
+    if amounts_ht and abs(articles_ht - total_ht) > tolerance + 0.01 * len(amounts_ht):
+        problems.append(f"somme des articles {articles_ht:.2f} != HT {total_ht:.2f}")
+    return problems
+
+MEG_FORMAT = InvoiceFormat(
+    name='meg',
+    markers=(),
+    field_patterns={
+        'numero_facture': r'N°\s*:\s*([A-Z0-9-]+)',
+        'date_facture': r'Date[:\s]+(\d{2}[/-]\d{2}[/-]\d{4})',
+        **COMMON_FIELD_PATTERNS,
+        'client_name': r'N°\s*client\s*:\s*(?:CLT\d+)\s*\n(?!.*?NOMADS)([^\n]+?)(?:\s*NOMADS|\s*$)',
+        'reglement': r'Règlement\s*:?\s*([^\n]+)',
+    },
+    parse_articles=parse_meg_articles,
+    parse_amounts=parse_meg_amounts,
+    normalize=normalize_meg_field,
+    check_amounts=check_meg_amounts,
+)
+
+# ----------------------------------------------------------------------------
+# Format internet (boutique en ligne)
+# ----------------------------------------------------------------------------
+
+INTERNET_CODE_PATTERN = re.compile(r'UGS\s*:\s*([^\n]+)')
+INTERNET_LINE_PATTERN = re.compile(r'\s(\d+)\s+(\d+[,.]?\d*)\s*€')
+INTERNET_TOTAL_PATTERN = re.compile(
+    r'Total\s+([\d\s]+[,.]?\d*)\s*€\s*\(dont\s+([\d\s]+[,.]?\d*)\s*€\s*TVA\)', re.IGNORECASE
+)
+INTERNET_EXPEDITION_PATTERN = re.compile(
+    r'Expédition\s+(?:([^€\n]*?)(?:(\d+[,.]?\d*)\s*€)?)?\s*(?:\(TTC\))?\s*(?:via\s*)?([^\n]*?)(?=\s*(?:Total|$))',
+    re.IGNORECASE
+)
+# Ignore les lignes qui commencent par ces mots
+INTERNET_IGNORE_STARTS = ('UGS', 'Poids', 'Taille', 'Colori', 'Total', 'Sous-total', 'Expédition', 'En cas')
+
+def parse_internet_articles(text: str) -> List[Article]:
+    articles = []
+    current_code = ""
+
+    for line in text.split('\n'):
+        line = line.strip()
+
+        # Ignore les lignes vides ou commençant par des mots à ignorer
+        if not line or line.startswith(INTERNET_IGNORE_STARTS):
+            if 'UGS' in line:
+                # Extraction du code UGS
+                match = INTERNET_CODE_PATTERN.search(line)
+                if match:
+                    current_code = match.group(1).strip()
+            continue
+
+        # Cherche un nombre (quantité) et un prix dans la ligne
+        quantite_match = INTERNET_LINE_PATTERN.search(line)
+
+        if quantite_match:
+            try:
+                description = line[:quantite_match.start()].strip()
+                quantite = int(quantite_match.group(1))
+                prix_unitaire = convert_to_float(quantite_match.group(2))
+
+                articles.append(Article(
+                    reference=current_code,
+                    description=description,
+                    quantite=quantite,
+                    prix_unitaire=prix_unitaire,
+                    montant_ht=0.0,  # Par défaut
+                    tva=0.0,         # Par défaut
+                    remise=0.0       # Par défaut
+                ))
+                current_code = ""  # Réinitialise le code pour le prochain article
+            except (ValueError, IndexError) as e:
+                print(f"Erreur lors de l'extraction d'un article internet: {e}")
+                continue
+    return articles
+
+def parse_internet_amounts(text: str) -> Dict:
+    amounts = {'type_expedition': ""}
+
+    # Extraction total TTC et TVA
+    total_match = INTERNET_TOTAL_PATTERN.search(text)
+    if total_match:
+        amounts['total_ttc'] = convert_to_float(total_match.group(1))
+        amounts['tva'] = convert_to_float(total_match.group(2))
+        amounts['total_ht'] = amounts['total_ttc'] - amounts['tva']
+
+    # Extraction frais et type d'expédition
+    expedition_match = INTERNET_EXPEDITION_PATTERN.search(text)
+    if expedition_match:
+        if expedition_match.group(2):  # Si on a un montant
+            amounts['frais_expedition'] = convert_to_float(expedition_match.group(2))
+        # Combine les parties du type d'expédition (avant et après le montant)
+        type_expedition = ' '.join(filter(None, [
+            expedition_match.group(1),
+            expedition_match.group(3)
+        ])).strip()
+        if type_expedition:
+            amounts['type_expedition'] = type_expedition
+
+    return amounts
+
+def check_internet_amounts(invoice: Invoice, tolerance: float) -> List[str]:
+    """
+    Montants internet : le total HT est déduit (TTC - TVA) et les articles n'ont pas de
+    montant HT, seules les lignes recoupent le total :
+    somme des quantité x prix TTC des articles + frais d'expédition = total TTC
+    """
+    totals = invoice.totals
+    total_ttc = float(totals.total_ttc or 0)
+    lines_ttc = sum(float(article.quantite or 0) * float(article.prix_unitaire or 0)
+                    for article in invoice.articles)
+    expected = lines_ttc + float(totals.frais_expedition or 0)
+    # Un centime d'arrondi possible par ligne
+    if abs(expected - total_ttc) > tolerance + 0.01 * len(invoice.articles):
+        return [f"articles + expédition {expected:.2f} != TTC {total_ttc:.2f}"]
+    return []
+
+INTERNET_FORMAT = InvoiceFormat(
+    name='internet',
+    # UGS en majuscule, numéro/date de commande... indiquent une facture internet
+    markers=("UGS", "N° de commande", "Date de commande", "Livraison gratuite"),
+    field_patterns={
+        'numero_facture': r'N° de facture\s*:\s*([^\n]+)',
+        'date_facture': r'Date de facture\s*:\s*(\d{1,2}\s+\w+\s+\d{4})',
+        'date_commande': r'Date de commande\s*:\s*(\d{1,2}\s+\w+\s+\d{4})',
+        **COMMON_FIELD_PATTERNS,
+        'client_name': r'FACTURE\s*\n(?!.*?NOMADS)([^\n]+?)(?:\s*N°\s*(?:de\s*facture|de\s*commande)|Résidence|Date|$)',
+    },
+    # Si pas de numéro de facture, le numéro de commande
+    fallback_patterns={'numero_facture': r'N° de commande\s*:\s*(\d+)'},
+    parse_articles=parse_internet_articles,
+    parse_amounts=parse_internet_amounts,
+    defaults={'statut_paiement': "Payé", 'reglement': "carte bancaire"},
+    check_amounts=check_internet_amounts,
+    priority=10,
+)
+
+register_format(MEG_FORMAT, default=True)
+register_format(INTERNET_FORMAT)
@@ -0,0 +1,243 @@
+"""
+Test de charge de POST /analyze_pdfs/
+
+Exemples :
+    python loadtest.py --corpus data_factures --clients 4 --batch-size 5 --requests 40
+    python loadtest.py --url http://localhost:8000 --rate 2 --requests 100
+    python loadtest.py --compare loadtest_results/20250301-120000.json
+
+Sans --url, l'application est démarrée dans le processus sur un port libre, avec la détection
+des doublons entre lots et le cache d'analyse désactivés (--parse-cache pour le garder). Contre un
+serveur distant, le démarrer avec DEDUP_ACROSS_BATCHES=false et PARSE_CACHE_SIZE=0
+PARSE_CACHE_PATH= pour mesurer le traitement complet : le corpus rejoué en boucle serait sinon
+servi par le cache dès le deuxième passage.
+Les résultats sont enregistrés en JSON dans loadtest_results/ pour comparer les versions.
+"""
+import argparse
+import itertools
+import json
+import math
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+
+import requests
+
+RESULTS_DIR = Path("loadtest_results")
+ENDPOINT = "/analyze_pdfs/"
+
+def percentile(values, pct: float):
+    """Percentile au rang le plus proche (None si aucune valeur)"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = min(len(ordered), max(1, math.ceil(pct / 100 * len(ordered))))
+    return ordered[rank - 1]
+
+def start_in_process_server(parse_cache: bool = False) -> str:
+    """Démarre l'application dans un thread uvicorn et renvoie son URL"""
+    # Le corpus est rejoué en boucle : sans cela, l'index inter-lots écarterait tout en doublon
+    os.environ.setdefault("DEDUP_ACROSS_BATCHES", "false")
+    if not parse_cache:
+        # ... et le cache d'analyse servirait les passages suivants sans rien analyser
+        os.environ.setdefault("PARSE_CACHE_SIZE", "0")
+        os.environ.setdefault("PARSE_CACHE_PATH", "")
+
+    import uvicorn
+    from app import app
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, name="loadtest-server", daemon=True).start()
+
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            if requests.get(f"{url}/ready", timeout=1).status_code in (200, 503):
+                return url
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    raise RuntimeError("In-process server did not start")
+
+def load_corpus(corpus: Path):
+    paths = sorted(corpus.glob("*.pdf"))
+    if not paths:
+        raise SystemExit(f"Aucun PDF trouvé dans {corpus}")
+    return [(path.name, path.read_bytes()) for path in paths]
+
+def send_batch(url: str, batch, timeout: float) -> dict:
+    files = [("files", (name, content, "application/pdf")) for name, content in batch]
+    started = time.perf_counter()
+    try:
+        response = requests.post(f"{url}{ENDPOINT}", files=files, timeout=timeout)
+        status = response.status_code
+        error = None if response.ok else response.text[:200]
+    except requests.RequestException as e:
+        status, error = None, str(e)
+    return {"status": status, "error": error, "service_seconds": time.perf_counter() - started}
+
+def run(args) -> dict:
+    corpus = load_corpus(Path(args.corpus))
+    url = args.url.rstrip("/") if args.url else start_in_process_server(args.parse_cache)
+
+    # Lots construits en parcourant le corpus en boucle
+    files = itertools.cycle(corpus)
+    batches = [[next(files) for _ in range(args.batch_size)] for _ in range(args.requests)]
+
+    results = []
+    results_lock = threading.Lock()
+
+    def execute(batch, scheduled_at=None):
+        # Boucle ouverte : la latence part de l'arrivée prévue, l'attente d'un client libre est
+        # comptée. Boucle fermée : elle part de la prise en charge par un client, pas de la mise
+        # en file (tous les lots sont soumis d'emblée)
+        if scheduled_at is None:
+            scheduled_at = time.perf_counter()
+        outcome = send_batch(url, batch, args.timeout)
+        outcome["latency_seconds"] = time.perf_counter() - scheduled_at
+        with results_lock:
+            results.append(outcome)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.clients) as pool:
+        if args.rate > 0:
+            # Boucle ouverte : arrivées de Poisson au débit demandé
+            next_arrival = time.perf_counter()
+            for batch in batches:
+                next_arrival += random.expovariate(args.rate)
+                delay = next_arrival - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                pool.submit(execute, batch, next_arrival)
+        else:
+            # Boucle fermée : chaque client renvoie un lot dès la réponse précédente
+            for batch in batches:
+                pool.submit(execute, batch)
+    elapsed = time.perf_counter() - started
+
+    latencies = [r["latency_seconds"] for r in results]
+    service_times = [r["service_seconds"] for r in results]
+    errors = [r for r in results if r["status"] != 200]
+    status_counts = {}
+    for r in results:
+        status_counts[str(r["status"])] = status_counts.get(str(r["status"]), 0) + 1
+
+    return {
+        "label": args.label,
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "git_commit": _git_commit(),
+        "config": {
+            "url": args.url or "in-process",
+            "corpus_files": len(corpus),
+            "clients": args.clients,
+            "batch_size": args.batch_size,
+            "requests": args.requests,
+            "rate": args.rate,
+            # Cache d'analyse du serveur : inconnu pour un serveur distant
+            "parse_cache": _parse_cache_state() if not args.url else "unknown",
+        },
+        "elapsed_seconds": round(elapsed, 3),
+        "throughput_rps": round(len(results) / elapsed, 3) if elapsed else None,
+        "throughput_docs_per_s": round(len(results) * args.batch_size / elapsed, 3) if elapsed else None,
+        "latency_seconds": {
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+            "max": max(latencies) if latencies else None,
+        },
+        # Durée de la requête HTTP seule, sans attente côté client
+        "service_seconds": {
+            "p50": percentile(service_times, 50),
+            "p95": percentile(service_times, 95),
+            "p99": percentile(service_times, 99),
+        },
+        "error_rate": round(len(errors) / len(results), 4) if results else None,
+        "status_counts": status_counts,
+        "sample_errors": [e["error"] for e in errors[:5]],
+    }
+
+def _parse_cache_state() -> str:
+    """État du cache d'analyse de l'application démarrée dans le processus"""
+    from parse_cache import PARSE_CACHE_PATH, PARSE_CACHE_SIZE
+
+    if PARSE_CACHE_PATH:
+        return "persistent"
+    return "memory" if PARSE_CACHE_SIZE > 0 else "off"
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def print_report(report: dict, baseline: dict = None):
+    def line(name, value, base):
+        delta = ""
+        if isinstance(value, (int, float)) and isinstance(base, (int, float)) and base:
+            delta = f"  ({(value - base) / base * 100:+.1f}% vs baseline)"
+        print(f"  {name:<22}{value}{delta}")
+
+    base = baseline or {}
+    print(f"Load test {report.get('label') or ''} @ {report['timestamp']} ({report.get('git_commit')})")
+    print(f"  config                {report['config']}")
+    line("throughput (req/s)", report["throughput_rps"], base.get("throughput_rps"))
+    line("throughput (docs/s)", report["throughput_docs_per_s"], base.get("throughput_docs_per_s"))
+    for key in ("p50", "p95", "p99", "max"):
+        value = report["latency_seconds"][key]
+        line(f"latency {key} (s)", round(value, 3) if value is not None else None,
+             base.get("latency_seconds", {}).get(key))
+    for key in ("p50", "p95"):
+        value = report.get("service_seconds", {}).get(key)
+        line(f"service {key} (s)", round(value, 3) if value is not None else None,
+             base.get("service_seconds", {}).get(key))
+    line("error rate", report["error_rate"], base.get("error_rate"))
+    print(f"  status codes          {report['status_counts']}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Test de charge de POST /analyze_pdfs/")
+    parser.add_argument("--url", help="URL de l'API (par défaut : application démarrée dans le processus)")
+    parser.add_argument("--corpus", default="data_factures", help="Dossier de PDF à rejouer")
+    parser.add_argument("--clients", type=int, default=4, help="Clients simultanés")
+    parser.add_argument("--batch-size", type=int, default=5, help="PDF par requête")
+    parser.add_argument("--requests", type=int, default=20, help="Nombre total de requêtes")
+    parser.add_argument("--rate", type=float, default=0.0,
+                        help="Arrivées par seconde (0 : boucle fermée, au rythme des clients)")
+    parser.add_argument("--parse-cache", action="store_true",
+                        help="Garder le cache d'analyse de l'application démarrée dans le processus")
+    parser.add_argument("--timeout", type=float, default=600.0, help="Délai max par requête (s)")
+    parser.add_argument("--label", default="", help="Étiquette du run (ex. numéro de version)")
+    parser.add_argument("--output", default=str(RESULTS_DIR), help="Dossier des résultats")
+    parser.add_argument("--compare", help="Résultat JSON de référence à comparer")
+    args = parser.parse_args(argv)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+
+    report = run(args)
+
+    output_dir = Path(args.output)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    output_path = output_dir / f"{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
+    with open(output_path, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+    print_report(report, baseline)
+    print(f"Résultats enregistrés dans {output_path}")
+    return 0 if report["error_rate"] == 0 else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,203 @@
+"""
+Grand livre mensuel : un classeur courant par mois au lieu d'un classeur par lot
+
+Les lignes Excel (invoice_to_row) sont stockées dans SQLite, une par facture :
+- clé = N° Syst. (type + numéro de facture), sinon le fichier qui l'a produite
+- une facture déjà présente est remplacée à sa place d'origine, une nouvelle est ajoutée en fin
+- le mois est celui de la date de facture, sinon celui de la validation
+
+Valider un lot ne touche que ses propres lignes : le coût dépend de la taille du lot, pas de
+celle du grand livre. Le classeur d'un mois n'est régénéré qu'à la demande, et seulement s'il a
+changé depuis la dernière génération.
+
+Limite : la génération réécrit tout le classeur du mois, à partir de toutes ses lignes. Un .xlsx
+est une archive zip (feuilles XML, table des chaînes partagées) : ajouter ou remplacer des lignes
+oblige à réécrire l'archive, openpyxl compris. Son coût suit donc la taille du mois, mais il n'est
+payé qu'une fois par lecture, quel que soit le nombre de lots validés entre deux lectures.
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from aggregates import aggregate_key
+from create_invoice_excel import HEADERS, invoice_to_row
+from records import as_invoice, parse_invoice_date
+
+logger = logging.getLogger(__name__)
+
+# Base du grand livre (vide : mode grand livre désactivé)
+MONTHLY_LEDGER_PATH = os.getenv("MONTHLY_LEDGER_PATH", "")
+# Classeurs mensuels générés à la demande
+MONTHLY_LEDGER_DIR = Path(os.getenv("MONTHLY_LEDGER_DIR", "temp_files/ledger"))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS rows (
+    invoice_key TEXT PRIMARY KEY,
+    month TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    row TEXT NOT NULL,
+    job_id TEXT,
+    filename TEXT,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_rows_month_position ON rows (month, position);
+CREATE TABLE IF NOT EXISTS months (
+    month TEXT PRIMARY KEY,
+    next_position INTEGER NOT NULL,
+    row_count INTEGER NOT NULL,
+    version INTEGER NOT NULL,
+    written_version INTEGER NOT NULL
+);
+"""
+
+def ledger_month(invoice) -> str:
+    """Mois (YYYY-MM) de la facture, sinon le mois courant"""
+    date_facture = parse_invoice_date(invoice.date_facture)
+    return (date_facture or datetime.now()).strftime('%Y-%m')
+
+class MonthlyLedger:
+    def __init__(self, path=MONTHLY_LEDGER_PATH, directory: Path = MONTHLY_LEDGER_DIR):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(str(path), check_same_thread=False, timeout=30)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(SCHEMA)
+        self._db.commit()
+        self._lock = threading.Lock()
+        # Une génération à la fois par mois
+        self._write_locks: Dict[str, threading.Lock] = {}
+
+    def _touch_month(self, month: str, added: int = 0) -> int:
+        """Marque le mois comme modifié ; renvoie la position de la prochaine ligne ajoutée"""
+        self._db.execute(
+            "INSERT INTO months VALUES (?, 0, 0, 0, -1) ON CONFLICT DO NOTHING", (month,)
+        )
+        position = self._db.execute(
+            "SELECT next_position FROM months WHERE month = ?", (month,)
+        ).fetchone()[0]
+        self._db.execute(
+            """UPDATE months SET next_position = next_position + ?, row_count = row_count + ?,
+                   version = version + 1
+               WHERE month = ?""",
+            (max(added, 0), added, month)
+        )
+        return position
+
+    def commit_batch(self, job_id: str, invoices_data: Dict) -> Dict[str, int]:
+        """
+        Ajoute ou remplace les lignes d'un lot en une transaction
+        Renvoie le nombre de lignes ajoutées et remplacées
+        """
+        counts = {'appended': 0, 'replaced': 0}
+        now = time.time()
+        with self._lock, self._db:
+            for filename, entry in invoices_data.items():
+                invoice = as_invoice(entry)
+                try:
+                    row = invoice_to_row(invoice)
+                except Exception as e:
+                    logger.error(f"Ledger: cannot build row for {filename}: {str(e)}")
+                    continue
+                key = aggregate_key(invoice, job_id, filename)
+                month = ledger_month(invoice)
+                payload = json.dumps(row, ensure_ascii=False)
+                previous = self._db.execute(
+                    "SELECT month, position FROM rows WHERE invoice_key = ?", (key,)
+                ).fetchone()
+                if previous is not None and previous['month'] == month:
+                    # Remplacement sur place : la ligne garde sa position
+                    self._touch_month(month)
+                    self._db.execute(
+                        """UPDATE rows SET row = ?, job_id = ?, filename = ?, updated_at = ?
+                           WHERE invoice_key = ?""",
+                        (payload, job_id, filename, now, key)
+                    )
+                    counts['replaced'] += 1
+                    continue
+                if previous is not None:
+                    # Date de facture corrigée : la ligne change de mois
+                    self._touch_month(previous['month'], -1)
+                    self._db.execute("DELETE FROM rows WHERE invoice_key = ?", (key,))
+                    counts['replaced'] += 1
+                else:
+                    counts['appended'] += 1
+                position = self._touch_month(month, 1)
+                self._db.execute(
+                    "INSERT INTO rows VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (key, month, position, payload, job_id, filename, now)
+                )
+        return counts
+
+    def months(self) -> List[Dict]:
+        """Mois du grand livre, avec leur nombre de lignes et l'état de leur classeur"""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT month, row_count, version, written_version FROM months ORDER BY month"
+            ).fetchall()
+        return [{'month': row['month'], 'rows': row['row_count'],
+                 'up_to_date': row['version'] == row['written_version']
+                 and self.workbook_path(row['month']).exists()}
+                for row in rows]
+
+    def workbook_path(self, month: str) -> Path:
+        return self.directory / f"grand_livre_{month}.xlsx"
+
+    def materialize(self, month: str) -> Optional[Path]:
+        """
+        Classeur du mois, régénéré en entier seulement s'il a changé (remplacement atomique)
+        None si le mois est inconnu
+        """
+        import pandas as pd
+        from create_invoice_excel import write_workbook
+
+        with self._lock:
+            write_lock = self._write_locks.setdefault(month, threading.Lock())
+        with write_lock:
+            with self._lock:
+                state = self._db.execute(
+                    "SELECT version, written_version FROM months WHERE month = ?", (month,)
+                ).fetchone()
+                if state is None:
+                    return None
+                path = self.workbook_path(month)
+                if state['version'] == state['written_version'] and path.exists():
+                    return path
+                version = state['version']
+                rows = [json.loads(row[0]) for row in self._db.execute(
+                    "SELECT row FROM rows WHERE month = ? ORDER BY position", (month,)
+                )]
+
+            df = pd.DataFrame(rows, columns=HEADERS)
+            # pandas choisit le format d'après l'extension : le fichier temporaire garde .xlsx
+            tmp_path = path.with_suffix('.tmp.xlsx')
+            write_workbook(df, str(tmp_path))
+            os.replace(tmp_path, path)
+            with self._lock, self._db:
+                self._db.execute(
+                    "UPDATE months SET written_version = ? WHERE month = ? AND written_version < ?",
+                    (version, month, version)
+                )
+            logger.info(f"Ledger workbook written: {path} ({len(rows)} row(s))")
+            return path
+
+_monthly_ledger: Optional[MonthlyLedger] = None
+_monthly_ledger_lock = threading.Lock()
+
+def get_monthly_ledger() -> Optional[MonthlyLedger]:
+    """Grand livre partagé du processus (None si MONTHLY_LEDGER_PATH est vide)"""
+    global _monthly_ledger
+    if not MONTHLY_LEDGER_PATH:
+        return None
+    if _monthly_ledger is None:
+        with _monthly_ledger_lock:
+            if _monthly_ledger is None:
+                _monthly_ledger = MonthlyLedger()
+    return _monthly_ledger
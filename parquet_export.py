@@ -0,0 +1,173 @@
+import json
+import sys
+import uuid
+from datetime import date, datetime
+from pathlib import Path
+
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+from records import as_invoice, parse_invoice_date
+
+# Schémas des deux jeux de données (en-têtes de factures et lignes d'articles)
+INVOICE_SCHEMA = pa.schema([
+    ('fichier', pa.string()),
+    ('numero_facture', pa.string()),
+    ('numero_client', pa.string()),
+    ('client_name', pa.string()),
+    ('Type_Vente', pa.string()),
+    ('Réseau_Vente', pa.string()),
+    ('date_facture', pa.date32()),
+    ('date_commande', pa.date32()),
+    ('total_ht', pa.float64()),
+    ('tva', pa.float64()),
+    ('total_ttc', pa.float64()),
+    ('frais_expedition', pa.float64()),
+    ('remise', pa.float64()),
+    ('nombre_articles', pa.float64()),
+    ('statut_paiement', pa.string()),
+    ('commentaire', pa.string()),
+    ('batch_id', pa.string()),
+    ('month', pa.string()),
+    ('Syst', pa.string()),
+])
+
+ARTICLE_SCHEMA = pa.schema([
+    ('fichier', pa.string()),
+    ('numero_facture', pa.string()),
+    ('ligne', pa.int32()),
+    ('reference', pa.string()),
+    ('description', pa.string()),
+    ('quantite', pa.float64()),
+    ('prix_unitaire', pa.float64()),
+    ('remise', pa.float64()),
+    ('montant_ht', pa.float64()),
+    ('tva', pa.float64()),
+    ('batch_id', pa.string()),
+    ('month', pa.string()),
+    ('Syst', pa.string()),
+])
+
+PARTITION_COLUMNS = ['month', 'Syst']
+
+def _to_float(value):
+    """Convertit une valeur numérique éventuellement vide en float (None si vide)"""
+    if value in (None, ''):
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+def build_tables(invoices_data, batch_id: str):
+    """Construit les tables Arrow des en-têtes et des articles"""
+    invoice_rows = {name: [] for name in INVOICE_SCHEMA.names}
+    article_rows = {name: [] for name in ARTICLE_SCHEMA.names}
+
+    for filename, entry in invoices_data.items():
+        invoice = as_invoice(entry)
+        totals = invoice.totals
+        syst = 'MEG' if invoice.type == 'meg' else 'Internet'
+        date_facture = parse_invoice_date(invoice.date_facture)
+        month = date_facture.strftime('%Y-%m') if isinstance(date_facture, date) else None
+
+        header = {
+            'fichier': filename,
+            'numero_facture': invoice.numero_facture,
+            'numero_client': invoice.numero_client,
+            'client_name': invoice.client_name,
+            'Type_Vente': invoice.type_vente,
+            'Réseau_Vente': invoice.reseau_vente,
+            'date_facture': date_facture,
+            'date_commande': parse_invoice_date(invoice.date_commande),
+            'total_ht': _to_float(totals.total_ht),
+            'tva': _to_float(totals.tva),
+            'total_ttc': _to_float(totals.total_ttc),
+            'frais_expedition': _to_float(totals.frais_expedition),
+            'remise': _to_float(totals.remise),
+            'nombre_articles': _to_float(invoice.nombre_articles),
+            'statut_paiement': invoice.statut_paiement,
+            'commentaire': invoice.commentaire,
+            'batch_id': batch_id,
+            'month': month,
+            'Syst': syst,
+        }
+        for name, value in header.items():
+            invoice_rows[name].append(value)
+
+        for line, article in enumerate(invoice.articles, 1):
+            row = {
+                'fichier': filename,
+                'numero_facture': invoice.numero_facture,
+                'ligne': line,
+                'reference': article.reference,
+                'description': article.description,
+                'quantite': _to_float(article.quantite),
+                'prix_unitaire': _to_float(article.prix_unitaire),
+                'remise': _to_float(article.remise),
+                'montant_ht': _to_float(article.montant_ht),
+                'tva': _to_float(article.tva),
+                'batch_id': batch_id,
+                'month': month,
+                'Syst': syst,
+            }
+            for name, value in row.items():
+                article_rows[name].append(value)
+
+    invoices = pa.Table.from_pydict(invoice_rows, schema=INVOICE_SCHEMA)
+    articles = pa.Table.from_pydict(article_rows, schema=ARTICLE_SCHEMA)
+    return invoices, articles
+
+def _write_partitioned(table, base_dir: Path, batch_id: str):
+    """Ajoute une table au jeu de données partitionné sans réécrire l'existant"""
+    if table.num_rows == 0:
+        return
+    partitioning = ds.partitioning(
+        pa.schema([table.schema.field(name) for name in PARTITION_COLUMNS]),
+        flavor='hive'
+    )
+    ds.write_dataset(
+        table,
+        base_dir,
+        format='parquet',
+        partitioning=partitioning,
+        # Un nom de fichier unique par lot : les partitions existantes ne sont jamais réécrites
+        basename_template=f'part-{batch_id}-{{i}}.parquet',
+        existing_data_behavior='overwrite_or_ignore',
+    )
+
+def export_parquet(invoices_data, output_dir, batch_id: str = None) -> dict:
+    """
+    Exporte les factures en deux jeux de données Parquet partitionnés par mois et Syst :
+    <output_dir>/invoices et <output_dir>/articles
+    """
+    output_dir = Path(output_dir)
+    batch_id = batch_id or f"{datetime.now().strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8]}"
+
+    invoices, articles = build_tables(invoices_data, batch_id)
+    _write_partitioned(invoices, output_dir / 'invoices', batch_id)
+    _write_partitioned(articles, output_dir / 'articles', batch_id)
+
+    return {
+        'batch_id': batch_id,
+        'invoices': invoices.num_rows,
+        'articles': articles.num_rows,
+    }
+
+def main():
+    """Exporte un fichier factures.json existant en Parquet"""
+    json_path = Path(sys.argv[1]) if len(sys.argv) > 1 else Path('factures.json')
+    output_dir = Path(sys.argv[2]) if len(sys.argv) > 2 else Path('parquet')
+    try:
+        with open(json_path, 'r', encoding='utf-8') as f:
+            invoices_data = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError) as e:
+        print(f"Erreur lors de la lecture de {json_path}: {str(e)}")
+        return
+
+    result = export_parquet(invoices_data, output_dir)
+    print(f"Export Parquet terminé : {result['invoices']} factures, "
+          f"{result['articles']} articles (lot {result['batch_id']})")
+
+if __name__ == "__main__":
+    main()
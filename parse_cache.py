@@ -0,0 +1,440 @@
+"""
+Mémoïsation versionnée des résultats d'InvoiceExtractor
+
+Clé : empreinte SHA-256 du texte + empreinte du format détecté. L'empreinte d'un format couvre
+ses marqueurs, ses patterns, ses valeurs par défaut et le code de ses analyseurs (avec les
+fonctions, regex et constantes qu'ils référencent), ainsi que la partie commune : source de
+billing_extractor.py (PARSER_VERSION incluse) et de records.py.
+Modifier un pattern MEG n'invalide donc que les factures MEG.
+
+Deux niveaux : un LRU en mémoire par processus, puis une base SQLite partagée, bornée à
+PARSE_CACHE_MAX_ROWS résultats et écrite par paquets. Elle ne conserve les textes (compressés,
+pour pouvoir tout réanalyser) qu'avec KEEP_RAW_TEXT=true. Avec un stockage d'artefacts
+(ARTIFACT_STORE_URL), les résultats y sont aussi publiés et partagés entre réplicas.
+    python parse_cache.py reparse                  # réanalyse les textes dont l'empreinte a changé
+    python parse_cache.py reparse factures.json    # idem pour les factures avec texte brut
+    python parse_cache.py prune                    # supprime les résultats obsolètes
+"""
+import argparse
+import atexit
+import hashlib
+import inspect
+import json
+import logging
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+import billing_extractor
+import invoice_formats
+import records
+from artifact_store import get_artifact_store, get_json, parse_key, put_json
+from invoice_formats import InvoiceFormat, detect_format, registered_formats
+from records import Invoice, dump_invoices, load_invoices
+
+logger = logging.getLogger(__name__)
+
+# Entrées conservées en mémoire par processus (0 : niveau mémoire désactivé)
+PARSE_CACHE_SIZE = int(os.getenv("PARSE_CACHE_SIZE", "2048"))
+# Base persistante (vide : niveau persistant désactivé)
+PARSE_CACHE_PATH = os.getenv("PARSE_CACHE_PATH", "temp_files/parse_cache.sqlite")
+# Résultats conservés dans la base persistante (les plus anciens sont supprimés au-delà)
+PARSE_CACHE_MAX_ROWS = int(os.getenv("PARSE_CACHE_MAX_ROWS", "50000"))
+# Résultats accumulés en mémoire avant une écriture groupée dans la base
+PARSE_CACHE_FLUSH_SIZE = int(os.getenv("PARSE_CACHE_FLUSH_SIZE", "32"))
+# Textes bruts conservés dans la base pour `reparse` (même réglage que pour factures.json)
+KEEP_RAW_TEXT = os.getenv("KEEP_RAW_TEXT", "false").lower() in ("1", "true", "yes")
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+# Modules dont le code détermine le résultat d'une analyse
+_PARSER_MODULES = ('billing_extractor', 'invoice_formats', 'records')
+# Valeurs globales prises en compte telles quelles dans les empreintes
+_CONSTANT_TYPES = (str, bytes, int, float, bool, tuple, list, dict, set, frozenset)
+
+def _value_fingerprint(value) -> str:
+    """Représentation stable d'une constante (ensembles triés : leur ordre varie d'un processus à l'autre)"""
+    if isinstance(value, re.Pattern):
+        return f"{value.pattern!r}/{value.flags}"
+    if isinstance(value, (set, frozenset)):
+        return repr(sorted(value, key=repr))
+    if isinstance(value, dict):
+        return json.dumps(value, sort_keys=True, ensure_ascii=False, default=repr)
+    return repr(value)
+
+def _is_constant(name: str, value) -> bool:
+    """
+    Regex ou constante de module (nom en majuscules) ; les états internes (_detector, _registry...)
+    changent pendant l'exécution et ne sont pas pris en compte
+    """
+    if isinstance(value, re.Pattern):
+        return True
+    return name.isupper() and isinstance(value, _CONSTANT_TYPES)
+
+def _code_objects(code):
+    """Code d'une fonction et de ses fonctions imbriquées (lambdas, fonctions locales)"""
+    yield code
+    for const in code.co_consts:
+        if inspect.iscode(const):
+            yield from _code_objects(const)
+
+def _code_fingerprint(func, seen=None) -> str:
+    """
+    Source d'une fonction et, récursivement, des globales qu'elle référence : fonctions du
+    projet (convert_to_float...), regex et constantes (INTERNET_IGNORE_STARTS, WHOLE_MATCH_FIELDS...)
+    """
+    if func is None:
+        return ''
+    func = getattr(func, '__func__', func)
+    seen = set() if seen is None else seen
+    if id(func) in seen:
+        return ''
+    seen.add(id(func))
+    try:
+        parts = [inspect.getsource(func)]
+    except (OSError, TypeError):
+        code = getattr(func, '__code__', None)
+        parts = [code.co_code.hex() if code else repr(func)]
+    code = getattr(func, '__code__', None)
+    if code is None:
+        return '\n'.join(parts)
+    names = sorted({name for nested in _code_objects(code) for name in nested.co_names})
+    for name in names:
+        if name not in func.__globals__:
+            continue
+        value = func.__globals__[name]
+        if inspect.isfunction(value) and value.__module__ in _PARSER_MODULES:
+            parts.append(f"{name}:{_code_fingerprint(value, seen)}")
+        elif _is_constant(name, value):
+            parts.append(f"{name}={_value_fingerprint(value)}")
+    return '\n'.join(parts)
+
+def _common_fingerprint() -> str:
+    """
+    Partie commune : version, source complète de l'extracteur et des enregistrements, ce que
+    l'extracteur importe des formats, détection (marqueurs de tous les formats)
+    """
+    parts = [f"version={billing_extractor.PARSER_VERSION}"]
+    for module in (billing_extractor, records):
+        parts.append(inspect.getsource(module))
+    for name, value in sorted(vars(billing_extractor).items()):
+        if getattr(invoice_formats, name, None) is not value or name.startswith('__'):
+            continue
+        if inspect.isfunction(value):
+            parts.append(f"{name}:{_code_fingerprint(value)}")
+        elif _is_constant(name, value):
+            parts.append(f"{name}={_value_fingerprint(value)}")
+    for invoice_format in registered_formats():
+        parts.append(f"{invoice_format.name}:{invoice_format.priority}:{invoice_format.markers!r}")
+    return '\n'.join(parts)
+
+def format_fingerprint(invoice_format: InvoiceFormat, common: Optional[str] = None) -> str:
+    """Empreinte d'un format : change dès qu'un élément de son analyse change"""
+    parts = [
+        common if common is not None else _common_fingerprint(),
+        invoice_format.name,
+        json.dumps(invoice_format.field_patterns, sort_keys=True, ensure_ascii=False),
+        json.dumps(invoice_format.fallback_patterns, sort_keys=True, ensure_ascii=False),
+        json.dumps(invoice_format.defaults, sort_keys=True, ensure_ascii=False),
+        _code_fingerprint(invoice_format.parse_articles),
+        _code_fingerprint(invoice_format.parse_amounts),
+        _code_fingerprint(invoice_format.normalize),
+    ]
+    return hashlib.sha256('\n'.join(parts).encode('utf-8')).hexdigest()[:32]
+
+def current_fingerprints() -> Dict[str, str]:
+    common = _common_fingerprint()
+    return {f.name: format_fingerprint(f, common) for f in registered_formats()}
+
+class ParseCache:
+    """Cache des résultats d'analyse : LRU en mémoire puis SQLite"""
+
+    def __init__(self, path: Optional[str] = PARSE_CACHE_PATH, max_entries: int = PARSE_CACHE_SIZE,
+                 keep_texts: bool = KEEP_RAW_TEXT, max_rows: int = PARSE_CACHE_MAX_ROWS,
+                 flush_size: int = PARSE_CACHE_FLUSH_SIZE):
+        self.max_entries = max_entries
+        self.keep_texts = keep_texts
+        self.max_rows = max_rows
+        self.flush_size = flush_size
+        self.fingerprints = current_fingerprints()
+        self._memory: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        # Résultats pas encore écrits dans la base, par (empreinte du texte, empreinte du format)
+        self._pending: Dict[Tuple[str, str], Tuple] = {}
+        # Les écritures groupées ne bloquent pas les consultations du niveau mémoire
+        self._db_lock = threading.Lock()
+        self.hits = 0
+        self.persistent_hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self._db = None
+        if path:
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.executescript("""
+                CREATE TABLE IF NOT EXISTS texts (
+                    text_hash TEXT PRIMARY KEY,
+                    text BLOB NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS results (
+                    text_hash TEXT NOT NULL,
+                    fingerprint TEXT NOT NULL,
+                    format TEXT NOT NULL,
+                    invoice TEXT NOT NULL,
+                    created REAL NOT NULL,
+                    PRIMARY KEY (text_hash, fingerprint)
+                );
+                CREATE INDEX IF NOT EXISTS idx_results_created ON results (created);
+            """)
+            self._db.commit()
+
+    def _remember(self, key, invoice_dict: Dict):
+        if self.max_entries <= 0:
+            return
+        self._memory[key] = invoice_dict
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def lookup(self, digest: str, fingerprint: str) -> Optional[Dict]:
+        key = (digest, fingerprint)
+        with self._lock:
+            invoice_dict = self._memory.get(key)
+            if invoice_dict is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return invoice_dict
+            pending = self._pending.get(key)
+            if pending is not None:
+                self.hits += 1
+                return json.loads(pending[3])
+        if self._db is not None:
+            with self._db_lock:
+                row = self._db.execute(
+                    "SELECT invoice FROM results WHERE text_hash = ? AND fingerprint = ?", key
+                ).fetchone()
+            if row is not None:
+                invoice_dict = json.loads(row[0])
+                with self._lock:
+                    self._remember(key, invoice_dict)
+                    self.persistent_hits += 1
+                return invoice_dict
+        invoice_dict = self._lookup_shared(digest, fingerprint)
+        with self._lock:
+            if invoice_dict is not None:
+                self._remember(key, invoice_dict)
+                self.shared_hits += 1
+                return invoice_dict
+            self.misses += 1
+            return None
+
+    def _lookup_shared(self, digest: str, fingerprint: str) -> Optional[Dict]:
+        """Résultat publié par un autre réplica (hors verrou : accès réseau possible)"""
+        store = get_artifact_store()
+        if store is None:
+            return None
+        try:
+            return get_json(store, parse_key(fingerprint, digest))
+        except Exception as e:
+            logger.warning(f"Artifact store lookup failed: {str(e)}")
+            return None
+
+    def store(self, digest: str, fingerprint: str, format_name: str, text: str, invoice: Invoice):
+        invoice_dict = invoice.to_dict()
+        flush = False
+        with self._lock:
+            self._remember((digest, fingerprint), invoice_dict)
+            if self._db is not None:
+                self._pending[(digest, fingerprint)] = (
+                    digest, fingerprint, format_name, json.dumps(invoice_dict, ensure_ascii=False),
+                    time.time(), zlib.compress(text.encode('utf-8')) if self.keep_texts else None,
+                )
+                flush = len(self._pending) >= self.flush_size
+        if flush:
+            self.flush()
+        store = get_artifact_store()
+        if store is not None:
+            try:
+                put_json(store, parse_key(fingerprint, digest), invoice_dict, overwrite=False)
+            except Exception as e:
+                logger.warning(f"Cannot publish parse result: {str(e)}")
+
+    def flush(self):
+        """Écrit en une transaction les résultats en attente, puis borne la base"""
+        if self._db is None:
+            return
+        with self._lock:
+            pending: List[Tuple] = list(self._pending.values())
+            self._pending.clear()
+        if not pending:
+            return
+        with self._db_lock, self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)",
+                [entry[:5] for entry in pending],
+            )
+            self._db.executemany(
+                "INSERT OR IGNORE INTO texts (text_hash, text) VALUES (?, ?)",
+                [(entry[0], entry[5]) for entry in pending if entry[5] is not None],
+            )
+            self._trim()
+
+    def _trim(self):
+        """Supprime les résultats les plus anciens au-delà de max_rows (sous self._db_lock)"""
+        if self.max_rows <= 0:
+            return
+        cutoff = self._db.execute(
+            "SELECT created FROM results ORDER BY created DESC LIMIT 1 OFFSET ?", (self.max_rows,)
+        ).fetchone()
+        if cutoff is None:
+            return
+        self._db.execute("DELETE FROM results WHERE created <= ?", (cutoff[0],))
+        self._delete_orphan_texts()
+
+    def _delete_orphan_texts(self):
+        self._db.execute(
+            "DELETE FROM texts WHERE text_hash NOT IN (SELECT text_hash FROM results)"
+        )
+
+    def get_or_parse(self, text: str, parse: Callable[..., Invoice]) -> Invoice:
+        """Résultat en cache pour ce texte et l'empreinte de son format, sinon parse(text, format)"""
+        invoice_format = detect_format(text)
+        fingerprint = self.fingerprints[invoice_format.name]
+        digest = text_hash(text)
+
+        invoice_dict = self.lookup(digest, fingerprint)
+        if invoice_dict is not None:
+            # Nouvel objet à chaque appel : les appelants modifient la facture
+            return Invoice.from_dict(invoice_dict)
+
+        invoice = parse(text, invoice_format)
+        self.store(digest, fingerprint, invoice_format.name, text, invoice)
+        return invoice
+
+    def stats(self) -> Dict:
+        with self._lock:
+            found = self.hits + self.persistent_hits + self.shared_hits
+            lookups = found + self.misses
+            return {
+                'memory_entries': len(self._memory),
+                'memory_hits': self.hits,
+                'persistent_hits': self.persistent_hits,
+                'shared_hits': self.shared_hits,
+                'misses': self.misses,
+                'hit_rate': round(found / lookups, 4) if lookups else None,
+            }
+
+    def stored_texts(self):
+        """Textes conservés dans la base persistante"""
+        if self._db is None:
+            return
+        with self._db_lock:
+            rows = self._db.execute("SELECT text_hash, text FROM texts").fetchall()
+        for digest, blob in rows:
+            yield digest, zlib.decompress(blob).decode('utf-8')
+
+    def prune(self) -> int:
+        """Supprime les résultats dont l'empreinte n'est plus celle d'un format courant"""
+        if self._db is None:
+            return 0
+        self.flush()
+        current = list(self.fingerprints.values())
+        placeholders = ','.join('?' * len(current))
+        with self._db_lock, self._db:
+            cursor = self._db.execute(
+                f"DELETE FROM results WHERE fingerprint NOT IN ({placeholders})", current
+            )
+            self._delete_orphan_texts()
+        return cursor.rowcount
+
+_parse_cache: Optional[ParseCache] = None
+_parse_cache_lock = threading.Lock()
+
+def get_parse_cache() -> Optional[ParseCache]:
+    """Cache partagé du processus (None si les deux niveaux sont désactivés)"""
+    global _parse_cache
+    if PARSE_CACHE_SIZE <= 0 and not PARSE_CACHE_PATH:
+        return None
+    if _parse_cache is None:
+        with _parse_cache_lock:
+            if _parse_cache is None:
+                _parse_cache = ParseCache()
+                # Résultats en attente écrits à l'arrêt du processus
+                atexit.register(_parse_cache.flush)
+    return _parse_cache
+
+def reparse(cache: ParseCache, json_paths=()) -> Dict:
+    """
+    Réanalyse en masse : seuls les textes dont l'empreinte de format a changé sont analysés
+    Sans fichier, parcourt les textes de la base ; sinon réécrit chaque factures.json (texte brut requis)
+    """
+    extractor = billing_extractor.InvoiceExtractor(cache=cache)
+    counts = {'unchanged': 0, 'reparsed': 0, 'without_text': 0}
+
+    def run(text: str) -> Invoice:
+        before = cache.misses
+        invoice = extractor.extract_invoice(text)
+        counts['reparsed' if cache.misses > before else 'unchanged'] += 1
+        return invoice
+
+    if not json_paths:
+        for _, text in cache.stored_texts():
+            run(text)
+        cache.flush()
+        return counts
+
+    for json_path in json_paths:
+        with open(json_path, 'r', encoding='utf-8') as f:
+            invoices = load_invoices(f)
+        for filename, invoice in invoices.items():
+            if invoice.text is None:
+                counts['without_text'] += 1
+                continue
+            updated = run(invoice.text)
+            updated.nombre_articles = updated.total_quantity()
+            updated.extraction_tier = invoice.extraction_tier
+            updated.text = invoice.text
+            invoices[filename] = updated
+        tmp_path = f"{json_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            dump_invoices(invoices, f)
+        os.replace(tmp_path, json_path)
+    cache.flush()
+    return counts
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Cache des résultats d'analyse des factures")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    reparse_parser = subparsers.add_parser("reparse", help="Réanalyse ce qui a changé")
+    reparse_parser.add_argument("json_files", nargs="*", help="factures.json avec texte brut (KEEP_RAW_TEXT)")
+    reparse_parser.add_argument("--prune", action="store_true", help="Supprime ensuite les résultats obsolètes")
+    subparsers.add_parser("prune", help="Supprime les résultats obsolètes")
+    args = parser.parse_args(argv)
+
+    if not PARSE_CACHE_PATH:
+        print("PARSE_CACHE_PATH est vide : pas de base persistante")
+        return 1
+    cache = ParseCache()
+    print(f"Empreintes courantes : {cache.fingerprints}")
+
+    if args.command == "reparse":
+        if not args.json_files and not cache.keep_texts:
+            print("KEEP_RAW_TEXT=false : seuls les textes conservés auparavant sont réanalysés")
+        counts = reparse(cache, args.json_files)
+        print(f"Inchangées : {counts['unchanged']}, réanalysées : {counts['reparsed']}"
+              + (f", sans texte brut : {counts['without_text']}" if args.json_files else ""))
+    if args.command == "prune" or getattr(args, "prune", False):
+        print(f"Résultats obsolètes supprimés : {cache.prune()}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
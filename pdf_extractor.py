@@ -1,23 +1,91 @@
-import pdfplumber
-from typing import Dict, Optional
+from typing import Dict, List, Optional
+
+def _table_cells(table, words, y_tolerance) -> List[List[Optional[str]]]:
+    """
+    Contenu des cellules d'une table, comme table.extract : un mot appartient à la cellule
+    qui contient son centre, les mots d'une cellule sont regroupés en lignes
+    """
+    from pdfplumber.utils import cluster_objects
+
+    rows = []
+    for row in table.rows:
+        cells = []
+        for bbox in row.cells:
+            if bbox is None:
+                cells.append(None)
+                continue
+            x0, top, x1, bottom = bbox
+            inside = [
+                word for word in words
+                if x0 <= (word['x0'] + word['x1']) / 2 < x1
+                and top <= (word['top'] + word['bottom']) / 2 < bottom
+            ]
+            lines = cluster_objects(inside, 'top', y_tolerance)
+            cells.append("\n".join(
+                " ".join(word['text'] for word in sorted(line, key=lambda word: word['x0']))
+                for line in lines
+            ))
+        rows.append(cells)
+    return rows
+
+def _analyse_page(page, include_tables: bool = True, text_options: Optional[Dict] = None):
+    """
+    Texte et tables d'une page, tirés d'un seul regroupement des caractères en mots
+    Le texte est celui de page.extract_text avec les mêmes réglages. Les cellules des tables
+    sont remplies avec ces mêmes mots ; la recherche des cadres (regroupement des traits)
+    n'est lancée que si la page contient des traits, sans lesquels aucune table n'existe.
+    """
+    from pdfplumber.utils.text import TEXTMAP_KWARGS, WORD_EXTRACTOR_KWARGS, WordExtractor
+
+    # Mêmes valeurs par défaut que page.extract_text
+    options = {'layout_bbox': page.bbox}
+    text_options = text_options or {}
+    if 'layout_width_chars' not in text_options:
+        options['layout_width'] = page.width
+    if 'layout_height_chars' not in text_options:
+        options['layout_height'] = page.height
+    options.update(text_options, presorted=True)
+
+    extractor = WordExtractor(**{k: v for k, v in options.items() if k in WORD_EXTRACTOR_KWARGS})
+    wordmap = extractor.extract_wordmap(page.chars)
+    text = wordmap.to_textmap(**{k: v for k, v in options.items() if k in TEXTMAP_KWARGS}).as_string
+
+    tables = []
+    if include_tables and page.edges:
+        words = [word for word, _ in wordmap.tuples]
+        tables = [_table_cells(table, words, extractor.y_tolerance) for table in page.find_tables()]
+    return text, tables
+
+def extract_text_from_pdf(pdf_path: str, include_tables: bool = True,
+                          text_options: Optional[Dict] = None) -> Optional[Dict]:
+    """
+    Extrait le texte et les tables d'un PDF en utilisant pdfplumber
+    include_tables=False : texte seul, pour les appelants qui n'exploitent pas les tables
+    text_options : paramètres de page.extract_text (tolérances, use_text_flow...)
+    """
+    # Import différé : pdfplumber/pdfminer ne sont chargés qu'à la première extraction
+    import pdfplumber
+
+    import font_cache
 
-def extract_text_from_pdf(pdf_path: str) -> Optional[Dict]:
-    """Extrait le texte et les tables d'un PDF en utilisant pdfplumber"""
     try:
         with pdfplumber.open(pdf_path) as pdf:
+            # Polices partagées entre les documents traités par ce worker
+            rsrcmgr = font_cache.install(pdf)
+
             # Initialisation des données
             text = ""
             tables = []
 
             # Extraction page par page
             for page in pdf.pages:
-                # Extraction du texte
-                text += page.extract_text() or ""
+                # Texte et tables issus de la même analyse de la page
+                page_text, page_tables = _analyse_page(page, include_tables, text_options)
+                text += page_text
+                tables.extend(page_tables)
 
-                # Extraction des tables
-                page_tables = page.extract_tables()
-                if page_tables:
-                    tables.extend(page_tables)
+                # Libère les objets de la page une fois exploités
+                page.close()
 
             # Construction du résultat
             result = {
@@ -31,9 +99,39 @@ def extract_text_from_pdf(pdf_path: str) -> Optional[Dict]:
             # Si des tables ont été trouvées, les ajouter au résultat
             if tables:
                 result['tables'] = tables
+            if rsrcmgr is not None:
+                result['font_cache'] = rsrcmgr.stats()
 
             return result
 
     except Exception as e:
         print(f"Erreur lors de l'extraction du PDF {pdf_path}: {str(e)}")
         return None
+
+def ocr_text_from_pdf(pdf_path: str, resolution: int = 300, lang: str = "fra") -> Optional[str]:
+    """
+    Texte d'un PDF par OCR (pytesseract) sur le rendu de chaque page
+    None si l'OCR n'est pas disponible (pytesseract ou binaire tesseract absent)
+    """
+    import pdfplumber
+
+    try:
+        import pytesseract
+    except ImportError:
+        print("OCR indisponible : pytesseract n'est pas installé")
+        return None
+
+    try:
+        texts = []
+        with pdfplumber.open(pdf_path) as pdf:
+            for page in pdf.pages:
+                image = page.to_image(resolution=resolution).original
+                texts.append(pytesseract.image_to_string(image, lang=lang))
+                page.close()
+        return "\n".join(texts)
+    except pytesseract.TesseractNotFoundError:
+        print("OCR indisponible : binaire tesseract introuvable")
+        return None
+    except Exception as e:
+        print(f"Erreur lors de l'OCR du PDF {pdf_path}: {str(e)}")
+        return None
@@ -0,0 +1,308 @@
+import cProfile
+import json
+import logging
+import os
+import pstats
+import resource
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Profilage de toutes les requêtes (sinon uniquement celles portant l'en-tête X-Profile: 1)
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "false").lower() in ("1", "true", "yes")
+PROFILE_HEADER = "X-Profile"
+PROFILES_DIR = Path(os.getenv("PROFILES_DIR", "temp_files/profiles"))
+# Nombre de profils conservés (les plus anciens sont supprimés)
+PROFILE_RING_SIZE = int(os.getenv("PROFILE_RING_SIZE", "50"))
+# Nombre de fonctions les plus coûteuses retenues par étape dans le résumé
+PROFILE_TOP_FUNCTIONS = 15
+
+# Mesure mémoire (tracemalloc) de toutes les requêtes, sinon celles portant X-Profile-Memory: 1
+MEMORY_PROFILING_ENABLED = os.getenv("MEMORY_PROFILING_ENABLED", "false").lower() in ("1", "true", "yes")
+MEMORY_HEADER = "X-Profile-Memory"
+# Profondeur de pile enregistrée par allocation et nombre de sites retenus par étape
+MEMORY_TRACE_FRAMES = int(os.getenv("MEMORY_TRACE_FRAMES", "5"))
+MEMORY_TOP_SITES = 10
+
+# cProfile ne supporte qu'un profileur actif à la fois dans le processus :
+# une étape concurrente est alors seulement chronométrée.
+_cprofile_lock = threading.Lock()
+
+# Même contrainte pour le pic tracemalloc, global au processus : une seule étape mesurée à la fois.
+# Les allocations des autres threads pendant une étape y sont comptées : les chiffres sont exacts
+# quand les requêtes mesurées ne se chevauchent pas.
+_memory_lock = threading.Lock()
+_tracing_lock = threading.Lock()
+_tracing_users = 0
+_tracing_owned = False
+
+def profiling_requested(headers) -> bool:
+    return PROFILING_ENABLED or headers.get(PROFILE_HEADER, "").lower() in ("1", "true", "yes")
+
+def memory_requested(headers) -> bool:
+    return MEMORY_PROFILING_ENABLED or headers.get(MEMORY_HEADER, "").lower() in ("1", "true", "yes")
+
+def _start_tracing():
+    """tracemalloc actif tant qu'au moins une requête mesure sa mémoire"""
+    global _tracing_users, _tracing_owned
+    with _tracing_lock:
+        if _tracing_users == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start(MEMORY_TRACE_FRAMES)
+            _tracing_owned = True
+        _tracing_users += 1
+
+def _stop_tracing():
+    """Arrête tracemalloc à la dernière requête, sauf s'il a été démarré ailleurs (PYTHONTRACEMALLOC)"""
+    global _tracing_users, _tracing_owned
+    with _tracing_lock:
+        _tracing_users = max(0, _tracing_users - 1)
+        if _tracing_users == 0 and _tracing_owned:
+            tracemalloc.stop()
+            _tracing_owned = False
+
+def memory_status() -> Dict:
+    """État de la mesure mémoire du processus"""
+    status = {'tracing': tracemalloc.is_tracing(), 'active_requests': _tracing_users,
+              'max_rss_bytes': max_rss_bytes()}
+    if tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        status.update(traced_bytes=current, traced_peak_bytes=peak,
+                      overhead_bytes=tracemalloc.get_tracemalloc_memory())
+    return status
+
+def max_rss_bytes() -> int:
+    """Pic de mémoire résidente du processus (ru_maxrss est en Ko sous Linux)"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def _top_sites(before: tracemalloc.Snapshot, after: tracemalloc.Snapshot,
+               limit: int = MEMORY_TOP_SITES) -> List[Dict]:
+    """Sites dont la mémoire retenue a le plus augmenté pendant l'étape"""
+    # Sans les allocations de tracemalloc et de ce module
+    filters = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)]
+    before, after = before.filter_traces(filters), after.filter_traces(filters)
+    sites = []
+    for stat in after.compare_to(before, 'lineno')[:limit]:
+        if stat.size_diff <= 0:
+            break
+        frame = stat.traceback[0]
+        sites.append({
+            'site': f"{os.path.basename(frame.filename)}:{frame.lineno}",
+            'retained_bytes': stat.size_diff,
+            'blocks': stat.count_diff,
+        })
+    return sites
+
+class NullProfiler:
+    """Profileur inactif : coût quasi nul"""
+    enabled = False
+
+    def stage(self, name: str, filename: Optional[str] = None):
+        return nullcontext()
+
+    def close(self):
+        pass
+
+NULL_PROFILER = NullProfiler()
+
+def request_profiler(label: str, headers):
+    """Profileur d'une requête selon X-Profile / X-Profile-Memory (ou les variables d'environnement)"""
+    cpu = profiling_requested(headers)
+    memory = memory_requested(headers)
+    if not cpu and not memory:
+        return NULL_PROFILER
+    return RequestProfiler(label, cpu=cpu, memory=memory)
+
+class RequestProfiler:
+    """
+    Profil d'une requête, découpé par étape et par fichier
+    cpu : profil cProfile ; memory : pic et mémoire retenue par étape (tracemalloc)
+    """
+    enabled = True
+
+    def __init__(self, label: str, cpu: bool = True, memory: bool = False):
+        self.label = label
+        self.cpu = cpu
+        self.memory = memory
+        self.created = time.time()
+        self.stages: List[Dict] = []
+        self._stats: Optional[pstats.Stats] = None
+        self._lock = threading.Lock()
+        self._closed = False
+        # Erreur de la requête, si elle a échoué
+        self.error: Optional[str] = None
+        if memory:
+            _start_tracing()
+
+    @contextmanager
+    def stage(self, name: str, filename: Optional[str] = None):
+        profile = None
+        if self.cpu and _cprofile_lock.acquire(blocking=False):
+            profile = cProfile.Profile()
+        wants_memory = self.memory and not self._closed
+        measure_memory = wants_memory and _memory_lock.acquire(blocking=False)
+        # Une autre étape est déjà mesurée : celle-ci est marquée, pas comptée comme nulle
+        memory = {'skipped': True} if wants_memory and not measure_memory else None
+        if measure_memory:
+            snapshot_before = tracemalloc.take_snapshot()
+            current_before, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+        started = time.perf_counter()
+        try:
+            if profile is not None:
+                profile.enable()
+            yield
+        finally:
+            duration = time.perf_counter() - started
+            if profile is not None:
+                profile.disable()
+                _cprofile_lock.release()
+            if measure_memory:
+                try:
+                    current_after, peak = tracemalloc.get_traced_memory()
+                    memory = {
+                        'peak_bytes': max(0, peak - current_before),
+                        'retained_bytes': current_after - current_before,
+                        'top_sites': _top_sites(snapshot_before, tracemalloc.take_snapshot()),
+                    }
+                finally:
+                    _memory_lock.release()
+            self._record(name, filename, duration, profile, memory)
+
+    def _record(self, name, filename, duration, profile, memory=None):
+        entry = {'stage': name, 'file': filename, 'seconds': round(duration, 6)}
+        if memory is not None:
+            entry['memory'] = memory
+        if profile is not None:
+            stats = pstats.Stats(profile)
+            entry['top'] = _top_functions(stats)
+        with self._lock:
+            self.stages.append(entry)
+            if profile is not None:
+                if self._stats is None:
+                    self._stats = pstats.Stats(profile)
+                else:
+                    self._stats.add(profile)
+
+    def summary(self) -> Dict:
+        totals: Dict[str, float] = {}
+        for entry in self.stages:
+            totals[entry['stage']] = totals.get(entry['stage'], 0.0) + entry['seconds']
+        summary = {
+            'id': self.label,
+            'created': datetime.fromtimestamp(self.created).isoformat(timespec='seconds'),
+            'stage_totals': {stage: round(seconds, 6) for stage, seconds in totals.items()},
+            'stages': self.stages,
+        }
+        if self.error is not None:
+            summary['error'] = self.error
+        if self.memory:
+            summary['memory'] = self.memory_summary()
+        return summary
+
+    def memory_summary(self) -> Dict:
+        """Pic max et mémoire retenue cumulée par étape et par document"""
+        by_stage: Dict[str, Dict] = {}
+        by_file: Dict[str, Dict] = {}
+        skipped = 0
+        for entry in self.stages:
+            memory = entry.get('memory')
+            if memory is None:
+                continue
+            if memory.get('skipped'):
+                skipped += 1
+                continue
+            for key, totals in ((entry['stage'], by_stage), (entry['file'], by_file)):
+                if key is None:
+                    continue
+                bucket = totals.setdefault(key, {'peak_bytes': 0, 'retained_bytes': 0})
+                bucket['peak_bytes'] = max(bucket['peak_bytes'], memory['peak_bytes'])
+                bucket['retained_bytes'] += memory['retained_bytes']
+        return {
+            'max_rss_bytes': max_rss_bytes(),
+            'by_stage': by_stage,
+            'by_file': by_file,
+            # Étapes non mesurées car concurrentes d'une autre étape mesurée
+            'skipped_stages': skipped,
+        }
+
+    def close(self):
+        """Arrête la mesure mémoire de la requête (appelé par save, et en cas d'erreur)"""
+        if self.memory and not self._closed:
+            self._closed = True
+            _stop_tracing()
+
+    def save(self, directory: Path = PROFILES_DIR, ring_size: int = PROFILE_RING_SIZE,
+             error: Optional[BaseException] = None) -> Path:
+        """
+        Écrit <id>.json (résumé par étape) et <id>.prof (pstats, ex. pour snakeviz)
+        error : erreur de la requête, notée dans le résumé (profil d'une requête en échec)
+        """
+        self.close()
+        if error is not None:
+            self.error = str(error) or type(error).__name__
+        if self.memory:
+            for stage, figures in self.memory_summary()['by_stage'].items():
+                logger.info(f"Memory {self.label} {stage}: peak {figures['peak_bytes']} B, "
+                            f"retained {figures['retained_bytes']} B")
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        summary_path = directory / f"{self.label}.json"
+        with open(summary_path, 'w', encoding='utf-8') as f:
+            json.dump(self.summary(), f, ensure_ascii=False)
+        if self._stats is not None:
+            self._stats.dump_stats(str(directory / f"{self.label}.prof"))
+        _trim_ring(directory, ring_size)
+        logger.info(f"Profile saved: {summary_path}")
+        return summary_path
+
+def _top_functions(stats: pstats.Stats, limit: int = PROFILE_TOP_FUNCTIONS) -> List[Dict]:
+    rows = []
+    for (filename, line, function), (_, calls, own, cumulative, _) in stats.stats.items():
+        rows.append({
+            'function': f"{os.path.basename(filename)}:{line}({function})",
+            'calls': calls,
+            'own_seconds': round(own, 6),
+            'cumulative_seconds': round(cumulative, 6),
+        })
+    rows.sort(key=lambda row: row['cumulative_seconds'], reverse=True)
+    return rows[:limit]
+
+def _trim_ring(directory: Path, ring_size: int):
+    """Ne conserve que les ring_size profils les plus récents"""
+    summaries = sorted(directory.glob("*.json"), key=lambda path: path.stat().st_mtime, reverse=True)
+    for old in summaries[ring_size:]:
+        old.unlink(missing_ok=True)
+        old.with_suffix('.prof').unlink(missing_ok=True)
+
+def list_profiles(directory: Path = PROFILES_DIR) -> List[Dict]:
+    directory = Path(directory)
+    if not directory.is_dir():
+        return []
+    profiles = []
+    for path in sorted(directory.glob("*.json"), key=lambda p: p.stat().st_mtime, reverse=True):
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                summary = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            continue
+        profiles.append({
+            'id': summary.get('id', path.stem),
+            'created': summary.get('created'),
+            'stage_totals': summary.get('stage_totals', {}),
+            'has_pstats': path.with_suffix('.prof').exists(),
+            'memory': summary.get('memory'),
+        })
+    return profiles
+
+def profile_path(profile_id: str, kind: str = 'json', directory: Path = PROFILES_DIR) -> Optional[Path]:
+    """Chemin d'un profil enregistré (None si inconnu)"""
+    if kind not in ('json', 'prof') or '/' in profile_id or profile_id.startswith('.'):
+        return None
+    path = Path(directory) / f"{profile_id}.{kind}"
+    return path if path.exists() else None
@@ -0,0 +1,194 @@
+import json
+from datetime import datetime
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Union
+
+@dataclass(slots=True)
+class Article:
+    """Ligne d'article d'une facture"""
+    reference: str = ''
+    description: str = ''
+    quantite: float = 0.0
+    prix_unitaire: float = 0.0
+    remise: float = 0.0
+    montant_ht: float = 0.0
+    tva: float = 0.0
+
+    def to_dict(self) -> Dict:
+        return {
+            'reference': self.reference,
+            'description': self.description,
+            'quantite': self.quantite,
+            'prix_unitaire': self.prix_unitaire,
+            'remise': self.remise,
+            'montant_ht': self.montant_ht,
+            'tva': self.tva
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> 'Article':
+        return cls(
+            reference=data.get('reference', ''),
+            description=data.get('description', ''),
+            quantite=data.get('quantite', 0.0),
+            prix_unitaire=data.get('prix_unitaire', 0.0),
+            remise=data.get('remise', 0.0),
+            montant_ht=data.get('montant_ht', 0.0),
+            tva=data.get('tva', 0.0)
+        )
+
+@dataclass(slots=True)
+class Totals:
+    """Montants totaux d'une facture (clé TOTAL du format dict)"""
+    total_ttc: float = 0.0
+    total_ht: float = 0.0
+    tva: float = 0.0
+    frais_expedition: float = 0.0
+    type_expedition: Optional[str] = None
+    remise: Union[float, str] = ''
+    acompte: Optional[float] = None
+
+    def to_dict(self) -> Dict:
+        data = {
+            'total_ttc': self.total_ttc,
+            'total_ht': self.total_ht,
+            'tva': self.tva,
+            'frais_expedition': self.frais_expedition,
+            'type_expedition': self.type_expedition,
+            'remise': self.remise
+        }
+        # L'acompte reçu n'apparaît que s'il a été trouvé (factures MEG)
+        if self.acompte is not None:
+            data['acompte'] = self.acompte
+        return data
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> 'Totals':
+        return cls(
+            total_ttc=data.get('total_ttc', 0.0),
+            total_ht=data.get('total_ht', 0.0),
+            tva=data.get('tva', 0.0),
+            frais_expedition=data.get('frais_expedition', 0.0),
+            type_expedition=data.get('type_expedition'),
+            remise=data.get('remise', ''),
+            acompte=data.get('acompte')
+        )
+
+@dataclass(slots=True)
+class Invoice:
+    """Facture structurée produite par InvoiceExtractor"""
+    type: str = ''
+    articles: List[Article] = field(default_factory=list)
+    nombre_articles: float = 0
+    totals: Totals = field(default_factory=Totals)
+    reseau_vente: str = ''
+    type_vente: str = ''
+    commentaire: str = ''
+    statut_paiement: str = ''
+    reglement: str = ''
+    numero_client: str = ''
+    client_name: str = ''
+    date_facture: str = ''
+    date_commande: str = ''
+    numero_facture: str = ''
+    acompte_echeance: Union[float, str] = ''
+    date_acompte: str = ''
+    # Étage d'extraction ayant produit la facture (voir tiered_extraction)
+    extraction_tier: Optional[str] = None
+    # Texte brut, uniquement si sa conservation a été demandée
+    text: Optional[str] = None
+
+    def total_quantity(self) -> float:
+        """Somme des quantités des articles"""
+        total = 0
+        for article in self.articles:
+            try:
+                total += float(article.quantite)
+            except (ValueError, TypeError):
+                print(f"Warning: Could not convert quantity to number: {article.quantite}")
+        return total
+
+    def to_dict(self) -> Dict:
+        """Couche de compatibilité : renvoie la forme dict historique de invoice_data"""
+        data = {
+            'type': self.type,
+            'articles': [article.to_dict() for article in self.articles],
+            'nombre_articles': self.nombre_articles,
+            'TOTAL': self.totals.to_dict(),
+            'Réseau_Vente': self.reseau_vente,
+            'Type_Vente': self.type_vente,
+            'commentaire': self.commentaire,
+            'statut_paiement': self.statut_paiement,
+            'reglement': self.reglement,
+            'numero_client': self.numero_client,
+            'client_name': self.client_name,
+            'date_facture': self.date_facture,
+            'date_commande': self.date_commande,
+            'numero_facture': self.numero_facture,
+            'acompte_echeance': self.acompte_echeance,
+            'date_acompte': self.date_acompte
+        }
+        if self.extraction_tier is not None:
+            data['extraction_tier'] = self.extraction_tier
+        return data
+
+    @classmethod
+    def from_dict(cls, data: Dict, text: Optional[str] = None) -> 'Invoice':
+        """Reconstruit une facture à partir de la forme dict historique"""
+        return cls(
+            type=data.get('type', ''),
+            articles=[Article.from_dict(article) for article in data.get('articles', [])],
+            nombre_articles=data.get('nombre_articles', 0),
+            totals=Totals.from_dict(data.get('TOTAL', {})),
+            reseau_vente=data.get('Réseau_Vente', ''),
+            type_vente=data.get('Type_Vente', ''),
+            commentaire=data.get('commentaire', ''),
+            statut_paiement=data.get('statut_paiement', ''),
+            reglement=data.get('reglement', ''),
+            numero_client=data.get('numero_client', ''),
+            client_name=data.get('client_name', ''),
+            date_facture=data.get('date_facture', ''),
+            date_commande=data.get('date_commande', ''),
+            numero_facture=data.get('numero_facture', ''),
+            acompte_echeance=data.get('acompte_echeance', ''),
+            date_acompte=data.get('date_acompte', ''),
+            extraction_tier=data.get('extraction_tier'),
+            text=text
+        )
+
+def parse_invoice_date(date_str: str):
+    """Convertit une date YYYY-MM-DD ou DD/MM/YYYY en objet date (None si invalide)"""
+    if not date_str:
+        return None
+    for fmt in ('%Y-%m-%d', '%d/%m/%Y', '%d-%m-%Y'):
+        try:
+            return datetime.strptime(date_str.strip(), fmt).date()
+        except ValueError:
+            continue
+    return None
+
+def as_invoice(entry) -> Invoice:
+    """Accepte un Invoice ou une entrée historique {'data': ..., 'text': ...}"""
+    if isinstance(entry, Invoice):
+        return entry
+    return Invoice.from_dict(entry.get('data', {}), entry.get('text'))
+
+def invoices_to_dict(invoices_data: Dict) -> Dict:
+    """Convertit {fichier: Invoice} vers le format historique de factures.json"""
+    result = {}
+    for filename, entry in invoices_data.items():
+        invoice = as_invoice(entry)
+        result[filename] = {'data': invoice.to_dict()}
+        if invoice.text is not None:
+            result[filename]['text'] = invoice.text
+    return result
+
+def dump_invoices(invoices_data: Dict, fp, indent: Optional[int] = None):
+    """Sérialise les factures en JSON (compact par défaut)"""
+    separators = (',', ':') if indent is None else None
+    json.dump(invoices_to_dict(invoices_data), fp, ensure_ascii=False, indent=indent,
+              separators=separators)
+
+def load_invoices(fp) -> Dict[str, Invoice]:
+    """Charge un factures.json sous forme de {fichier: Invoice}"""
+    return {filename: as_invoice(entry) for filename, entry in json.load(fp).items()}
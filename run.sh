@@ -23,8 +23,7 @@ pkill -f "streamlit run" || true
 
 # Clean up any temporary files
 echo "Cleaning up temporary files..."
-rm -f temp_files/factures.json
-rm -f temp_files/factures*.xlsx
+rm -rf temp_files/workspaces
 
 # Start FastAPI in the background
 echo "Starting FastAPI server..."
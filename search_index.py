@@ -0,0 +1,194 @@
+"""
+Index de recherche des factures traitées (SQLite)
+
+- invoices : une ligne par facture, colonnes indexées (numéro, client, dates, réseau, total TTC)
+- invoices_fts : index plein texte FTS5 du texte extrait, même rowid que invoices
+
+L'index est alimenté à la fin de chaque lot et interrogé par GET /search.
+"""
+import logging
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from records import as_invoice, parse_invoice_date
+
+logger = logging.getLogger(__name__)
+
+# Base de l'index (vide : indexation désactivée)
+SEARCH_INDEX_PATH = os.getenv("SEARCH_INDEX_PATH", "temp_files/search_index.sqlite")
+SEARCH_MAX_LIMIT = 500
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS invoices (
+    id INTEGER PRIMARY KEY,
+    job_id TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    original_name TEXT,
+    type TEXT,
+    numero_facture TEXT COLLATE NOCASE,
+    client_name TEXT COLLATE NOCASE,
+    numero_client TEXT COLLATE NOCASE,
+    date_facture TEXT,
+    date_commande TEXT,
+    reseau_vente TEXT,
+    total_ttc REAL,
+    indexed_at REAL NOT NULL,
+    UNIQUE (job_id, filename)
+);
+CREATE INDEX IF NOT EXISTS idx_invoices_numero_facture ON invoices (numero_facture);
+CREATE INDEX IF NOT EXISTS idx_invoices_client_name ON invoices (client_name);
+CREATE INDEX IF NOT EXISTS idx_invoices_numero_client ON invoices (numero_client);
+CREATE INDEX IF NOT EXISTS idx_invoices_date_facture ON invoices (date_facture);
+CREATE INDEX IF NOT EXISTS idx_invoices_date_commande ON invoices (date_commande);
+CREATE INDEX IF NOT EXISTS idx_invoices_reseau_vente ON invoices (reseau_vente);
+CREATE INDEX IF NOT EXISTS idx_invoices_total_ttc ON invoices (total_ttc);
+CREATE VIRTUAL TABLE IF NOT EXISTS invoices_fts USING fts5(
+    text, refs, tokenize = 'unicode61 remove_diacritics 2'
+);
+"""
+
+def _iso_date(value: str) -> Optional[str]:
+    parsed = parse_invoice_date(value)
+    return parsed.isoformat() if parsed else None
+
+def _fts_query(query: str) -> str:
+    """Chaque mot est cherché tel quel (guillemets), le dernier aussi comme préfixe"""
+    terms = ['"' + term.replace('"', '""') + '"' for term in query.split()]
+    if terms:
+        terms[-1] += '*'
+    return ' '.join(terms)
+
+class SearchIndex:
+    def __init__(self, path=SEARCH_INDEX_PATH):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(str(path), check_same_thread=False, timeout=30)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        # LIKE 'préfixe%' insensible à la casse, servi par les index COLLATE NOCASE
+        self._db.execute("PRAGMA case_sensitive_like=OFF")
+        self._db.executescript(SCHEMA)
+        self._db.commit()
+        self._lock = threading.Lock()
+
+    def index_batch(self, job_id: str, invoices_data: Dict, texts: Dict[str, str],
+                    original_names: Optional[Dict[str, str]] = None) -> int:
+        """
+        Ajoute (ou remplace) les factures d'un lot en une transaction
+        Seules les factures dont le texte est fourni sont indexées
+        """
+        original_names = original_names or {}
+        rows = 0
+        with self._lock, self._db:
+            for filename, entry in invoices_data.items():
+                text = texts.get(filename)
+                if text is None:
+                    continue
+                invoice = as_invoice(entry)
+                previous = self._db.execute(
+                    "SELECT id FROM invoices WHERE job_id = ? AND filename = ?", (job_id, filename)
+                ).fetchone()
+                if previous is not None:
+                    self._db.execute("DELETE FROM invoices_fts WHERE rowid = ?", (previous['id'],))
+                    self._db.execute("DELETE FROM invoices WHERE id = ?", (previous['id'],))
+                try:
+                    total_ttc = float(invoice.totals.total_ttc)
+                except (TypeError, ValueError):
+                    total_ttc = None
+                cursor = self._db.execute(
+                    """INSERT INTO invoices (job_id, filename, original_name, type, numero_facture,
+                           client_name, numero_client, date_facture, date_commande, reseau_vente,
+                           total_ttc, indexed_at)
+                       VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                    (job_id, filename, original_names.get(filename, filename), invoice.type,
+                     invoice.numero_facture, invoice.client_name, invoice.numero_client,
+                     _iso_date(invoice.date_facture), _iso_date(invoice.date_commande),
+                     invoice.reseau_vente, total_ttc, time.time()),
+                )
+                refs = ' '.join(article.reference for article in invoice.articles if article.reference)
+                self._db.execute(
+                    "INSERT INTO invoices_fts (rowid, text, refs) VALUES (?, ?, ?)",
+                    (cursor.lastrowid, text, refs),
+                )
+                rows += 1
+        return rows
+
+    def search(self, q: Optional[str] = None, numero_facture: Optional[str] = None,
+               client: Optional[str] = None, numero_client: Optional[str] = None,
+               reseau_vente: Optional[str] = None, date_from: Optional[str] = None,
+               date_to: Optional[str] = None, total_ttc: Optional[float] = None,
+               min_ttc: Optional[float] = None, max_ttc: Optional[float] = None,
+               limit: int = 50, offset: int = 0) -> List[Dict]:
+        """
+        Recherche combinée : plein texte (q) et filtres sur les colonnes indexées
+        client : préfixe du nom ; total_ttc : montant exact au centime près
+        """
+        conditions, params = [], []
+        if numero_facture:
+            conditions.append("i.numero_facture = ?")
+            params.append(numero_facture)
+        if client:
+            conditions.append("i.client_name LIKE ?")
+            params.append(client.replace('%', '').replace('_', '') + '%')
+        if numero_client:
+            conditions.append("i.numero_client = ?")
+            params.append(numero_client)
+        if reseau_vente:
+            conditions.append("i.reseau_vente = ?")
+            params.append(reseau_vente)
+        if date_from:
+            conditions.append("i.date_facture >= ?")
+            params.append(date_from)
+        if date_to:
+            conditions.append("i.date_facture <= ?")
+            params.append(date_to)
+        if total_ttc is not None:
+            conditions.append("i.total_ttc BETWEEN ? AND ?")
+            params.extend([total_ttc - 0.005, total_ttc + 0.005])
+        if min_ttc is not None:
+            conditions.append("i.total_ttc >= ?")
+            params.append(min_ttc)
+        if max_ttc is not None:
+            conditions.append("i.total_ttc <= ?")
+            params.append(max_ttc)
+
+        columns = ("i.id, i.job_id, i.filename, i.original_name, i.type, i.numero_facture, "
+                   "i.client_name, i.numero_client, i.date_facture, i.date_commande, "
+                   "i.reseau_vente, i.total_ttc")
+        if q and q.strip():
+            sql = (f"SELECT {columns}, snippet(invoices_fts, 0, '[', ']', '…', 12) AS snippet "
+                   "FROM invoices_fts JOIN invoices i ON i.id = invoices_fts.rowid "
+                   "WHERE invoices_fts MATCH ?")
+            params.insert(0, _fts_query(q))
+            order = "ORDER BY bm25(invoices_fts)"
+        else:
+            sql = f"SELECT {columns} FROM invoices i WHERE 1 = 1"
+            order = "ORDER BY i.date_facture DESC, i.id DESC"
+        for condition in conditions:
+            sql += f" AND {condition}"
+        sql += f" {order} LIMIT ? OFFSET ?"
+        params.extend([max(1, min(limit, SEARCH_MAX_LIMIT)), max(0, offset)])
+
+        with self._lock:
+            return [dict(row) for row in self._db.execute(sql, params).fetchall()]
+
+    def count(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM invoices").fetchone()[0]
+
+_search_index: Optional[SearchIndex] = None
+_search_index_lock = threading.Lock()
+
+def get_search_index() -> Optional[SearchIndex]:
+    """Index partagé du processus (None si SEARCH_INDEX_PATH est vide)"""
+    global _search_index
+    if not SEARCH_INDEX_PATH:
+        return None
+    if _search_index is None:
+        with _search_index_lock:
+            if _search_index is None:
+                _search_index = SearchIndex()
+    return _search_index
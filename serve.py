@@ -0,0 +1,93 @@
+"""
+Démarrage de l'API en mode pré-forké :
+le processus parent importe et préchauffe la chaîne d'extraction une seule fois,
+puis forke les workers qui héritent des modules déjà chargés (copy-on-write).
+
+Usage : python serve.py  (variables HOST, PORT, WEB_CONCURRENCY)
+"""
+import logging
+import os
+import signal
+import socket
+import sys
+import time
+
+import uvicorn
+
+from app import app, warmup
+
+logger = logging.getLogger(__name__)
+
+HOST = os.getenv("HOST", "0.0.0.0")
+PORT = int(os.getenv("PORT", "8000"))
+WORKERS = int(os.getenv("WEB_CONCURRENCY", "2"))
+
+def bind_socket(host: str, port: int) -> socket.socket:
+    """Ouvre le socket d'écoute partagé par tous les workers"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+def run_worker(sock: socket.socket):
+    """Boucle d'un worker : sert les requêtes sur le socket hérité du parent"""
+    config = uvicorn.Config(app, log_level="info")
+    server = uvicorn.Server(config)
+    server.run(sockets=[sock])
+
+def spawn_worker(sock: socket.socket) -> int:
+    pid = os.fork()
+    if pid == 0:
+        # Le worker laisse uvicorn gérer ses propres signaux
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        try:
+            run_worker(sock)
+        finally:
+            os._exit(0)
+    return pid
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+
+    # Préchauffage unique dans le parent, avant tout fork
+    started = time.perf_counter()
+    warmup()
+    logger.info(f"Parent warmed up in {time.perf_counter() - started:.2f}s, forking {WORKERS} workers")
+
+    sock = bind_socket(HOST, PORT)
+    workers = {spawn_worker(sock) for _ in range(WORKERS)}
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    # Supervision : un worker qui meurt est remplacé par un nouveau fork du parent préchauffé
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        workers.discard(pid)
+        if not stopping:
+            logger.warning(f"Worker {pid} exited with status {status}, respawning")
+            workers.add(spawn_worker(sock))
+
+    sock.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
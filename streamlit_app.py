@@ -2,14 +2,16 @@ import streamlit as st
 import requests
 import os
 from dotenv import load_dotenv
-from create_invoice_excel import create_invoice_dataframe, format_excel, load_invoice_data
-import pandas as pd
+from create_invoice_excel import create_invoice_dataframe, build_workbook
 from datetime import datetime
 import pytz
-import json
 from pathlib import Path
-from pdf_extractor import extract_text_from_pdf
 from billing_extractor import InvoiceExtractor
+from dedup import BatchDeduplicator, DuplicateIndex
+from parse_cache import get_parse_cache
+from records import dump_invoices
+from tiered_extraction import extract_invoice_tiered
+from workspace import Workspace, cleanup_expired
 
 # Set page configuration (must be the first Streamlit command)
 st.set_page_config(
@@ -28,10 +30,16 @@ reload_env()
 # Configuration de l'API endpoint
 API_URL = os.getenv("API_URL", "http://fastapi:8000")
 PROJECT_ID = os.getenv("PROJECT_ID", "nomadsfacturation")
+KEEP_RAW_TEXT = os.getenv("KEEP_RAW_TEXT", "false").lower() in ("1", "true", "yes")
 
 # Create temp_files directory if it doesn't exist
 os.makedirs('temp_files', exist_ok=True)
 
+# Un espace de travail par analyse, nettoyé après expiration
+WORKSPACES_DIR = Path('temp_files') / 'workspaces'
+cleanup_expired(WORKSPACES_DIR)
+DEDUP_INDEX_PATH = Path('temp_files') / 'dedup_index.sqlite'
+
 # Centrer le titre Nomads Surfing
 st.markdown("<h1 style='text-align: center;'>Nomads Surfing 🌊</h1>", unsafe_allow_html=True)
 
@@ -41,86 +49,100 @@ st.markdown("<h2 style='text-align: center;'>Analyse automatique de factures PDF
 # Upload multiple PDF files
 uploaded_files = st.file_uploader(" ", type="pdf", accept_multiple_files=True)
 
-def process_pdfs_locally(uploaded_files):
+def keep_duplicate(deduplicator, duplicate, invoices_data):
+    """Politique flag : conserve la facture en double, marquée, sans nouvelle analyse"""
+    flagged = deduplicator.flagged(duplicate)
+    if flagged is not None:
+        invoices_data[duplicate.filename] = flagged
+
+def process_pdfs_locally(uploaded_files, keep_text=KEEP_RAW_TEXT):
     """Process PDFs locally using the same logic as app.py"""
     # Initialiser l'extracteur
-    extractor = InvoiceExtractor()
+    extractor = InvoiceExtractor(cache=get_parse_cache())
 
     # Dictionnaire pour stocker les données des factures
     invoices_data = {}
+    # Fichiers en échec, listés dans la feuille 'Erreurs' du classeur
+    errors = []
+
+    # Espace de travail isolé pour cette analyse
+    workspace = Workspace.create(WORKSPACES_DIR)
+
+    # Doublons dans le lot et avec les analyses précédentes
+    deduplicator = BatchDeduplicator(DuplicateIndex(DEDUP_INDEX_PATH), job_id=workspace.job_id)
 
     # Traiter chaque PDF
     for uploaded_file in uploaded_files:
+        # Nom fourni par le client : assaini, et rendu unique si deux fichiers portent le même
+        pdf_path = workspace.unique_file(uploaded_file.name)
+        name = pdf_path.name
+        # Le nettoyage des espaces expirés ne supprime pas une analyse en cours
+        workspace.touch()
         try:
             # Save the PDF locally
-            pdf_path = os.path.join('temp_files', uploaded_file.name)
             with open(pdf_path, 'wb') as f:
                 f.write(uploaded_file.getvalue())
 
-            # Extract text from PDF
-            extracted_data = extract_text_from_pdf(pdf_path)
-            text = extracted_data.get('text', '')
-
-            # Extract invoice data
-            data = extractor.extract_invoice_data(text)
+            # Copie exacte d'un fichier déjà traité : aucune extraction
+            duplicate = deduplicator.check_content(name, pdf_path)
+            if duplicate:
+                keep_duplicate(deduplicator, duplicate, invoices_data)
+                continue
 
-            # Calculate total quantity from articles
-            total_quantity = 0
-            articles = data.get("invoice_data", {}).get("articles", [])
-            for article in articles:
-                try:
-                    qty = float(article.get("quantite", 0))
-                    total_quantity += qty
-                except (ValueError, TypeError):
-                    st.warning(f"Could not convert quantity to number: {article.get('quantite')}")
+            # Extract invoice data (costlier tiers only if the amounts do not reconcile)
+            result = extract_invoice_tiered(str(pdf_path), extractor)
+            if result is None:
+                raise ValueError("Text extraction failed")
+            invoice, text = result.invoice, result.text
 
             # Update nombre_articles with the actual sum of quantities
-            if "invoice_data" in data:
-                data["invoice_data"]["nombre_articles"] = total_quantity
-
-            # Store data in the format expected by create_invoice_dataframe
-            invoices_data[uploaded_file.name] = {
-                "text": text,
-                "data": {
-                    "type": data.get("invoice_data", {}).get("type", ""),
-                    "TOTAL": data.get("invoice_data", {}).get("TOTAL", {}),
-                    "articles": data.get("invoice_data", {}).get("articles", []),
-                    "nombre_articles": total_quantity,  # Use calculated total
-                    "Type_Vente": data.get("invoice_data", {}).get("Type_Vente", ""),
-                    "Réseau_Vente": data.get("invoice_data", {}).get("Réseau_Vente", ""),
-                    "commentaire": data.get("invoice_data", {}).get("commentaire", ""),
-                    "statut_paiement": data.get("invoice_data", {}).get("statut_paiement", ""),
-                    "numero_client": data.get("invoice_data", {}).get("numero_client", ""),
-                    "client_name": data.get("invoice_data", {}).get("client_name", ""),
-                    "date_facture": data.get("invoice_data", {}).get("date_facture", ""),
-                    "date_commande": data.get("invoice_data", {}).get("date_commande", ""),
-                    "numero_facture": data.get("invoice_data", {}).get("numero_facture", "")
-                }
-            }
+            invoice.nombre_articles = invoice.total_quantity()
+
+            # Même facture déjà traitée
+            duplicate = deduplicator.check_invoice(name, invoice)
+            if duplicate:
+                keep_duplicate(deduplicator, duplicate, invoices_data)
+                continue
+
+            # Le texte brut n'est conservé que sur demande
+            if keep_text:
+                invoice.text = text
+
+            invoices_data[name] = invoice
         except Exception as e:
             st.error(f"Error processing {uploaded_file.name}: {str(e)}")
+            errors.append({'file': name, 'name': uploaded_file.name,
+                           'stage': 'extract', 'error': str(e)})
+
+    if extractor.cache is not None:
+        extractor.cache.flush()
+
+    for duplicate in deduplicator.duplicates:
+        st.info(f"♻️ {duplicate.filename} : doublon de {duplicate.original}")
 
     # Save JSON data
-    json_path = os.path.join('temp_files', 'factures.json')
+    json_path = workspace.file('factures.json')
     with open(json_path, 'w', encoding='utf-8') as f:
-        json.dump(invoices_data, f, ensure_ascii=False, indent=2)
+        dump_invoices(invoices_data, f)
 
     # Generate Excel filename
     paris_tz = pytz.timezone('Europe/Paris')
     current_time = datetime.now(paris_tz)
     timestamp = current_time.strftime('%y%m%d%H%M%S')
-    filename = f'factures_auto_{timestamp}.xlsx'
-    excel_path = os.path.join('temp_files', filename)
+    filename = f'factures_auto_{timestamp}_{workspace.job_id.rsplit("-", 1)[-1][:8]}.xlsx'
 
     # Create DataFrame using the same function as app.py
-    df = create_invoice_dataframe(invoices_data)
+    df = create_invoice_dataframe(invoices_data, errors=errors)
+
+    # Build the formatted workbook in memory
+    with build_workbook(df, errors=errors) as workbook:
+        excel_data = workbook.read()
 
-    # Save with formatting
-    with pd.ExcelWriter(excel_path, engine='xlsxwriter') as writer:
-        df.to_excel(writer, sheet_name='Factures', index=False)
-        format_excel(writer, df)
+    # Seules les factures livrées dans le classeur rejoignent l'index des doublons
+    failed = {error['file'] for error in errors}
+    deduplicator.commit(name for name in invoices_data if name not in failed)
 
-    return excel_path, filename, df
+    return excel_data, filename, df
 
 if uploaded_files:
     for uploaded_file in uploaded_files:
@@ -131,16 +153,13 @@ if uploaded_files:
         try:
             with st.spinner("🔄 Analyse en cours..."):
                 # Process PDFs locally using the same logic as app.py
-                excel_path, filename, df = process_pdfs_locally(uploaded_files)
+                excel_data, filename, df = process_pdfs_locally(uploaded_files)
 
                 # Display summary information
                 st.success("✅ Analyse des documents terminée avec succès ! 🎉")
 
 
                 # Provide download button
-                with open(excel_path, 'rb') as f:
-                    excel_data = f.read()
-
                 st.success(f"📂 Fichier Excel créé avec succès ! 🤙")
 
                 st.download_button(
@@ -0,0 +1,67 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+PAGE_WIDTH = 595
+PAGE_HEIGHT = 842
+
+def build_pdf(pages, font_size: int = 12, rules=None) -> bytes:
+    """
+    PDF minimal : pages = [[(haut de la ligne en points, texte[, gauche]), ...], ...]
+    rules : rectangles tracés par page, [[(x0, haut, x1, bas), ...], ...]
+    """
+    objects = []
+
+    def add(body: bytes) -> int:
+        objects.append(body)
+        return len(objects)
+
+    catalog = add(b"")
+    pages_id = add(b"")
+    font = add(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+    page_ids = []
+    for index, lines in enumerate(pages):
+        stream = b"".join(
+            b"BT /F1 %d Tf %.2f %.2f Td (%s) Tj ET\n"
+            % (font_size, left, PAGE_HEIGHT - top - font_size, text.encode('latin-1'))
+            for top, text, left in ((*line, 50)[:3] for line in lines)
+        )
+        stream += b"".join(
+            b"%.2f %.2f %.2f %.2f re S\n" % (x0, PAGE_HEIGHT - bottom, x1 - x0, bottom - top)
+            for x0, top, x1, bottom in (rules[index] if rules else [])
+        )
+        content = add(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream))
+        page_ids.append(add(
+            b"<< /Type /Page /Parent %d 0 R /MediaBox [0 0 %d %d] /Contents %d 0 R "
+            b"/Resources << /Font << /F1 %d 0 R >> >> >>"
+            % (pages_id, PAGE_WIDTH, PAGE_HEIGHT, content, font)
+        ))
+    objects[catalog - 1] = b"<< /Type /Catalog /Pages %d 0 R >>" % pages_id
+    objects[pages_id - 1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (
+        b" ".join(b"%d 0 R" % page_id for page_id in page_ids), len(page_ids)
+    )
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n%s\nendobj\n" % (number, body)
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    for offset in offsets:
+        out += b"%010d 00000 n \n" % offset
+    out += b"trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (
+        len(objects) + 1, catalog, xref
+    )
+    return bytes(out)
+
+@pytest.fixture
+def make_pdf(tmp_path):
+    def make(pages, name="facture.pdf", rules=None):
+        path = tmp_path / name
+        path.write_bytes(build_pdf(pages, rules=rules))
+        return str(path)
+    return make
@@ -0,0 +1,190 @@
+import asyncio
+import threading
+
+import pytest
+
+from admission import AdmissionController, AdmissionMiddleware, Overloaded
+
+def call(middleware, body_chunks, headers=(), path="/analyze_pdfs/", seen=None):
+    """
+    Requête ASGI factice ; renvoie (statut, corps reçu par l'application)
+    seen : reçoit le scope vu par l'application
+    """
+    received = []
+    sent = []
+    messages = [{'type': 'http.request', 'body': chunk, 'more_body': i < len(body_chunks) - 1}
+                for i, chunk in enumerate(body_chunks)]
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    async def app(scope, receive, send):
+        if seen is not None:
+            seen.update(scope)
+        while True:
+            message = await receive()
+            received.append(message['body'])
+            if not message.get('more_body'):
+                break
+        await send({'type': 'http.response.start', 'status': 200, 'headers': []})
+        await send({'type': 'http.response.body', 'body': b'ok'})
+
+    scope = {'type': 'http', 'method': 'POST', 'path': path, 'headers': list(headers)}
+    asyncio.run(AdmissionMiddleware(app, **middleware)(scope, receive, send))
+    return sent[0]['status'], b''.join(received)
+
+def test_body_within_limit_is_passed_through():
+    status, body = call({'max_body_bytes': 10, 'controller': AdmissionController()}, [b'12345', b'678'])
+    assert (status, body) == (200, b'12345678')
+
+def test_declared_oversized_body_is_rejected_before_reading():
+    controller = AdmissionController()
+    status, body = call({'max_body_bytes': 10, 'controller': controller}, [b'x' * 20],
+                        headers=[(b'content-length', b'20')])
+    assert (status, body) == (413, b'')
+    assert controller.oversized_requests == 1
+
+def test_streamed_oversized_body_is_cut_off():
+    controller = AdmissionController()
+    status, _ = call({'max_body_bytes': 10, 'controller': controller}, [b'x' * 6, b'x' * 6, b'x'])
+    assert status == 413
+    assert controller.oversized_requests == 1
+
+def test_full_queue_is_rejected_before_reading():
+    controller = AdmissionController(max_documents=1, max_queued=0)
+    tickets = [controller.admit(1, 'interactive'), controller.admit(1, 'bulk')]
+    status, body = call({'controller': controller}, [b'pdf'])
+    assert (status, body) == (429, b'')
+    for ticket in tickets:
+        ticket.close()
+
+def test_declared_documents_are_reserved_before_the_body_is_read():
+    controller = AdmissionController(max_documents=1, max_queued=4)
+    seen = {}
+    status, _ = call({'controller': controller}, [b'pdf'], seen=seen,
+                     headers=[(b'x-document-count', b'3')])
+    ticket = seen['state']['admission_ticket']
+    assert status == 200
+    assert (ticket.priority, ticket.cost) == ('interactive', 3)
+    # Réservation libérée à la fin de la requête
+    assert controller.classes['interactive']['pending'] == 0
+
+def test_resize_to_the_real_document_count():
+    controller = AdmissionController(max_documents=1, max_queued=24)
+    ticket = controller.admit(1, 'interactive')
+    ticket.resize(12)
+    # Plus de INTERACTIVE_MAX_DOCUMENTS documents : la réservation passe en bulk
+    assert ticket.priority == 'bulk'
+    assert controller.classes['interactive']['pending'] == 0
+    assert controller.classes['bulk']['pending'] == 12
+
+    other = controller.admit(10, 'bulk')
+    with pytest.raises(Overloaded):
+        other.resize(14)
+    assert controller.classes['bulk']['pending'] == 22
+    other.close()
+    ticket.close()
+    assert controller.classes['bulk']['pending'] == 0
+
+def test_admitted_work_does_not_need_the_shared_threadpool():
+    import anyio
+    import anyio.to_thread
+
+    controller = AdmissionController(max_documents=1, max_queued=0)
+
+    async def scenario():
+        shared = anyio.to_thread.current_default_thread_limiter()
+        shared.total_tokens = 1
+        release = threading.Event()
+        async with anyio.create_task_group() as group:
+            # Le pool partagé est entièrement occupé
+            group.start_soon(anyio.to_thread.run_sync, release.wait)
+            await anyio.sleep(0.05)
+            with anyio.fail_after(5):
+                result = await controller.run(lambda value: value * 2, 21)
+            release.set()
+        return result
+
+    assert asyncio.run(scenario()) == 42
+
+def test_background_document_shares_the_processing_slots():
+    controller = AdmissionController(max_documents=1, max_queued=4)
+    ticket = controller.admit(1, 'interactive')
+    started = threading.Event()
+
+    def request_document():
+        with ticket.document():
+            started.set()
+
+    with controller.background_document():
+        assert controller.in_flight == 1
+        worker = threading.Thread(target=request_document)
+        worker.start()
+        # Le seul créneau est pris par la pré-extraction
+        assert not started.wait(0.2)
+    worker.join(timeout=5)
+    assert started.is_set()
+    assert controller.in_flight == 0
+    ticket.close()
+
+def test_fair_scheduler_shares_slots_by_weight():
+    from admission import FairScheduler
+
+    scheduler = FairScheduler(1, {'interactive': 3, 'bulk': 1})
+    scheduler.acquire('bulk')
+    order = []
+    order_lock = threading.Lock()
+
+    def waiter(priority):
+        scheduler.acquire(priority)
+        with order_lock:
+            order.append(priority)
+        scheduler.release()
+
+    # Le créneau est pris : 8 documents de chaque classe se mettent en file
+    threads = [threading.Thread(target=waiter, args=(priority,))
+               for priority in ('bulk', 'interactive') for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    while sum(scheduler.waiting().values()) < len(threads):
+        threading.Event().wait(0.01)
+    scheduler.release()
+    for thread in threads:
+        thread.join(timeout=5)
+
+    # Poids 3 contre 1 (le créneau initial a été compté à la classe bulk) : les interactifs
+    # passent devant, sans affamer le lot
+    assert order[:8].count('interactive') >= 6
+    assert 'bulk' in order[:5]
+    assert sorted(order) == ['bulk'] * 8 + ['interactive'] * 8
+
+def test_idle_class_does_not_bank_credit():
+    from admission import FairScheduler
+
+    scheduler = FairScheduler(1, {'interactive': 1, 'bulk': 1})
+    # Longue série bulk pendant que la classe interactive est inactive
+    for _ in range(10):
+        scheduler.acquire('bulk')
+        scheduler.release()
+    scheduler.acquire('bulk')
+    order = []
+
+    def waiter(priority):
+        scheduler.acquire(priority)
+        order.append(priority)
+        scheduler.release()
+
+    threads = [threading.Thread(target=waiter, args=(priority,))
+               for priority in ('interactive',) * 4 + ('bulk',) * 4]
+    for thread in threads:
+        thread.start()
+    while sum(scheduler.waiting().values()) < len(threads):
+        threading.Event().wait(0.01)
+    scheduler.release()
+    for thread in threads:
+        thread.join(timeout=5)
+    # Poids égaux : la classe revenue ne rattrape pas les 10 créneaux bulk d'affilée
+    assert 'bulk' in order[:3]
@@ -0,0 +1,42 @@
+import pytest
+
+pytest.importorskip("pandas")
+
+from aggregates import MonthlyAggregates
+from records import Invoice
+
+def make_invoice(numero="F1", total_ttc=120.0, tva=20.0, date_facture="2025-03-14",
+                 reseau_vente="20.01.01"):
+    invoice = Invoice(type='meg', numero_facture=numero, date_facture=date_facture,
+                      reseau_vente=reseau_vente, type_vente="20.01")
+    invoice.totals.total_ttc = total_ttc
+    invoice.totals.tva = tva
+    invoice.totals.total_ht = total_ttc - tva
+    return invoice
+
+def test_corrected_invoice_replaces_its_contribution(tmp_path):
+    aggregates = MonthlyAggregates(tmp_path / "aggregates.sqlite")
+    aggregates.commit_batch("job1", {"a.pdf": make_invoice(), "b.pdf": make_invoice("F2", 60.0, 10.0)})
+    # Même facture revalidée avec un montant corrigé (reprise, réexport)
+    aggregates.commit_batch("job2", {"a2.pdf": make_invoice(total_ttc=240.0, tva=40.0)})
+
+    totals = aggregates.summary()['totals']
+    assert totals['invoice_count'] == 2
+    assert totals['total_ttc'] == pytest.approx(300.0)
+
+def test_correction_moves_invoice_between_months(tmp_path):
+    aggregates = MonthlyAggregates(tmp_path / "aggregates.sqlite")
+    aggregates.commit_batch("job1", {"a.pdf": make_invoice(date_facture="2025-03-14")})
+    aggregates.commit_batch("job2", {"a.pdf": make_invoice(date_facture="2025-04-02")})
+
+    rows = aggregates.summary()['rows']
+    assert [(row['month'], row['invoice_count']) for row in rows] == [("2025-04", 1)]
+
+def test_removed_invoice_and_rebuild_agree(tmp_path):
+    aggregates = MonthlyAggregates(tmp_path / "aggregates.sqlite")
+    aggregates.commit_batch("job1", {"a.pdf": make_invoice(), "b.pdf": make_invoice("F2")})
+    aggregates.remove("meg|F2")
+    before = aggregates.summary()
+    aggregates.rebuild()
+    assert aggregates.summary() == before
+    assert before['totals']['invoice_count'] == 1
@@ -0,0 +1,67 @@
+import json
+
+import pytest
+
+from artifact_store import (LocalStore, batch_key, parse_key, publish_batch, restore_batch,
+                            text_key)
+from workspace import Workspace
+
+def test_keys_are_content_addressed_and_namespaced():
+    assert text_key("abc") == "texts/abc.json"
+    assert parse_key("fp", "abc") == "parses/fp/abc.json"
+    assert batch_key("job1", "manifest.json") == "batches/job1/manifest.json"
+
+@pytest.mark.parametrize("key", ["", "../etc/passwd", "texts//a.json", "texts/./a.json", "/abs"])
+def test_invalid_keys_are_rejected(tmp_path, key):
+    with pytest.raises(ValueError):
+        LocalStore(tmp_path).get(key)
+
+def test_content_addressed_put_is_not_rewritten(tmp_path):
+    store = LocalStore(tmp_path)
+    store.put("texts/abc.json", b"premier", overwrite=False)
+    store.put("texts/abc.json", b"second", overwrite=False)
+    assert store.get("texts/abc.json") == b"premier"
+    assert store.list("texts") == ["texts/abc.json"]
+
+def write_batch(workspace, manifest):
+    with open(workspace.file("manifest.json"), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f)
+    workspace.file("factures.json").write_text("{}")
+
+def test_stale_local_manifest_is_refreshed(tmp_path):
+    store = LocalStore(tmp_path / "store")
+    replica_a, replica_b = tmp_path / "a", tmp_path / "b"
+
+    # Réplica A : lot avec un fichier en échec
+    workspace = Workspace.create(replica_a, "job1")
+    workspace.file("x.pdf").write_bytes(b"%PDF x")
+    failed = [{'file': 'x.pdf', 'name': 'x.pdf', 'status': 'error'}]
+    write_batch(workspace, failed)
+    publish_batch(store, workspace, failed)
+
+    # Réplica B : rapatrie le lot puis le reprend avec succès
+    restored = restore_batch(store, replica_b, "job1")
+    assert restored.file("x.pdf").read_bytes() == b"%PDF x"
+    fixed = [{'file': 'x.pdf', 'name': 'x.pdf', 'status': 'ok'}]
+    write_batch(restored, fixed)
+    publish_batch(store, restored, fixed)
+
+    # Réplica A : sa copie locale est périmée et doit être remplacée
+    refreshed = restore_batch(store, replica_a, "job1")
+    assert json.loads(refreshed.file("manifest.json").read_text()) == fixed
+
+def test_unpublished_local_changes_are_kept(tmp_path):
+    store = LocalStore(tmp_path / "store")
+    workspace = Workspace.create(tmp_path / "a", "job1")
+    published = [{'file': 'x.pdf', 'name': 'x.pdf', 'status': 'error'}]
+    write_batch(workspace, published)
+    publish_batch(store, workspace, published)
+
+    # Reprise locale pas encore publiée : le stockage n'a pas changé depuis, la copie locale reste
+    local = [{'file': 'x.pdf', 'name': 'x.pdf', 'status': 'ok'}]
+    write_batch(workspace, local)
+    reopened = restore_batch(store, tmp_path / "a", "job1")
+    assert json.loads(reopened.file("manifest.json").read_text()) == local
+
+def test_unknown_batch(tmp_path):
+    assert restore_batch(LocalStore(tmp_path / "store"), tmp_path / "a", "job1") is None
@@ -0,0 +1,111 @@
+import importlib
+
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("pandas")
+
+from records import Invoice
+from tiered_extraction import TieredResult
+
+class Recorder:
+    """Index secondaire factice : garde les factures reçues à chaque validation"""
+
+    def __init__(self):
+        self.batches = []
+
+    def commit_batch(self, job_id, invoices_data):
+        self.batches.append(sorted(invoices_data))
+        return len(invoices_data)
+
+@pytest.fixture
+def app_module(tmp_path, monkeypatch):
+    # app crée temp_files/ dans le répertoire courant à l'import
+    monkeypatch.chdir(tmp_path)
+    app = importlib.import_module("app")
+    monkeypatch.setattr(app, "get_parse_cache", lambda: None)
+    monkeypatch.setattr(app, "get_search_index", lambda: None)
+    monkeypatch.setattr(app, "get_artifact_store", lambda: None)
+    monkeypatch.setattr(app, "DEDUP_ACROSS_BATCHES", False)
+    return app
+
+def test_only_new_delivered_invoices_reach_secondary_stores(app_module, tmp_path, monkeypatch):
+    import create_invoice_excel
+    import parquet_export
+
+    broken = {"b.pdf"}
+
+    def extract(path, extractor, profiler=None):
+        filename = path.rsplit("/", 1)[-1]
+        invoice = Invoice(type='meg', numero_facture=filename, date_facture='2025-03-01')
+        invoice.totals.total_ttc = 12.0
+        return TieredResult(invoice, f"texte {filename}", 'fast')
+
+    invoice_to_row = create_invoice_excel.invoice_to_row
+
+    def to_row(invoice):
+        if invoice.numero_facture in broken:
+            raise ValueError("ligne invalide")
+        return invoice_to_row(invoice)
+
+    aggregates, ledger, exported = Recorder(), Recorder(), []
+    monkeypatch.setattr(app_module, "extract_invoice_tiered", extract)
+    monkeypatch.setattr(create_invoice_excel, "invoice_to_row", to_row)
+    monkeypatch.setattr(app_module, "get_aggregates", lambda: aggregates)
+    monkeypatch.setattr(app_module, "get_monthly_ledger", lambda: ledger)
+    monkeypatch.setattr(app_module, "PARQUET_EXPORT_DIR", str(tmp_path / "parquet"))
+    monkeypatch.setattr(parquet_export, "export_parquet",
+                        lambda invoices, directory: exported.append(sorted(invoices)))
+
+    workspace = app_module.Workspace.create(tmp_path / "workspaces")
+    for filename in ("a.pdf", "b.pdf"):
+        workspace.file(filename).write_bytes(f"%PDF {filename}".encode())
+
+    touched = []
+    monkeypatch.setattr(app_module.Workspace, "touch", lambda self: touched.append(self.job_id))
+    result = app_module.process_pdfs([workspace.file("a.pdf"), workspace.file("b.pdf")],
+                                     workspace=workspace)
+    # Expiration repoussée à chaque document : le nettoyage ne supprime pas un lot en cours
+    assert touched == [workspace.job_id] * 2
+    assert [entry['file'] for entry in result.failed] == ["b.pdf"]
+    # b.pdf n'a pas produit de ligne : il n'est reporté nulle part
+    assert aggregates.batches == ledger.batches == exported == [["a.pdf"]]
+
+    # La reprise ne reporte que la facture retraitée, pas celles déjà livrées
+    broken.clear()
+    result = app_module.retry_failed(workspace)
+    assert not result.failed
+    assert aggregates.batches == ledger.batches == exported == [["a.pdf"], ["b.pdf"]]
+
+def test_per_replica_stores_are_off_with_a_shared_artifact_store(app_module, tmp_path, monkeypatch):
+    import asyncio
+
+    from fastapi import HTTPException
+
+    def extract(path, extractor, profiler=None):
+        invoice = Invoice(type='meg', numero_facture="F1", date_facture='2025-03-01')
+        invoice.totals.total_ttc = 12.0
+        return TieredResult(invoice, "texte", 'text')
+
+    aggregates = Recorder()
+    monkeypatch.setattr(app_module, "ARTIFACT_STORE_URL", "file:///srv/artefacts")
+    monkeypatch.setattr(app_module, "DEDUP_ACROSS_BATCHES", True)
+    monkeypatch.setattr(app_module, "get_duplicate_index", lambda: pytest.fail("index local utilisé"))
+    monkeypatch.setattr(app_module, "extract_invoice_tiered", extract)
+    monkeypatch.setattr(app_module, "get_aggregates", lambda: aggregates)
+    monkeypatch.setattr(app_module, "get_monthly_ledger", lambda: None)
+    monkeypatch.setattr(app_module, "PARQUET_EXPORT_DIR", None)
+
+    workspace = app_module.Workspace.create(tmp_path / "workspaces")
+    workspace.file("a.pdf").write_bytes(b"%PDF a")
+    result = app_module.process_pdfs([workspace.file("a.pdf")], workspace=workspace)
+    assert not result.failed
+    assert aggregates.batches == []
+
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(app_module.monthly_report())
+    assert error.value.status_code == 404
+
+    # Un seul réplica derrière le stockage partagé : les bases locales sont réactivées
+    monkeypatch.setattr(app_module, "REPLICA_LOCAL_STORES", True)
+    assert app_module.local_stores_enabled()
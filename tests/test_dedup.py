@@ -0,0 +1,71 @@
+from dedup import BatchDeduplicator, DuplicateIndex
+from records import Invoice
+
+def make_invoice(numero="F1", total_ttc=12.0):
+    invoice = Invoice(type='meg')
+    invoice.numero_facture = numero
+    invoice.totals.total_ttc = total_ttc
+    return invoice
+
+def run_batch(index, job_id, files, delivered=None, policy='skip'):
+    """files : {fichier: (chemin, facture)} ; delivered : fichiers présents dans le classeur"""
+    names = {filename: f"origine_{filename}" for filename in files}
+    deduplicator = BatchDeduplicator(index, policy=policy, job_id=job_id, names=names)
+    kept = {}
+    for filename, (path, invoice) in files.items():
+        duplicate = deduplicator.check_content(filename, path)
+        if duplicate is None:
+            duplicate = deduplicator.check_invoice(filename, invoice)
+        if duplicate is None:
+            kept[filename] = invoice
+        elif deduplicator.flagged(duplicate) is not None:
+            kept[filename] = deduplicator.flagged(duplicate)
+    deduplicator.commit(kept if delivered is None else delivered)
+    return deduplicator, kept
+
+def test_undelivered_invoice_is_not_indexed(tmp_path):
+    index = DuplicateIndex(tmp_path / "index.sqlite")
+    pdf = tmp_path / "a.pdf"
+    pdf.write_bytes(b"%PDF a")
+    # Lot en échec (500, ou ligne Excel en erreur) : rien n'est enregistré
+    run_batch(index, "job1", {"a.pdf": (pdf, make_invoice())}, delivered=[])
+    deduplicator, kept = run_batch(index, "job2", {"b.pdf": (pdf, make_invoice())})
+    assert not deduplicator.duplicates
+    assert list(kept) == ["b.pdf"]
+
+def test_retry_does_not_flag_the_batch_own_files(tmp_path):
+    index = DuplicateIndex(tmp_path / "index.sqlite")
+    pdf = tmp_path / "a.pdf"
+    pdf.write_bytes(b"%PDF a")
+    run_batch(index, "job1", {"a.pdf": (pdf, make_invoice())})
+    deduplicator, kept = run_batch(index, "job1", {"a.pdf": (pdf, make_invoice())})
+    assert not deduplicator.duplicates
+    assert list(kept) == ["a.pdf"]
+
+def test_duplicates_report_original_name_and_job(tmp_path):
+    index = DuplicateIndex(tmp_path / "index.sqlite")
+    first, second = tmp_path / "a.pdf", tmp_path / "b.pdf"
+    first.write_bytes(b"%PDF a")
+    second.write_bytes(b"%PDF b")
+    run_batch(index, "job1", {"input_1.pdf": (first, make_invoice())})
+
+    deduplicator, _ = run_batch(index, "job2", {"input_2.pdf": (first, make_invoice())})
+    assert deduplicator.duplicates[0].to_dict() == {
+        'filename': "input_2.pdf", 'name': "origine_input_2.pdf",
+        'original': "origine_input_1.pdf", 'original_job': "job1", 'kind': 'content',
+    }
+
+    deduplicator, kept = run_batch(index, "job3", {"input_3.pdf": (second, make_invoice())},
+                                   policy='flag')
+    assert kept["input_3.pdf"].commentaire == "DOUBLON de origine_input_1.pdf (lot job1)"
+
+def test_invoice_duplicate_teaches_index_the_new_content(tmp_path):
+    index = DuplicateIndex(tmp_path / "index.sqlite")
+    first, second = tmp_path / "a.pdf", tmp_path / "b.pdf"
+    first.write_bytes(b"%PDF a")
+    second.write_bytes(b"%PDF b (reexport)")
+    run_batch(index, "job1", {"a.pdf": (first, make_invoice())})
+    deduplicator, _ = run_batch(index, "job2", {"b.pdf": (second, make_invoice())})
+    assert deduplicator.duplicates[0].kind == 'invoice'
+    deduplicator, _ = run_batch(index, "job3", {"c.pdf": (second, make_invoice())})
+    assert deduplicator.duplicates[0].kind == 'content'
@@ -0,0 +1,55 @@
+import pytest
+
+pytest.importorskip("pandas")
+pytest.importorskip("xlsxwriter")
+
+from monthly_ledger import MonthlyLedger
+from records import Invoice
+
+def make_invoice(numero, client="Client", date_facture="2025-03-14"):
+    invoice = Invoice(type='meg', numero_facture=numero, date_facture=date_facture,
+                      client_name=client)
+    invoice.totals.total_ttc = 12.0
+    return invoice
+
+def clients(ledger, month):
+    with ledger._lock:
+        rows = ledger._db.execute(
+            "SELECT invoice_key, row FROM rows WHERE month = ? ORDER BY position", (month,)
+        ).fetchall()
+    return [row['invoice_key'] for row in rows], [row['row'] for row in rows]
+
+def test_existing_invoice_is_replaced_in_place(tmp_path):
+    ledger = MonthlyLedger(tmp_path / "ledger.sqlite", tmp_path / "classeurs")
+    counts = ledger.commit_batch("job1", {f"{n}.pdf": make_invoice(f"F{n}") for n in range(3)})
+    assert counts == {'appended': 3, 'replaced': 0}
+
+    counts = ledger.commit_batch("job2", {"corrige.pdf": make_invoice("F1", client="Corrigé"),
+                                          "nouveau.pdf": make_invoice("F9")})
+    assert counts == {'appended': 1, 'replaced': 1}
+
+    keys, rows = clients(ledger, "2025-03")
+    assert keys == ["meg|F0", "meg|F1", "meg|F2", "meg|F9"]
+    assert "Corrigé" in rows[1]
+
+def test_date_correction_moves_row_to_its_new_month(tmp_path):
+    ledger = MonthlyLedger(tmp_path / "ledger.sqlite", tmp_path / "classeurs")
+    ledger.commit_batch("job1", {"a.pdf": make_invoice("F1"), "b.pdf": make_invoice("F2")})
+    ledger.commit_batch("job2", {"a.pdf": make_invoice("F1", date_facture="2025-04-01")})
+
+    months = {month['month']: month['rows'] for month in ledger.months()}
+    assert months == {"2025-03": 1, "2025-04": 1}
+
+def test_workbook_is_regenerated_only_when_changed(tmp_path):
+    ledger = MonthlyLedger(tmp_path / "ledger.sqlite", tmp_path / "classeurs")
+    ledger.commit_batch("job1", {"a.pdf": make_invoice("F1")})
+    path = ledger.materialize("2025-03")
+    written = path.stat().st_mtime_ns
+    assert ledger.materialize("2025-03").stat().st_mtime_ns == written
+    assert ledger.months()[0]['up_to_date']
+
+    ledger.commit_batch("job2", {"a.pdf": make_invoice("F1", client="Corrigé")})
+    assert not ledger.months()[0]['up_to_date']
+    ledger.materialize("2025-03")
+    assert ledger.months()[0]['up_to_date']
+    assert ledger.materialize("2099-01") is None
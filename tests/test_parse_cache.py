@@ -0,0 +1,73 @@
+import sqlite3
+
+import invoice_formats
+import parse_cache
+from billing_extractor import InvoiceExtractor
+from parse_cache import ParseCache, current_fingerprints
+
+MEG_TEXT = "N° client : CLT001\nTotal HT 10,00 €\nTVA 2,00 €\nTotal TTC 12,00 €\n"
+INTERNET_TEXT = "N° de commande : 42\nUGS : ABC\nPull 2 15,00 €\n"
+
+def parse(cache, text):
+    return InvoiceExtractor(cache=cache).extract_invoice(text)
+
+def test_format_change_invalidates_only_that_format(monkeypatch):
+    before = current_fingerprints()
+    # Constante référencée par l'analyseur des articles internet
+    monkeypatch.setattr(invoice_formats, "INTERNET_IGNORE_STARTS",
+                        invoice_formats.INTERNET_IGNORE_STARTS + ("Coloris",))
+    after = current_fingerprints()
+    assert after['internet'] != before['internet']
+    assert after['meg'] == before['meg']
+
+def test_shared_helper_change_invalidates_its_users(monkeypatch):
+    before = current_fingerprints()
+
+    def convert_to_float(amount_str):
+        return float(amount_str.replace(',', '.').replace(' ', '').replace(' ', ''))
+
+    monkeypatch.setattr(invoice_formats, "convert_to_float", convert_to_float)
+    after = current_fingerprints()
+    assert after['internet'] != before['internet']
+    assert after['meg'] != before['meg']
+
+def test_fingerprints_are_stable_across_calls():
+    assert current_fingerprints() == current_fingerprints()
+
+def test_persistent_hit_after_flush_and_reparse_on_fingerprint_change(tmp_path, monkeypatch):
+    path = str(tmp_path / "cache.sqlite")
+    cache = ParseCache(path, max_entries=0, flush_size=100)
+    parse(cache, MEG_TEXT)
+    # Écriture groupée : rien dans la base avant flush
+    assert sqlite3.connect(path).execute("SELECT COUNT(*) FROM results").fetchone()[0] == 0
+    cache.flush()
+
+    reopened = ParseCache(path, max_entries=0)
+    parse(reopened, MEG_TEXT)
+    assert reopened.stats()['persistent_hits'] == 1
+
+    monkeypatch.setattr(parse_cache.billing_extractor, "PARSER_VERSION", 999)
+    changed = ParseCache(path, max_entries=0)
+    parse(changed, MEG_TEXT)
+    assert changed.stats()['misses'] == 1
+
+def test_raw_text_is_kept_only_on_demand(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    cache = ParseCache(path, keep_texts=False)
+    parse(cache, MEG_TEXT)
+    cache.flush()
+    assert list(cache.stored_texts()) == []
+
+    keeping = ParseCache(path, keep_texts=True)
+    parse(keeping, INTERNET_TEXT)
+    keeping.flush()
+    assert [text for _, text in keeping.stored_texts()] == [INTERNET_TEXT]
+
+def test_persistent_level_is_bounded(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    cache = ParseCache(path, max_rows=2, flush_size=1, keep_texts=True)
+    for number in range(5):
+        parse(cache, f"{MEG_TEXT}Facture N° {number}\n")
+    rows = sqlite3.connect(path).execute("SELECT COUNT(*) FROM results").fetchone()[0]
+    assert rows == 2
+    assert len(list(cache.stored_texts())) == 2
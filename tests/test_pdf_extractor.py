@@ -0,0 +1,39 @@
+import pytest
+
+pytest.importorskip("pdfplumber")
+
+from pdf_extractor import extract_text_from_pdf
+
+def test_every_line_is_extracted_once_in_page_order(make_pdf):
+    path = make_pdf([
+        [(40, "N : FAC0000001"), (320, "ART001 premiere page"), (500, "ART002 milieu")],
+        [(30, "ART003 haut"), (780, "ART004 bas de page")],
+        [(100, "ART005 derniere page"), (670, "Total TTC 10,00")],
+    ])
+    text = extract_text_from_pdf(path, include_tables=False)['text']
+    references = ("FAC0000001", "ART001", "ART002", "ART003", "ART004", "ART005", "Total TTC")
+    for reference in references:
+        assert text.count(reference) == 1, reference
+    positions = [text.index(reference) for reference in references]
+    assert positions == sorted(positions)
+
+def test_text_and_table_cells_come_from_the_same_words(make_pdf):
+    import pdfplumber
+
+    grid = [(40, 100, 200, 130), (200, 100, 400, 130), (40, 130, 200, 160), (200, 130, 400, 160)]
+    path = make_pdf([[
+        (40, "N : FAC0000001"),
+        (108, "ART001", 50), (108, "12,00", 210),
+        (138, "ART002", 50), (138, "3,50", 210),
+        (300, "Total TTC 15,50"),
+    ]], rules=[grid])
+    extracted = extract_text_from_pdf(path)
+    assert extracted['tables'] == [[["ART001", "12,00"], ["ART002", "3,50"]]]
+
+    with pdfplumber.open(path) as pdf:
+        page = pdf.pages[0]
+        assert extracted['text'] == page.extract_text()
+        assert extracted['tables'] == page.extract_tables()
+        options = {'use_text_flow': True, 'x_tolerance': 1.5, 'y_tolerance': 5}
+        text = extract_text_from_pdf(path, include_tables=False, text_options=options)['text']
+        assert text == page.extract_text(**options)
@@ -0,0 +1,31 @@
+import json
+
+from profiling import RequestProfiler
+
+def test_failed_request_profile_is_saved_with_its_error(tmp_path):
+    profiler = RequestProfiler("job-echec", cpu=False)
+    try:
+        with profiler.stage("extract_text", "a.pdf"):
+            raise ValueError("Text extraction failed")
+    except ValueError as e:
+        path = profiler.save(tmp_path, error=e)
+    summary = json.loads(path.read_text(encoding='utf-8'))
+    assert summary['error'] == "Text extraction failed"
+    assert [entry['stage'] for entry in summary['stages']] == ["extract_text"]
+
+def test_overlapping_stage_is_marked_as_not_measured(tmp_path):
+    measured = RequestProfiler("job-mesure", cpu=False, memory=True)
+    overlapping = RequestProfiler("job-concurrent", cpu=False, memory=True)
+    try:
+        with measured.stage("extract_text", "a.pdf"):
+            with overlapping.stage("extract_text", "b.pdf"):
+                pass
+    finally:
+        measured.close()
+        overlapping.close()
+
+    assert 'peak_bytes' in measured.stages[0]['memory']
+    assert overlapping.stages[0]['memory'] == {'skipped': True}
+    summary = overlapping.memory_summary()
+    assert summary['skipped_stages'] == 1
+    assert summary['by_stage'] == {}
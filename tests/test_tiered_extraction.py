@@ -0,0 +1,44 @@
+import tiered_extraction
+from records import Article, Invoice
+from tiered_extraction import extract_invoice_tiered, reconcile
+
+def internet_invoice(*lines, frais_expedition=0.0, total_ttc=0.0, tva=0.0):
+    invoice = Invoice(type='internet', articles=[
+        Article(reference=f"UGS{index}", quantite=quantite, prix_unitaire=prix)
+        for index, (quantite, prix) in enumerate(lines)
+    ])
+    invoice.totals.total_ttc = total_ttc
+    invoice.totals.tva = tva
+    # Comme parse_internet_amounts : HT déduit, donc toujours cohérent avec TTC et TVA
+    invoice.totals.total_ht = total_ttc - tva
+    invoice.totals.frais_expedition = frais_expedition
+    return invoice
+
+def test_internet_lines_must_add_up_to_the_total():
+    assert reconcile(internet_invoice((2, 15.0), (1, 9.9), frais_expedition=4.9,
+                                      total_ttc=44.8, tva=7.47)) == []
+    # Une ligne manquée : HT + TVA = TTC tient toujours, mais les lignes ne recoupent plus
+    problems = reconcile(internet_invoice((2, 15.0), frais_expedition=4.9, total_ttc=44.8, tva=7.47))
+    assert problems == ["articles + expédition 34.90 != TTC 44.80"]
+
+def test_meg_articles_must_add_up_to_total_ht():
+    invoice = Invoice(type='meg', articles=[Article(montant_ht=10.0), Article(montant_ht=5.0)])
+    invoice.totals.total_ht, invoice.totals.tva, invoice.totals.total_ttc = 15.0, 3.0, 18.0
+    assert reconcile(invoice) == []
+    invoice.articles.pop()
+    assert reconcile(invoice) == ["somme des articles 10.00 != HT 15.00"]
+
+def test_tables_tier_reuses_the_tables_read_with_the_text(monkeypatch):
+    text = "UGS : A\nTotal 44,80 € (dont 7,47 € TVA)\nExpédition 4,90 €\n"
+    calls = []
+
+    def extract(pdf_path, include_tables=True, text_options=None):
+        calls.append(include_tables)
+        return {'text': text, 'tables': [[["Pull", "2", "15,00 €"], ["Bonnet", "1", "9,90 €"]]]}
+
+    monkeypatch.setattr(tiered_extraction, "extract_text_from_pdf", extract)
+    monkeypatch.setattr(tiered_extraction, "get_artifact_store", lambda: None)
+    result = extract_invoice_tiered("facture.pdf", tiers=['text', 'tables'])
+    assert calls == [True]
+    assert result.tier == 'tables' and result.problems == []
+    assert [article.quantite for article in result.invoice.articles] == [2, 1]
@@ -0,0 +1,57 @@
+from datetime import date, timedelta
+
+import pytest
+
+import aggregates
+import search_index
+from records import Invoice
+from watcher import DailyLedger, FolderWatcher
+
+class BrokenStore:
+    def index_batch(self, *args):
+        raise RuntimeError("index indisponible")
+
+    def commit_batch(self, *args):
+        raise RuntimeError("base verrouillée")
+
+def make_watcher(tmp_path):
+    folder = tmp_path / "depot"
+    folder.mkdir(exist_ok=True)
+    return FolderWatcher(folder, tmp_path / "sortie", workers=1, use_inotify=False)
+
+def test_secondary_store_failure_keeps_the_invoice(tmp_path, monkeypatch):
+    monkeypatch.setattr(search_index, "get_search_index", lambda: BrokenStore())
+    monkeypatch.setattr(aggregates, "get_aggregates", lambda: BrokenStore())
+    watcher = make_watcher(tmp_path)
+    watcher._commit("a.pdf", Invoice(type='meg', numero_facture='F1'), "texte")
+
+    ledger = watcher.ledger()
+    assert list(ledger.invoices) == ["a.pdf"]
+    assert not ledger.errors
+
+def test_processed_state_is_appended_and_reloaded(tmp_path):
+    watcher = make_watcher(tmp_path)
+    for name, signature in (("a.pdf", [1, 10]), ("b.pdf", [2, 20]), ("a.pdf", [3, 30])):
+        watcher._processed[name] = signature
+        watcher._save_state(name)
+    lines = watcher._state_path.read_text(encoding='utf-8').splitlines()
+    assert len(lines) == 3
+
+    restarted = make_watcher(tmp_path)
+    assert restarted._processed == {"a.pdf": [3, 30], "b.pdf": [2, 20]}
+    # Compacté au démarrage : une ligne par fichier
+    assert len(restarted._state_path.read_text(encoding='utf-8').splitlines()) == 2
+
+def test_previous_day_workbook_is_written_outside_the_lock(tmp_path):
+    pytest.importorskip("pandas")
+    watcher = make_watcher(tmp_path)
+    yesterday = DailyLedger(watcher.output_dir, date.today() - timedelta(days=1))
+    yesterday.commit({'file': 'a.pdf', 'data': Invoice(type='meg', numero_facture='F1').to_dict()})
+    watcher._ledger = yesterday
+
+    with watcher._lock:
+        # Changement de jour : la veille est seulement mise de côté
+        assert watcher.ledger().day == date.today()
+        assert not yesterday.workbook_path.exists()
+    watcher.finalize_closed_ledgers()
+    assert yesterday.workbook_path.exists()
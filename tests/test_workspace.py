@@ -0,0 +1,22 @@
+import os
+import time
+
+from workspace import Workspace, cleanup_expired
+
+def test_unique_file_sanitizes_and_deduplicates_client_names(tmp_path):
+    workspace = Workspace.create(tmp_path)
+    first = workspace.unique_file("../../etc/facture mars?.pdf")
+    assert first == workspace.file("facture mars_.pdf")
+    first.write_bytes(b"%PDF")
+    assert workspace.unique_file("facture mars?.pdf") == workspace.file("facture mars_-2.pdf")
+    assert workspace.unique_file("C:\\Users\\x\\..") == workspace.file("document.pdf")
+
+def test_touched_workspace_survives_the_janitor(tmp_path):
+    active, idle = Workspace.create(tmp_path), Workspace.create(tmp_path)
+    past = time.time() - 7200
+    for workspace in (active, idle):
+        os.utime(workspace.path, (past, past))
+    # Lot en cours : process_pdfs repousse l'expiration à chaque document
+    active.touch()
+    assert cleanup_expired(tmp_path, ttl=3600) == 1
+    assert active.path.is_dir() and not idle.path.exists()
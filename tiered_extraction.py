@@ -0,0 +1,187 @@
+"""
+Extraction par étages : le chemin texte rapide d'abord, les chemins coûteux seulement si besoin
+
+1. text    : texte pdfplumber + InvoiceExtractor (cas courant)
+2. tables  : articles relus depuis les tables détectées sur les pages
+3. layout  : texte réextrait avec d'autres réglages de mise en page
+4. ocr     : texte obtenu par OCR (pytesseract) du rendu des pages
+
+Un étage n'est lancé que si les montants de l'étage précédent ne se recoupent pas.
+Avec un stockage d'artefacts partagé, le texte retenu est publié sous l'empreinte du PDF :
+un PDF déjà vu par un autre réplica n'est pas réextrait.
+"""
+import logging
+import os
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+from artifact_store import get_artifact_store, get_json, put_json, text_key
+from billing_extractor import InvoiceExtractor
+from dedup import content_hash
+from invoice_formats import get_format
+from pdf_extractor import extract_text_from_pdf, ocr_text_from_pdf
+from profiling import NULL_PROFILER
+from records import Invoice
+
+logger = logging.getLogger(__name__)
+
+# Étages autorisés, dans l'ordre d'escalade
+EXTRACTION_TIERS = [
+    tier.strip() for tier in os.getenv("EXTRACTION_TIERS", "text,tables,layout,ocr").split(",")
+    if tier.strip()
+]
+# Écart toléré entre montants (arrondis)
+RECONCILE_TOLERANCE = float(os.getenv("RECONCILE_TOLERANCE", "0.02"))
+# Réglages pdfplumber de l'étage layout : ordre du flux PDF, tolérances plus larges
+LAYOUT_TEXT_OPTIONS = {'use_text_flow': True, 'x_tolerance': 1.5, 'y_tolerance': 5}
+OCR_LANG = os.getenv("OCR_LANG", "fra")
+OCR_RESOLUTION = int(os.getenv("OCR_RESOLUTION", "300"))
+
+def reconcile(invoice: Invoice, tolerance: float = RECONCILE_TOLERANCE) -> List[str]:
+    """
+    Contrôle de cohérence des montants ; renvoie la liste des anomalies (vide si cohérent)
+    - au moins un article et un total TTC
+    - puis les recoupements propres au format (check_amounts de invoice_formats)
+    """
+    problems = []
+    if not invoice.articles:
+        problems.append("aucun article")
+    if float(invoice.totals.total_ttc or 0) <= 0:
+        problems.append("total TTC absent")
+        return problems
+
+    try:
+        check_amounts = get_format(invoice.type).check_amounts
+    except KeyError:
+        check_amounts = None
+    if check_amounts is not None:
+        problems.extend(check_amounts(invoice, tolerance))
+    return problems
+
+@dataclass
+class TieredResult:
+    invoice: Invoice
+    text: str
+    tier: str
+    problems: List[str] = field(default_factory=list)
+    # Étages essayés, avec leurs anomalies
+    attempts: List[dict] = field(default_factory=list)
+
+def _table_text(tables) -> str:
+    """Une ligne de texte par ligne de table, cellules séparées par des espaces"""
+    lines = []
+    for table in tables:
+        for row in table:
+            cells = [cell.replace('\n', ' ').strip() for cell in row if cell]
+            if cells:
+                lines.append(' '.join(cells))
+    return '\n'.join(lines)
+
+def _run_tier(tier: str, pdf_path: str, text: str, tables: List, extractor: InvoiceExtractor):
+    """
+    (facture, texte) d'un étage coûteux ; None si l'étage ne produit rien
+    tables : tables lues avec le texte de l'étage text, sans nouvelle lecture du PDF
+    """
+    if tier == 'tables':
+        if not tables:
+            return None
+        invoice = extractor.extract_invoice(text)
+        # Articles relus depuis les lignes des tables, montants depuis le texte
+        articles = extractor.extract_articles(_table_text(tables), invoice.type)
+        if not articles:
+            return None
+        invoice.articles = articles
+        invoice.nombre_articles = len(articles)
+        return invoice, text
+
+    if tier == 'layout':
+        extracted = extract_text_from_pdf(pdf_path, include_tables=False,
+                                          text_options=LAYOUT_TEXT_OPTIONS)
+        layout_text = (extracted or {}).get('text')
+        if not layout_text:
+            return None
+        return extractor.extract_invoice(layout_text), layout_text
+
+    if tier == 'ocr':
+        ocr_text = ocr_text_from_pdf(pdf_path, resolution=OCR_RESOLUTION, lang=OCR_LANG)
+        if not ocr_text:
+            return None
+        return extractor.extract_invoice(ocr_text), ocr_text
+
+    logger.warning(f"Unknown extraction tier: {tier}")
+    return None
+
+def extract_invoice_tiered(pdf_path: str, extractor: Optional[InvoiceExtractor] = None,
+                           profiler=NULL_PROFILER, tiers: Optional[List[str]] = None) -> Optional[TieredResult]:
+    """
+    Extrait la facture d'un PDF en escaladant les étages tant que les montants ne se recoupent pas
+    Si aucun étage ne réconcilie, le résultat retenu est celui qui a le moins d'anomalies
+    (à égalité, le moins coûteux). None si le texte du PDF n'a pas pu être extrait.
+    """
+    extractor = extractor or InvoiceExtractor()
+    tiers = tiers or EXTRACTION_TIERS
+    filename = os.path.basename(pdf_path)
+
+    # Texte déjà extrait de ce PDF (par ce réplica ou un autre)
+    store = get_artifact_store()
+    pdf_digest = None
+    if store is not None:
+        try:
+            pdf_digest = content_hash(pdf_path)
+            cached = get_json(store, text_key(pdf_digest))
+        except Exception as e:
+            logger.warning(f"Artifact store unavailable for {filename}: {str(e)}")
+            store, cached = None, None
+        if cached is not None:
+            with profiler.stage("parse", filename):
+                invoice = extractor.extract_invoice(cached['text'])
+            result = TieredResult(invoice, cached['text'], cached['tier'], reconcile(invoice))
+            result.attempts.append({'tier': cached['tier'], 'problems': result.problems,
+                                    'cached': True})
+            invoice.extraction_tier = result.tier
+            return result
+
+    with profiler.stage("extract_text", filename):
+        # Tables lues avec le texte (pages tracées seulement), pour l'étage tables
+        extracted = extract_text_from_pdf(pdf_path, include_tables='tables' in tiers)
+    if extracted is None:
+        return None
+    text = extracted.get('text', '')
+    tables = extracted.get('tables', [])
+    if 'font_cache' in extracted:
+        logger.info(f"Font cache: {extracted['font_cache']}")
+
+    with profiler.stage("parse", filename):
+        invoice = extractor.extract_invoice(text)
+    best = TieredResult(invoice, text, 'text', reconcile(invoice))
+    best.attempts.append({'tier': 'text', 'problems': best.problems})
+
+    for tier in tiers:
+        if not best.problems:
+            break
+        if tier == 'text':
+            continue
+        logger.info(f"{filename}: escalating to tier '{tier}' ({'; '.join(best.problems)})")
+        with profiler.stage(f"tier_{tier}", filename):
+            produced = _run_tier(tier, pdf_path, text, tables, extractor)
+        if produced is None:
+            best.attempts.append({'tier': tier, 'problems': ['aucun résultat']})
+            continue
+        tier_invoice, tier_text = produced
+        problems = reconcile(tier_invoice)
+        best.attempts.append({'tier': tier, 'problems': problems})
+        if len(problems) < len(best.problems):
+            best = TieredResult(tier_invoice, tier_text, tier, problems, best.attempts)
+
+    if best.problems:
+        logger.warning(f"{filename}: amounts do not reconcile after {len(best.attempts)} tier(s), "
+                       f"keeping tier '{best.tier}': {'; '.join(best.problems)}")
+    best.invoice.extraction_tier = best.tier
+    # L'étage tables dépend aussi des tables du PDF : son résultat n'est pas rejouable depuis le texte
+    if store is not None and best.tier != 'tables':
+        try:
+            put_json(store, text_key(pdf_digest), {'text': best.text, 'tier': best.tier},
+                     overwrite=False)
+        except Exception as e:
+            logger.warning(f"Cannot publish extracted text of {filename}: {str(e)}")
+    return best
@@ -0,0 +1,222 @@
+"""
+Téléversement reprenable par morceaux
+
+Une session de téléversement est un espace de travail (workspace.py) contenant :
+- upload.json : marqueur de session
+- files/<file_id>.json : déclaration d'un fichier (nom, taille, taille des morceaux)
+- chunks/<file_id>/<index> : morceaux reçus, chacun écrit de façon atomique
+- input_<file_id>.pdf : fichier réassemblé dès la réception de son dernier morceau
+
+Tout l'état est sur disque : un client reprend après une coupure en demandant l'état de la
+session (morceaux manquants), même si la requête suivante arrive sur un autre worker.
+Chaque fichier complet est aussitôt mis en file d'extraction : réception et analyse se recouvrent.
+"""
+import json
+import logging
+import math
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from workspace import Workspace
+
+logger = logging.getLogger(__name__)
+
+# Taille maximale (et par défaut) d'un morceau
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", str(8 * 1024 * 1024)))
+# Taille maximale d'un fichier déclaré
+UPLOAD_MAX_FILE_BYTES = int(os.getenv("UPLOAD_MAX_FILE_BYTES", str(200 * 1024 * 1024)))
+# Extractions lancées en parallèle pendant la réception
+UPLOAD_EXTRACT_WORKERS = int(os.getenv("UPLOAD_EXTRACT_WORKERS", "2"))
+
+SESSION_MARKER = "upload.json"
+
+class UploadSession:
+    """Session de téléversement par morceaux, adossée à un espace de travail"""
+
+    def __init__(self, workspace: Workspace):
+        self.workspace = workspace
+        self.upload_id = workspace.job_id
+
+    @classmethod
+    def create(cls, root: Path) -> 'UploadSession':
+        workspace = Workspace.create(root)
+        with open(workspace.file(SESSION_MARKER), 'w', encoding='utf-8') as f:
+            json.dump({'created': time.time(), 'chunk_size': UPLOAD_CHUNK_SIZE}, f)
+        workspace.file("files").mkdir()
+        workspace.file("chunks").mkdir()
+        return cls(workspace)
+
+    @classmethod
+    def open(cls, root: Path, upload_id: str) -> Optional['UploadSession']:
+        """Rouvre une session (None si inconnue ou expirée)"""
+        workspace = Workspace.open(root, upload_id)
+        if workspace is None or not workspace.file(SESSION_MARKER).exists():
+            return None
+        return cls(workspace)
+
+    def _file_meta_path(self, file_id: str) -> Path:
+        return self.workspace.file("files") / f"{file_id}.json"
+
+    def _chunk_dir(self, file_id: str) -> Path:
+        return self.workspace.file("chunks") / file_id
+
+    def pdf_path(self, file_id: str) -> Path:
+        return self.workspace.file(f"input_{file_id}.pdf")
+
+    def add_file(self, filename: str, size: int, chunk_size: Optional[int] = None) -> Dict:
+        """Déclare un fichier à téléverser ; renvoie son identifiant et son découpage"""
+        if not filename or not filename.endswith('.pdf'):
+            raise ValueError("All files must be PDFs")
+        if size <= 0 or size > UPLOAD_MAX_FILE_BYTES:
+            raise ValueError(f"File size must be between 1 and {UPLOAD_MAX_FILE_BYTES} bytes")
+        chunk_size = min(chunk_size or UPLOAD_CHUNK_SIZE, UPLOAD_CHUNK_SIZE)
+        if chunk_size <= 0:
+            raise ValueError("Chunk size must be positive")
+
+        file_id = uuid.uuid4().hex[:16]
+        meta = {
+            'file_id': file_id,
+            'filename': filename,
+            'size': size,
+            'chunk_size': chunk_size,
+            'total_chunks': math.ceil(size / chunk_size),
+            'declared_ns': time.time_ns(),
+        }
+        with open(self._file_meta_path(file_id), 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False)
+        self._chunk_dir(file_id).mkdir()
+        self.workspace.touch()
+        return meta
+
+    def file_meta(self, file_id: str) -> Optional[Dict]:
+        if not file_id or '/' in file_id or file_id.startswith('.'):
+            return None
+        try:
+            with open(self._file_meta_path(file_id), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def files(self) -> List[Dict]:
+        """Fichiers déclarés, dans l'ordre de déclaration"""
+        metas = []
+        for path in self.workspace.file("files").glob("*.json"):
+            with open(path, 'r', encoding='utf-8') as f:
+                metas.append(json.load(f))
+        return sorted(metas, key=lambda meta: meta['declared_ns'])
+
+    def _received(self, meta: Dict) -> List[int]:
+        chunk_dir = self._chunk_dir(meta['file_id'])
+        if not chunk_dir.is_dir():
+            return []
+        return sorted(int(path.name) for path in chunk_dir.iterdir() if path.name.isdigit())
+
+    def is_complete(self, meta: Dict) -> bool:
+        return self.pdf_path(meta['file_id']).exists()
+
+    def write_chunk(self, file_id: str, index: int, data: bytes) -> Dict:
+        """
+        Enregistre un morceau (idempotent : un morceau renvoyé remplace le précédent)
+        Renvoie l'accusé de réception ; 'completed' est vrai pour la requête qui a terminé le fichier
+        """
+        meta = self.file_meta(file_id)
+        if meta is None:
+            raise KeyError(file_id)
+        if not 0 <= index < meta['total_chunks']:
+            raise ValueError(f"Chunk index must be between 0 and {meta['total_chunks'] - 1}")
+        expected = min(meta['chunk_size'], meta['size'] - index * meta['chunk_size'])
+        if len(data) != expected:
+            raise ValueError(f"Chunk {index} must be {expected} bytes, got {len(data)}")
+
+        completed = False
+        if not self.is_complete(meta):
+            chunk_path = self._chunk_dir(file_id) / str(index)
+            tmp_path = chunk_path.with_name(f".{index}.{os.getpid()}.{threading.get_ident()}.tmp")
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, chunk_path)
+            if len(self._received(meta)) == meta['total_chunks']:
+                completed = self._assemble(meta)
+        self.workspace.touch()
+        return self.file_status(meta, completed=completed)
+
+    def _assemble(self, meta: Dict) -> bool:
+        """Réassemble le fichier ; False s'il l'a déjà été par une requête concurrente"""
+        file_id = meta['file_id']
+        pdf_path = self.pdf_path(file_id)
+        chunk_dir = self._chunk_dir(file_id)
+        tmp_path = pdf_path.with_name(f".{pdf_path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        try:
+            with open(tmp_path, 'wb') as out:
+                for index in range(meta['total_chunks']):
+                    with open(chunk_dir / str(index), 'rb') as chunk:
+                        out.write(chunk.read())
+        except FileNotFoundError:
+            # Morceaux déjà consommés par l'assemblage concurrent
+            tmp_path.unlink(missing_ok=True)
+            return False
+        if pdf_path.exists():
+            tmp_path.unlink(missing_ok=True)
+            return False
+        os.replace(tmp_path, pdf_path)
+        for chunk in chunk_dir.iterdir():
+            chunk.unlink(missing_ok=True)
+        logger.info(f"Upload {self.upload_id}: file {meta['filename']} complete ({meta['size']} bytes)")
+        return True
+
+    def file_status(self, meta: Dict, completed: bool = False) -> Dict:
+        complete = self.is_complete(meta)
+        received = list(range(meta['total_chunks'])) if complete else self._received(meta)
+        missing = sorted(set(range(meta['total_chunks'])) - set(received))
+        return {
+            'file_id': meta['file_id'],
+            'filename': meta['filename'],
+            'total_chunks': meta['total_chunks'],
+            'received_chunks': len(received),
+            'missing_chunks': missing,
+            'complete': complete,
+            'completed': completed,
+        }
+
+    def status(self) -> Dict:
+        files = [self.file_status(meta) for meta in self.files()]
+        return {
+            'upload_id': self.upload_id,
+            'files': files,
+            'complete': bool(files) and all(entry['complete'] for entry in files),
+        }
+
+    def pdf_paths(self) -> List[Path]:
+        return [self.pdf_path(meta['file_id']) for meta in self.files()]
+
+class ExtractionQueue:
+    """Extractions lancées dès qu'un fichier est complet, récupérées à la finalisation"""
+
+    def __init__(self, extract, max_workers: int = UPLOAD_EXTRACT_WORKERS):
+        self._extract = extract
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="upload-extract")
+        self._futures: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+    def submit(self, pdf_path: Path):
+        with self._lock:
+            # Sessions jamais finalisées : leurs fichiers ont été supprimés par le nettoyage
+            for stale in [key for key, future in self._futures.items()
+                          if future.done() and not os.path.exists(key)]:
+                del self._futures[stale]
+            key = str(pdf_path)
+            if key not in self._futures:
+                self._futures[key] = self._executor.submit(self._extract, key)
+
+    def take(self, pdf_paths: List[Path]) -> Dict[str, Future]:
+        """Retire et renvoie les extractions lancées pour ces fichiers (par ce worker)"""
+        with self._lock:
+            return {
+                str(path): self._futures.pop(str(path))
+                for path in pdf_paths if str(path) in self._futures
+            }
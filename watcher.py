@@ -0,0 +1,414 @@
+"""
+Surveillance d'un dossier de dépôt : ingestion continue des factures
+
+    python watcher.py --folder data_factures --output-dir factures_du_jour
+
+Les PDF nouveaux ou modifiés sont détectés par inotify (Linux, via ctypes) ou, à défaut, par
+un parcours périodique du dossier. Un fichier n'est traité qu'une fois stable (taille et date
+inchangées pendant --debounce secondes), par un pool de --workers extractions. Chaque facture
+est validée dès qu'elle est prête : journal du jour (factures.jsonl), index de recherche et
+agrégats mensuels. Le classeur du jour (factures_YYYY-MM-DD.xlsx) est reconstruit toutes les
+--workbook-interval secondes s'il a changé. Seul le premier niveau du dossier est surveillé.
+"""
+import argparse
+import ctypes
+import ctypes.util
+import json
+import logging
+import os
+import select
+import signal
+import struct
+import sys
+import threading
+import time
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from billing_extractor import InvoiceExtractor
+from parse_cache import get_parse_cache
+from records import Invoice
+from tiered_extraction import extract_invoice_tiered
+
+logger = logging.getLogger(__name__)
+
+# Événements inotify utiles : écriture terminée, fichier déplacé dans le dossier, créé, modifié
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+_EVENT_HEADER = struct.Struct('iIII')
+
+class InotifyWatch:
+    """Surveillance inotify d'un dossier (non récursive) ; OSError si indisponible"""
+
+    def __init__(self, folder: Path):
+        libc_name = ctypes.util.find_library('c')
+        if not libc_name or not sys.platform.startswith('linux'):
+            raise OSError("inotify unavailable on this platform")
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+        self._fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_MODIFY
+        if libc.inotify_add_watch(self._fd, os.fsencode(str(folder)), mask) < 0:
+            errno = ctypes.get_errno()
+            os.close(self._fd)
+            raise OSError(errno, "inotify_add_watch failed")
+        self.folder = folder
+
+    def read(self, timeout: float):
+        """Noms de fichiers touchés depuis le dernier appel (attend au plus timeout secondes)"""
+        ready, _, _ = select.select([self._fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            buffer = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        names = []
+        offset = 0
+        while offset + _EVENT_HEADER.size <= len(buffer):
+            _, _, _, length = _EVENT_HEADER.unpack_from(buffer, offset)
+            offset += _EVENT_HEADER.size
+            name = buffer[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if name:
+                names.append(os.fsdecode(name))
+        return names
+
+    def close(self):
+        os.close(self._fd)
+
+class DailyLedger:
+    """Factures validées du jour : journal JSONL (rechargé au redémarrage) et classeur roulant"""
+
+    def __init__(self, output_dir: Path, day: date):
+        self.day = day
+        self.directory = Path(output_dir) / day.isoformat()
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.journal_path = self.directory / "factures.jsonl"
+        self.invoices: Dict[str, Invoice] = {}
+        self.errors: Dict[str, Dict] = {}
+        self.version = 0
+        self.written_version = -1
+        if self.journal_path.exists():
+            with open(self.journal_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    self._replay(json.loads(line))
+            self.version = 1
+
+    def _replay(self, record: Dict):
+        if record.get('error') is not None:
+            self.errors[record['file']] = record
+            self.invoices.pop(record['file'], None)
+        else:
+            self.invoices[record['file']] = Invoice.from_dict(record['data'])
+            self.errors.pop(record['file'], None)
+
+    def commit(self, record: Dict):
+        """Ajoute une entrée au journal (écrite sur disque avant d'être prise en compte)"""
+        with open(self.journal_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self._replay(record)
+        self.version += 1
+
+    @property
+    def workbook_path(self) -> Path:
+        return self.directory.parent / f"factures_{self.day.isoformat()}.xlsx"
+
+    def write_workbook(self, lock=None):
+        """
+        Reconstruit le classeur du jour s'il a changé (remplacement atomique)
+        lock : verrou des validations, tenu seulement le temps de copier les factures
+        """
+        from create_invoice_excel import create_invoice_dataframe, write_workbook
+
+        with lock or nullcontext():
+            if self.version == self.written_version:
+                return
+            version = self.version
+            invoices = dict(self.invoices)
+            errors = list(self.errors.values())
+        df = create_invoice_dataframe(invoices, errors=errors)
+        # pandas choisit le format d'après l'extension : le fichier temporaire garde .xlsx
+        tmp_path = self.workbook_path.with_suffix('.tmp.xlsx')
+        write_workbook(df, str(tmp_path), errors)
+        os.replace(tmp_path, self.workbook_path)
+        self.written_version = version
+        logger.info(f"Daily workbook updated: {self.workbook_path} ({len(invoices)} invoice(s))")
+
+class FolderWatcher:
+    def __init__(self, folder, output_dir, workers: int = 2, debounce: float = 2.0,
+                 poll_interval: float = 5.0, workbook_interval: float = 300.0,
+                 use_inotify: bool = True):
+        self.folder = Path(folder)
+        self.output_dir = Path(output_dir)
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.workbook_interval = workbook_interval
+        self.use_inotify = use_inotify
+        self.stop_event = threading.Event()
+
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="watch-extract")
+        # File bornée : pas plus de 2 fichiers en attente par worker
+        self._slots = threading.BoundedSemaphore(workers * 2)
+        self._lock = threading.Lock()
+        # Fichiers en cours d'écriture : nom -> (taille, mtime_ns, vu stable depuis)
+        self._pending: Dict[str, tuple] = {}
+        self._in_flight = set()
+        # Fichiers traités : nom -> [taille, mtime_ns], journal en ajout seul
+        self._state_path = self.output_dir / ".watcher_state.jsonl"
+        self._state_lines = 0
+        self._processed = self._load_state()
+        self._compact_state()
+        self._ledger: Optional[DailyLedger] = None
+        # Journaux des jours précédents dont le classeur reste à finaliser (hors verrou)
+        self._closed_ledgers: List[DailyLedger] = []
+
+    def _load_state(self) -> Dict[str, list]:
+        processed = {}
+        # Ancien format : carte complète réécrite après chaque fichier
+        legacy_path = self.output_dir / ".watcher_state.json"
+        try:
+            with open(legacy_path, 'r', encoding='utf-8') as f:
+                processed.update(json.load(f))
+        except (FileNotFoundError, json.JSONDecodeError):
+            pass
+        try:
+            with open(self._state_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        name, signature = json.loads(line)
+                    except ValueError:
+                        # Dernière ligne tronquée par un arrêt brutal
+                        continue
+                    processed[name] = signature
+        except FileNotFoundError:
+            pass
+        return processed
+
+    def _compact_state(self):
+        """Réécrit le journal d'état avec une ligne par fichier (remplacement atomique)"""
+        tmp_path = self._state_path.with_suffix('.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for name, signature in self._processed.items():
+                f.write(json.dumps([name, signature], ensure_ascii=False) + '\n')
+        os.replace(tmp_path, self._state_path)
+        self._state_lines = len(self._processed)
+        (self.output_dir / ".watcher_state.json").unlink(missing_ok=True)
+
+    def _save_state(self, name: str):
+        """Ajoute l'état d'un fichier au journal (appelé verrou tenu) ; compacté s'il a doublé"""
+        with open(self._state_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps([name, self._processed[name]], ensure_ascii=False) + '\n')
+        self._state_lines += 1
+        if self._state_lines > 2 * len(self._processed) + 1000:
+            self._compact_state()
+
+    def ledger(self) -> DailyLedger:
+        """
+        Journal du jour (appelé verrou tenu) ; au changement de jour, celui de la veille est mis
+        de côté et son classeur finalisé hors verrou par finalize_closed_ledgers
+        """
+        today = date.today()
+        if self._ledger is None or self._ledger.day != today:
+            if self._ledger is not None:
+                self._closed_ledgers.append(self._ledger)
+            self._ledger = DailyLedger(self.output_dir, today)
+        return self._ledger
+
+    def finalize_closed_ledgers(self):
+        """Classeurs des jours terminés : plus aucune validation ne les modifie, pas de verrou"""
+        with self._lock:
+            closed, self._closed_ledgers = self._closed_ledgers, []
+        for ledger in closed:
+            ledger.write_workbook()
+
+    def touch(self, name: str):
+        """Signale un fichier nouveau ou modifié (le délai de stabilité repart de zéro)"""
+        if not name.lower().endswith('.pdf') or name.startswith('.'):
+            return
+        with self._lock:
+            self._pending[name] = (None, None, time.monotonic())
+
+    def scan(self):
+        """Parcours complet : fichiers inconnus ou modifiés depuis leur dernier traitement"""
+        for entry in os.scandir(self.folder):
+            if not entry.is_file() or not entry.name.lower().endswith('.pdf'):
+                continue
+            stat = entry.stat()
+            if self._processed.get(entry.name) != [stat.st_size, stat.st_mtime_ns]:
+                with self._lock:
+                    if entry.name not in self._pending and entry.name not in self._in_flight:
+                        self._pending[entry.name] = (None, None, time.monotonic())
+
+    def _ready_files(self):
+        """Fichiers dont la taille et la date n'ont pas bougé depuis debounce secondes"""
+        now = time.monotonic()
+        ready = []
+        with self._lock:
+            for name, (size, mtime_ns, since) in list(self._pending.items()):
+                try:
+                    stat = os.stat(self.folder / name)
+                except FileNotFoundError:
+                    del self._pending[name]
+                    continue
+                if (stat.st_size, stat.st_mtime_ns) != (size, mtime_ns):
+                    self._pending[name] = (stat.st_size, stat.st_mtime_ns, now)
+                elif now - since >= self.debounce and stat.st_size > 0 and name not in self._in_flight:
+                    del self._pending[name]
+                    if self._processed.get(name) != [stat.st_size, stat.st_mtime_ns]:
+                        ready.append((name, stat.st_size, stat.st_mtime_ns))
+        return ready
+
+    def _dispatch(self):
+        for name, size, mtime_ns in self._ready_files():
+            # Bloque quand la file est pleine : la lecture des événements reprend ensuite
+            while not self._slots.acquire(timeout=0.5):
+                if self.stop_event.is_set():
+                    return
+            with self._lock:
+                self._in_flight.add(name)
+            self._executor.submit(self._process, name, size, mtime_ns)
+
+    def _process(self, name: str, size: int, mtime_ns: int):
+        started = time.perf_counter()
+        path = self.folder / name
+        try:
+            result = extract_invoice_tiered(str(path), InvoiceExtractor(cache=get_parse_cache()))
+            if result is None:
+                raise ValueError("Text extraction failed")
+            invoice = result.invoice
+            invoice.nombre_articles = invoice.total_quantity()
+            self._commit(name, invoice, result.text)
+            logger.info(f"{name}: committed in {time.perf_counter() - started:.2f}s "
+                        f"(tier {result.tier})")
+        except Exception as e:
+            logger.error(f"{name}: {str(e)}")
+            with self._lock:
+                self.ledger().commit({'file': name, 'name': name, 'stage': 'extract', 'error': str(e)})
+        finally:
+            with self._lock:
+                self._processed[name] = [size, mtime_ns]
+                self._in_flight.discard(name)
+                self._save_state(name)
+            self._slots.release()
+
+    def _commit(self, name: str, invoice: Invoice, text: str):
+        """
+        Validation immédiate : journal du jour, puis index de recherche, agrégats et grand livre
+        La facture est acquise dès son entrée au journal : l'échec d'un index secondaire est
+        seulement journalisé (sinon une entrée d'erreur la retirerait du classeur du jour)
+        """
+        from aggregates import get_aggregates
+        from monthly_ledger import get_monthly_ledger
+        from search_index import get_search_index
+
+        with self._lock:
+            ledger = self.ledger()
+            ledger.commit({'file': name, 'data': invoice.to_dict()})
+        job_id = f"watch-{ledger.day.isoformat()}"
+
+        search_index = get_search_index()
+        if search_index is not None:
+            try:
+                search_index.index_batch(job_id, {name: invoice}, {name: text})
+            except Exception as e:
+                logger.error(f"{name}: search indexing failed: {str(e)}")
+        aggregates = get_aggregates()
+        if aggregates is not None:
+            try:
+                aggregates.commit_batch(job_id, {name: invoice})
+            except Exception as e:
+                logger.error(f"{name}: aggregates update failed: {str(e)}")
+        monthly_ledger = get_monthly_ledger()
+        if monthly_ledger is not None:
+            try:
+                monthly_ledger.commit_batch(job_id, {name: invoice})
+            except Exception as e:
+                logger.error(f"{name}: monthly ledger update failed: {str(e)}")
+
+    def _workbook_loop(self):
+        while not self.stop_event.wait(self.workbook_interval):
+            try:
+                with self._lock:
+                    ledger = self.ledger()
+                self.finalize_closed_ledgers()
+                ledger.write_workbook(self._lock)
+            except Exception as e:
+                logger.error(f"Daily workbook failed: {str(e)}")
+
+    def run(self):
+        watch = None
+        if self.use_inotify:
+            try:
+                watch = InotifyWatch(self.folder)
+                logger.info(f"Watching {self.folder} with inotify")
+            except OSError as e:
+                logger.warning(f"inotify unavailable ({str(e)}), polling every {self.poll_interval}s")
+
+        workbook_thread = threading.Thread(target=self._workbook_loop, name="daily-workbook", daemon=True)
+        workbook_thread.start()
+
+        # Fichiers déposés pendant l'arrêt
+        self.scan()
+        last_scan = time.monotonic()
+        try:
+            while not self.stop_event.is_set():
+                if watch is not None:
+                    for name in watch.read(timeout=0.5):
+                        self.touch(name)
+                else:
+                    self.stop_event.wait(0.5)
+                # Parcours périodique : mode dégradé, et filet de sécurité avec inotify
+                interval = self.poll_interval if watch is None else self.poll_interval * 12
+                if time.monotonic() - last_scan >= interval:
+                    self.scan()
+                    last_scan = time.monotonic()
+                self._dispatch()
+        finally:
+            if watch is not None:
+                watch.close()
+            self._executor.shutdown(wait=True)
+            with self._lock:
+                ledger = self.ledger()
+            self.finalize_closed_ledgers()
+            ledger.write_workbook(self._lock)
+            logger.info("Watcher stopped")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Ingestion continue d'un dossier de factures PDF")
+    parser.add_argument("--folder", default="data_factures", help="Dossier surveillé")
+    parser.add_argument("--output-dir", default="factures_du_jour", help="Journaux et classeurs du jour")
+    parser.add_argument("--workers", type=int, default=2, help="Extractions simultanées")
+    parser.add_argument("--debounce", type=float, default=2.0,
+                        help="Secondes sans changement avant de traiter un fichier")
+    parser.add_argument("--poll-interval", type=float, default=5.0,
+                        help="Intervalle de parcours du dossier sans inotify (s)")
+    parser.add_argument("--workbook-interval", type=float, default=300.0,
+                        help="Intervalle de mise à jour du classeur du jour (s)")
+    parser.add_argument("--no-inotify", action="store_true", help="Force le parcours périodique")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    watcher = FolderWatcher(args.folder, args.output_dir, workers=args.workers,
+                            debounce=args.debounce, poll_interval=args.poll_interval,
+                            workbook_interval=args.workbook_interval,
+                            use_inotify=not args.no_inotify)
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: watcher.stop_event.set())
+    watcher.run()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
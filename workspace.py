@@ -0,0 +1,112 @@
+import asyncio
+import logging
+import os
+import re
+import shutil
+import time
+import uuid
+from datetime import datetime
+from pathlib import Path
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# Durée de vie d'un espace de travail inactif et fréquence du nettoyage
+WORKSPACE_TTL_SECONDS = int(os.getenv("WORKSPACE_TTL_SECONDS", "3600"))
+JANITOR_INTERVAL_SECONDS = int(os.getenv("JANITOR_INTERVAL_SECONDS", "300"))
+# Caractères remplacés dans le nom d'un fichier reçu
+UNSAFE_FILENAME_CHARS = re.compile(r'[^\w.()\- ]+')
+
+def new_job_id() -> str:
+    """Identifiant unique de requête/lot : horodatage lisible + suffixe aléatoire"""
+    return f"{datetime.now().strftime('%y%m%d%H%M%S')}-{uuid.uuid4().hex[:12]}"
+
+class Workspace:
+    """Répertoire isolé propre à une requête ou un lot (PDF reçus, JSON, Excel)"""
+
+    def __init__(self, root: Path, job_id: str):
+        self.root = Path(root)
+        self.job_id = job_id
+        self.path = self.root / job_id
+
+    @classmethod
+    def create(cls, root: Path, job_id: Optional[str] = None) -> 'Workspace':
+        workspace = cls(root, job_id or new_job_id())
+        workspace.path.mkdir(parents=True, exist_ok=False)
+        return workspace
+
+    @classmethod
+    def open(cls, root: Path, job_id: str) -> Optional['Workspace']:
+        """Rouvre un espace existant (None s'il a expiré ou si l'identifiant est invalide)"""
+        if not job_id or '/' in job_id or job_id.startswith('.'):
+            return None
+        workspace = cls(root, job_id)
+        return workspace if workspace.path.is_dir() else None
+
+    def file(self, name: str) -> Path:
+        return self.path / name
+
+    def unique_file(self, name: str) -> Path:
+        """
+        Chemin libre pour un fichier reçu sous le nom fourni par le client : nom réduit à sa
+        base, caractères sûrs, suffixe -2, -3... si le lot contient déjà un fichier de ce nom
+        """
+        base = os.path.basename(name.replace('\\', '/'))
+        base = UNSAFE_FILENAME_CHARS.sub('_', base).strip('. ') or 'document.pdf'
+        stem, suffix = os.path.splitext(base)
+        candidate = self.path / base
+        counter = 2
+        while candidate.exists():
+            candidate = self.path / f"{stem}-{counter}{suffix}"
+            counter += 1
+        return candidate
+
+    def touch(self):
+        """Repousse l'expiration de l'espace"""
+        os.utime(self.path)
+
+    def destroy(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+def latest_workspace(root: Path, required_file: Optional[str] = None) -> Optional[Workspace]:
+    """Renvoie l'espace le plus récent (contenant éventuellement un fichier donné)"""
+    root = Path(root)
+    if not root.is_dir():
+        return None
+    candidates = [
+        entry for entry in root.iterdir()
+        if entry.is_dir() and (required_file is None or (entry / required_file).exists())
+    ]
+    if not candidates:
+        return None
+    latest = max(candidates, key=lambda entry: entry.stat().st_mtime)
+    return Workspace(root, latest.name)
+
+def cleanup_expired(root: Path, ttl: int = WORKSPACE_TTL_SECONDS) -> int:
+    """Supprime les espaces de travail inactifs depuis plus de ttl secondes"""
+    root = Path(root)
+    if not root.is_dir():
+        return 0
+    now = time.time()
+    removed = 0
+    for entry in root.iterdir():
+        try:
+            if entry.is_dir() and now - entry.stat().st_mtime > ttl:
+                shutil.rmtree(entry, ignore_errors=True)
+                removed += 1
+        except FileNotFoundError:
+            # Supprimé entre-temps par un autre worker
+            continue
+    return removed
+
+async def janitor(root: Path, ttl: int = WORKSPACE_TTL_SECONDS,
+                  interval: int = JANITOR_INTERVAL_SECONDS):
+    """Tâche de fond : nettoie périodiquement les espaces expirés"""
+    while True:
+        try:
+            removed = await asyncio.to_thread(cleanup_expired, root, ttl)
+            if removed:
+                logger.info(f"Janitor removed {removed} expired workspace(s)")
+        except Exception as e:
+            logger.error(f"Janitor error: {str(e)}")
+        await asyncio.sleep(interval)